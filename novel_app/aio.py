@@ -0,0 +1,100 @@
+"""Bridges between the asyncio generation pipeline and synchronous callers."""
+
+from __future__ import annotations
+
+import asyncio
+import queue
+import threading
+from collections.abc import AsyncIterator, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from typing import TypeVar
+
+
+T = TypeVar("T")
+
+_DONE = object()
+
+
+async def iterate_in_thread(iterator: Iterator[T]) -> AsyncIterator[T]:
+    """Consume a blocking iterator from the event loop, one item per worker hop."""
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, next, iterator, _DONE)
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close:
+            try:
+                await loop.run_in_executor(None, close)
+            except ValueError:
+                # The iterator is still running in a worker after a cancel.
+                pass
+
+
+class EventLoopThread:
+    """A daemon thread running one event loop shared by every bridged stream.
+
+    Blocking work the loop hands off, such as chunks of synchronous model
+    clients and ``asyncio.to_thread`` calls, runs on the loop's own pool of
+    ``workers`` threads instead of asyncio's small default executor.
+    """
+
+    def __init__(self, name: str = "novel-async", workers: int = 64):
+        self.name = name
+        self.workers = max(1, int(workers))
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._guard = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._guard:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                loop.set_default_executor(
+                    ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix=f"{self.name}-blocking"
+                    )
+                )
+                threading.Thread(
+                    target=loop.run_forever, name=self.name, daemon=True
+                ).start()
+                self._loop = loop
+            return self._loop
+
+    def iterate(self, stream: AsyncIterator[T]) -> Iterator[T]:
+        """Drive an async iterator on the shared loop and yield its items here.
+
+        Closing the returned generator cancels the async iterator.
+        """
+        items: queue.Queue[tuple[str, object]] = queue.Queue()
+
+        async def pump() -> None:
+            try:
+                async for item in stream:
+                    items.put(("item", item))
+                items.put(("end", None))
+            except asyncio.CancelledError:
+                items.put(("end", None))
+                raise
+            except BaseException as exc:
+                items.put(("error", exc))
+            finally:
+                aclose = getattr(stream, "aclose", None)
+                if aclose:
+                    await aclose()
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                kind, value = items.get()
+                if kind == "item":
+                    yield value
+                elif kind == "end":
+                    return
+                else:
+                    raise value
+        finally:
+            future.cancel()
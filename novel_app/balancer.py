@@ -0,0 +1,421 @@
+"""Weighted least-outstanding balancing, retries and hedging across endpoints."""
+
+from __future__ import annotations
+
+import asyncio
+import http.client
+import math
+import queue
+import threading
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Callable, Iterator
+from itertools import chain
+from typing import Any
+
+from .openai_client import ModelServerError
+
+
+RETRYABLE_STATUSES = frozenset({408, 409, 425, 429, 500, 502, 503, 504})
+
+DEFAULT_BALANCING = {
+    "retries": 2,
+    "backoff_seconds": 0.5,
+    "cooldown_seconds": 30,
+    "hedge": False,
+    "hedge_percentile": 95,
+    "hedge_min_delay_seconds": 0.5,
+}
+
+# Hedging waits for this many first-chunk samples before trusting the percentile.
+HEDGE_MIN_SAMPLES = 10
+
+
+def balancing_settings(bot_config: dict[str, Any]) -> dict[str, Any]:
+    """The bot's ``balancing`` settings merged over the defaults."""
+    configured = bot_config.get("balancing") or {}
+    return {key: configured.get(key, value) for key, value in DEFAULT_BALANCING.items()}
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether another attempt, possibly on another endpoint, may succeed."""
+    if isinstance(error, ModelServerError):
+        return error.status in RETRYABLE_STATUSES
+    if isinstance(error, (OSError, http.client.HTTPException)):
+        return True
+    # qwen_agent wraps transport and rate-limit failures in this type.
+    return type(error).__name__ == "ModelServiceError"
+
+
+class Endpoint:
+    """One model server a bot can send requests to, with its live statistics."""
+
+    def __init__(self, label: str, agent: Any, weight: float = 1.0):
+        self.label = label
+        self.agent = agent
+        self.weight = max(0.01, float(weight))
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.cooldown_until = 0.0
+        self.first_chunk_seconds: deque[float] = deque(maxlen=200)
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+    def percentile(self, percent: float) -> float | None:
+        if not self.first_chunk_seconds:
+            return None
+        ordered = sorted(self.first_chunk_seconds)
+        rank = max(0, math.ceil(len(ordered) * percent / 100) - 1)
+        return ordered[min(rank, len(ordered) - 1)]
+
+
+class EndpointGroup:
+    """Spread one bot's requests over its endpoints.
+
+    Each attempt goes to the healthy endpoint with the fewest outstanding
+    requests per unit of weight. A retryable failure before the first chunk
+    cools the endpoint down and retries elsewhere after an exponential
+    backoff; once text has been delivered the stream is never restarted.
+    With ``hedge`` enabled, a second endpoint is raced when the first has
+    not produced a chunk within its recent ``hedge_percentile`` latency.
+    """
+
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        stream_agent: Callable[[Any, list[dict[str, Any]]], Iterator[str]],
+        astream_agent: Callable[[Any, list[dict[str, Any]]], AsyncIterator[str]] | None = None,
+        retries: int = 2,
+        backoff_seconds: float = 0.5,
+        cooldown_seconds: float = 30,
+        hedge: bool = False,
+        hedge_percentile: float = 95,
+        hedge_min_delay_seconds: float = 0.5,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.endpoints = endpoints
+        self.stream_agent = stream_agent
+        self.astream_agent = astream_agent
+        self.retries = max(0, int(retries))
+        self.backoff_seconds = float(backoff_seconds)
+        self.cooldown_seconds = float(cooldown_seconds)
+        self.hedge = bool(hedge) and len(endpoints) > 1
+        self.hedge_percentile = float(hedge_percentile)
+        self.hedge_min_delay_seconds = float(hedge_min_delay_seconds)
+        self.sleep = sleep
+        self._lock = threading.Lock()
+
+    def _acquire(self, exclude: list[Endpoint]) -> Endpoint:
+        with self._lock:
+            now = time.monotonic()
+            candidates = [item for item in self.endpoints if item not in exclude]
+            candidates = candidates or list(self.endpoints)
+            healthy = [item for item in candidates if item.healthy(now)]
+            if healthy:
+                endpoint = min(
+                    healthy,
+                    key=lambda item: ((item.outstanding + 1) / item.weight, -item.weight),
+                )
+            else:
+                endpoint = min(candidates, key=lambda item: item.cooldown_until)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def _finish(
+        self,
+        endpoint: Endpoint,
+        error: BaseException | None,
+        first_chunk: float | None,
+    ) -> None:
+        with self._lock:
+            endpoint.outstanding -= 1
+            if first_chunk is not None:
+                endpoint.first_chunk_seconds.append(first_chunk)
+            if error is None:
+                endpoint.consecutive_failures = 0
+                endpoint.cooldown_until = 0.0
+            elif is_retryable(error):
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                endpoint.cooldown_until = time.monotonic() + self.cooldown_seconds * min(
+                    endpoint.consecutive_failures, 4
+                )
+
+    def _run(self, endpoint: Endpoint, messages: list[dict[str, Any]]) -> Iterator[str]:
+        started = time.monotonic()
+        first_chunk = None
+        error = None
+        try:
+            for chunk in self.stream_agent(endpoint.agent, messages):
+                if first_chunk is None:
+                    first_chunk = time.monotonic() - started
+                yield chunk
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            self._finish(endpoint, error, first_chunk)
+
+    def _hedge_delay(self, endpoint: Endpoint) -> float | None:
+        if not self.hedge or len(endpoint.first_chunk_seconds) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(self.hedge_min_delay_seconds, endpoint.percentile(self.hedge_percentile) or 0)
+
+    def _start(
+        self, messages: list[dict[str, Any]], tried: list[Endpoint]
+    ) -> Iterator[str]:
+        """Wait for a first chunk and return the whole stream from one endpoint."""
+        primary = self._acquire(tried)
+        tried.append(primary)
+        delay = self._hedge_delay(primary)
+        if delay is None:
+            run = self._run(primary, messages)
+            first = next(run, None)
+            return chain([first], run) if first is not None else iter(())
+        return self._race(primary, delay, messages, tried)
+
+    def _race(
+        self,
+        primary: Endpoint,
+        delay: float,
+        messages: list[dict[str, Any]],
+        tried: list[Endpoint],
+    ) -> Iterator[str]:
+        events: queue.Queue[tuple[int, str, Any]] = queue.Queue()
+        cancelled: list[threading.Event] = []
+
+        def launch(endpoint: Endpoint) -> None:
+            tag = len(cancelled)
+            cancel = threading.Event()
+            cancelled.append(cancel)
+
+            def pump() -> None:
+                run = self._run(endpoint, messages)
+                try:
+                    for chunk in run:
+                        if cancel.is_set():
+                            run.close()
+                            return
+                        events.put((tag, "chunk", chunk))
+                    events.put((tag, "end", None))
+                except Exception as exc:
+                    events.put((tag, "error", exc))
+
+            threading.Thread(target=pump, daemon=True, name="novel-hedge").start()
+
+        launch(primary)
+        racers = [primary]
+        failed: dict[int, BaseException] = {}
+        winner = None
+        first = None
+        while winner is None:
+            try:
+                tag, kind, value = events.get(
+                    timeout=delay if len(racers) == 1 and not failed else None
+                )
+            except queue.Empty:
+                secondary = self._acquire(tried)
+                tried.append(secondary)
+                with self._lock:
+                    secondary.hedges += 1
+                racers.append(secondary)
+                launch(secondary)
+                continue
+            if kind == "error":
+                # Wait for any racer still running; the retry loop handles
+                # the case where every racer failed.
+                failed[tag] = value
+                if len(failed) == len(racers):
+                    raise value
+                continue
+            winner, first = tag, value
+        for tag, cancel in enumerate(cancelled):
+            if tag != winner:
+                cancel.set()
+        if winner:
+            # Tag 0 is the primary, so any other winner is the hedge.
+            with self._lock:
+                racers[winner].hedge_wins += 1
+
+        def follow() -> Iterator[str]:
+            try:
+                if first is None:
+                    return
+                yield first
+                while True:
+                    tag, kind, value = events.get()
+                    if tag != winner:
+                        continue
+                    if kind == "chunk":
+                        yield value
+                    elif kind == "end":
+                        return
+                    else:
+                        raise value
+            finally:
+                cancelled[winner].set()
+
+        return follow()
+
+    def stream(self, messages: list[dict[str, Any]]) -> Iterator[str]:
+        tried: list[Endpoint] = []
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.sleep(self.backoff_seconds * 2 ** (attempt - 1))
+            try:
+                chunks = self._start(messages, tried)
+            except Exception as exc:
+                if attempt == self.retries or not is_retryable(exc):
+                    raise
+                continue
+            yield from chunks
+            return
+
+    async def _arun(
+        self, endpoint: Endpoint, messages: list[dict[str, Any]]
+    ) -> AsyncIterator[str]:
+        started = time.monotonic()
+        first_chunk = None
+        error = None
+        try:
+            async for chunk in self.astream_agent(endpoint.agent, messages):
+                if first_chunk is None:
+                    first_chunk = time.monotonic() - started
+                yield chunk
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            self._finish(endpoint, error, first_chunk)
+
+    async def _astart(
+        self, messages: list[dict[str, Any]], tried: list[Endpoint]
+    ) -> tuple[AsyncIterator[str], str | None]:
+        """Async ``_start``: the winning stream and its first chunk, or None if empty."""
+        primary = self._acquire(tried)
+        tried.append(primary)
+        run = self._arun(primary, messages)
+        delay = self._hedge_delay(primary)
+        if delay is not None:
+            return await self._arace(primary, run, delay, messages, tried)
+        try:
+            return run, await run.__anext__()
+        except StopAsyncIteration:
+            return run, None
+
+    async def _arace(
+        self,
+        primary: Endpoint,
+        run: AsyncIterator[str],
+        delay: float,
+        messages: list[dict[str, Any]],
+        tried: list[Endpoint],
+    ) -> tuple[AsyncIterator[str], str | None]:
+        """Race a hedge against ``primary`` once it is ``delay`` late, like ``_race``."""
+        pending = {asyncio.ensure_future(run.__anext__()): (primary, run)}
+        losers: list[AsyncIterator[str]] = []
+        hedged = False
+        failure: BaseException | None = None
+        winner = None
+        try:
+            while winner is None:
+                done, _ = await asyncio.wait(
+                    pending,
+                    timeout=None if hedged or failure else delay,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    hedged = True
+                    secondary = self._acquire(tried)
+                    tried.append(secondary)
+                    with self._lock:
+                        secondary.hedges += 1
+                    hedge_run = self._arun(secondary, messages)
+                    pending[asyncio.ensure_future(hedge_run.__anext__())] = (
+                        secondary,
+                        hedge_run,
+                    )
+                    continue
+                for task in done:
+                    endpoint, racer = pending.pop(task)
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
+                        first = None
+                    except Exception as exc:
+                        # Wait for any racer still running; the retry loop
+                        # handles the case where every racer failed.
+                        failure = exc
+                        continue
+                    if winner is None:
+                        winner = (endpoint, racer, first)
+                    else:
+                        losers.append(racer)
+                if winner is None and not pending:
+                    raise failure
+        finally:
+            for task, (_, racer) in pending.items():
+                task.cancel()
+                try:
+                    await task
+                except BaseException:
+                    pass
+                losers.append(racer)
+            for racer in losers:
+                await racer.aclose()
+        endpoint, racer, first = winner
+        if endpoint is not primary:
+            with self._lock:
+                endpoint.hedge_wins += 1
+        return racer, first
+
+    async def astream(self, messages: list[dict[str, Any]]) -> AsyncIterator[str]:
+        """The asyncio counterpart of ``stream``, with the same balancing, hedging and retries."""
+        tried: list[Endpoint] = []
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff_seconds * 2 ** (attempt - 1))
+            try:
+                run, first = await self._astart(messages, tried)
+            except Exception as exc:
+                if attempt == self.retries or not is_retryable(exc):
+                    raise
+                continue
+            try:
+                if first is None:
+                    return
+                yield first
+                async for chunk in run:
+                    yield chunk
+            finally:
+                await run.aclose()
+            return
+
+    def health(self) -> list[dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "endpoint": endpoint.label,
+                    "weight": endpoint.weight,
+                    "healthy": endpoint.healthy(now),
+                    "outstanding": endpoint.outstanding,
+                    "requests": endpoint.requests,
+                    "failures": endpoint.failures,
+                    "consecutive_failures": endpoint.consecutive_failures,
+                    "hedges": endpoint.hedges,
+                    "hedge_wins": endpoint.hedge_wins,
+                    "p95_first_chunk_ms": (
+                        round(endpoint.percentile(95) * 1000)
+                        if endpoint.first_chunk_seconds
+                        else None
+                    ),
+                }
+                for endpoint in self.endpoints
+            ]
@@ -0,0 +1,310 @@
+"""Persistent caches for repeatable summarization work."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+from .database import NovelDatabase
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class SummaryCache:
+    """Content-addressed chunk summaries shared by every project.
+
+    Entries are keyed by (chunk hash, summary model, prompt version) and live
+    in the application database, so identical text is summarized only once
+    across uploads and restarts. The least recently used entries are evicted
+    when the stored summaries exceed ``max_bytes``.
+    """
+
+    def __init__(self, database: NovelDatabase, max_bytes: int):
+        self.database = database
+        self.max_bytes = max(0, int(max_bytes))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._counter_lock = threading.Lock()
+        self.initialize()
+
+    def initialize(self) -> None:
+        with self.database.connect() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS summary_cache (
+                    chunk_hash TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    prompt_version TEXT NOT NULL,
+                    summary TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY(chunk_hash, model, prompt_version)
+                );
+
+                CREATE INDEX IF NOT EXISTS idx_summary_cache_last_used
+                    ON summary_cache(last_used);
+                """
+            )
+
+    def _count(self, hits: int = 0, misses: int = 0, evictions: int = 0) -> None:
+        with self._counter_lock:
+            self.hits += hits
+            self.misses += misses
+            self.evictions += evictions
+
+    def get_many(
+        self, chunk_hashes: list[str], model: str, prompt_version: str
+    ) -> dict[str, str]:
+        """Return cached summaries for the given hashes and mark them as used."""
+        unique = list(dict.fromkeys(chunk_hashes))
+        found: dict[str, str] = {}
+        with self.database.connect() as connection:
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                placeholders = ", ".join("?" for _ in batch)
+                rows = connection.execute(
+                    f"""
+                    SELECT chunk_hash, summary FROM summary_cache
+                    WHERE model = ? AND prompt_version = ?
+                    AND chunk_hash IN ({placeholders})
+                    """,
+                    (model, prompt_version, *batch),
+                ).fetchall()
+                found.update((row["chunk_hash"], row["summary"]) for row in rows)
+            if found:
+                connection.executemany(
+                    """
+                    UPDATE summary_cache SET hits = hits + 1, last_used = ?
+                    WHERE chunk_hash = ? AND model = ? AND prompt_version = ?
+                    """,
+                    [(time.time(), key, model, prompt_version) for key in found],
+                )
+        hits = sum(1 for key in chunk_hashes if key in found)
+        self._count(hits=hits, misses=len(chunk_hashes) - hits)
+        return found
+
+    def put_many(
+        self, summaries: dict[str, str], model: str, prompt_version: str
+    ) -> None:
+        if not summaries or not self.max_bytes:
+            return
+        now = time.time()
+        with self.database.connect() as connection:
+            connection.executemany(
+                """
+                INSERT OR REPLACE INTO summary_cache (
+                    chunk_hash, model, prompt_version, summary, size, hits, last_used
+                ) VALUES (?, ?, ?, ?, ?, 0, ?)
+                """,
+                [
+                    (key, model, prompt_version, summary, len(summary.encode("utf-8")), now)
+                    for key, summary in summaries.items()
+                ],
+            )
+            self._evict(connection)
+
+    def _evict(self, connection: Any) -> None:
+        total = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM summary_cache"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        victims: list[tuple[str, str, str]] = []
+        for row in connection.execute(
+            """
+            SELECT chunk_hash, model, prompt_version, size FROM summary_cache
+            ORDER BY last_used ASC
+            """
+        ):
+            if excess <= 0:
+                break
+            victims.append((row["chunk_hash"], row["model"], row["prompt_version"]))
+            excess -= row["size"]
+        connection.executemany(
+            """
+            DELETE FROM summary_cache
+            WHERE chunk_hash = ? AND model = ? AND prompt_version = ?
+            """,
+            victims,
+        )
+        self._count(evictions=len(victims))
+
+    def stats(self) -> dict[str, int]:
+        with self.database.connect() as connection:
+            row = connection.execute(
+                "SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS size FROM summary_cache"
+            ).fetchone()
+        with self._counter_lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": int(row["entries"]),
+                "bytes": int(row["size"]),
+            }
+
+
+def response_key(
+    bot: str,
+    model: str,
+    generate_cfg: dict[str, Any],
+    system_prompt: str,
+    prompt: str,
+) -> str:
+    """Cache key of one model call; any change to model, sampling or prompts misses."""
+    return content_hash(
+        json.dumps(
+            [bot, model, generate_cfg, content_hash(system_prompt), content_hash(prompt)],
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+    )
+
+
+class ResponseCache:
+    """Complete model responses, in a memory LRU backed by the database.
+
+    Entries older than ``ttl_seconds`` are ignored and purged; the least
+    recently used database entries are evicted beyond ``max_bytes``.
+    """
+
+    def __init__(
+        self,
+        database: NovelDatabase,
+        max_bytes: int,
+        ttl_seconds: float,
+        memory_entries: int = 256,
+    ):
+        self.database = database
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl_seconds = float(ttl_seconds)
+        self.memory_entries = max(0, int(memory_entries))
+        self._memory: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.initialize()
+
+    def initialize(self) -> None:
+        with self.database.connect() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    bot TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                );
+
+                CREATE INDEX IF NOT EXISTS idx_response_cache_last_used
+                    ON response_cache(last_used);
+                """
+            )
+
+    def _fresh(self, created: float, now: float) -> bool:
+        return not self.ttl_seconds or now - created < self.ttl_seconds
+
+    def _remember(self, key: str, response: str, created: float) -> None:
+        if not self.memory_entries:
+            return
+        with self._lock:
+            self._memory[key] = (response, created)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached and self._fresh(cached[1], now):
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return cached[0]
+            self._memory.pop(key, None)
+        with self.database.connect() as connection:
+            row = connection.execute(
+                "SELECT response, created FROM response_cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row and self._fresh(row["created"], now):
+                connection.execute(
+                    "UPDATE response_cache SET last_used = ? WHERE key = ?",
+                    (now, key),
+                )
+        if not row or not self._fresh(row["created"], now):
+            with self._lock:
+                self.misses += 1
+            return None
+        self._remember(key, row["response"], row["created"])
+        with self._lock:
+            self.hits += 1
+        return row["response"]
+
+    def put(self, key: str, bot: str, response: str) -> None:
+        now = time.time()
+        self._remember(key, response, now)
+        if not self.max_bytes:
+            return
+        with self.database.connect() as connection:
+            connection.execute(
+                """
+                INSERT OR REPLACE INTO response_cache (
+                    key, bot, response, size, created, last_used
+                ) VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (key, bot, response, len(response.encode("utf-8")), now, now),
+            )
+            self._evict(connection, now)
+
+    def _evict(self, connection: Any, now: float) -> None:
+        evicted = 0
+        if self.ttl_seconds:
+            evicted += connection.execute(
+                "DELETE FROM response_cache WHERE created <= ?",
+                (now - self.ttl_seconds,),
+            ).rowcount
+        excess = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM response_cache"
+        ).fetchone()[0] - self.max_bytes
+        victims: list[tuple[str]] = []
+        if excess > 0:
+            for row in connection.execute(
+                "SELECT key, size FROM response_cache ORDER BY last_used ASC"
+            ):
+                if excess <= 0:
+                    break
+                victims.append((row["key"],))
+                excess -= row["size"]
+            connection.executemany("DELETE FROM response_cache WHERE key = ?", victims)
+        with self._lock:
+            self.evictions += evicted + len(victims)
+
+    def stats(self) -> dict[str, int]:
+        with self.database.connect() as connection:
+            row = connection.execute(
+                "SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS size FROM response_cache"
+            ).fetchone()
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": int(row["entries"]),
+                "bytes": int(row["size"]),
+            }
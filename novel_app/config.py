@@ -34,12 +34,12 @@ def _configured_value(
     return environment_value or dotenv_value or str(json_value or "").strip()
 
 
-def _resolve_bot(
-    bot_config: dict[str, Any],
+def _resolve_connection(
+    connection_config: dict[str, Any],
     dotenv_config: Mapping[str, str | None],
 ) -> dict[str, Any]:
-    """Resolve one bot using environment > .env > config.json."""
-    resolved = dict(bot_config)
+    """Resolve model, server and key using environment > .env > config.json."""
+    resolved = dict(connection_config)
     model_env = str(resolved.pop("model_env", "") or "").strip()
     server_env = str(resolved.pop("model_server_env", "") or "").strip()
     key_env = str(resolved.pop("api_key_env", "") or "").strip()
@@ -56,6 +56,27 @@ def _resolve_bot(
     return resolved
 
 
+def _resolve_bot(
+    bot_config: dict[str, Any],
+    dotenv_config: Mapping[str, str | None],
+) -> dict[str, Any]:
+    """Resolve one bot and its optional endpoint list.
+
+    Endpoints inherit the bot's model and API key when they leave them empty.
+    """
+    resolved = _resolve_connection(bot_config, dotenv_config)
+    if resolved.get("endpoints"):
+        endpoints = []
+        for endpoint_config in resolved["endpoints"]:
+            endpoint = _resolve_connection(endpoint_config, dotenv_config)
+            endpoint["model"] = endpoint["model"] or resolved["model"]
+            endpoint["api_key"] = endpoint["api_key"] or resolved["api_key"]
+            endpoint["weight"] = float(endpoint.get("weight", 1))
+            endpoints.append(endpoint)
+        resolved["endpoints"] = endpoints
+    return resolved
+
+
 def _load_or_create_secret(
     data_dir: Path,
     dotenv_config: Mapping[str, str | None],
@@ -112,9 +133,45 @@ def load_config(
     app_config.setdefault("allowed_extensions", ["txt", "md"])
     app_config.setdefault("text_length_threshold", 100_000)
     app_config.setdefault("summary_chunk_chars", 24_000)
+    app_config.setdefault("summary_chunk_overlap", 0)
     app_config.setdefault("recent_context_chars", 12_000)
     app_config.setdefault("context_char_budget", 60_000)
     app_config.setdefault("style_sample_chars", 3_000)
+    app_config.setdefault("max_inflight_calls", {"summary_bot": 4, "writing_bot": 2})
+    app_config.setdefault("summary_merge_fan_in", 8)
+    app_config.setdefault("summary_cache_max_mb", 64)
+    app_config.setdefault("response_cache_max_mb", 64)
+    app_config.setdefault("response_cache_ttl_hours", 168)
+    app_config.setdefault("background_workers", 2)
+    app_config.setdefault("blocking_workers", 64)
+    app_config.setdefault(
+        "scheduler",
+        {
+            "max_concurrent": 0,
+            "bots": {
+                "summary_bot": {
+                    "max_concurrent": 8,
+                    "requests_per_minute": 0,
+                    "tokens_per_minute": 0,
+                },
+                "writing_bot": {
+                    "max_concurrent": 4,
+                    "requests_per_minute": 0,
+                    "tokens_per_minute": 0,
+                },
+            },
+        },
+    )
+    app_config.setdefault("speculative_planning", False)
+    app_config.setdefault("metrics_event", False)
+    app_config.setdefault("max_project_tokens", 0)
+    app_config.setdefault("retrieval_char_budget", 6_000)
+    app_config.setdefault("retrieval_top_k", 6)
+    app_config.setdefault("retrieval_passage_chars", 400)
+    app_config.setdefault("prompt_reserve_tokens", 2_000)
+    app_config.setdefault("prompt_layout", "standard")
+    app_config.setdefault("tokenizer", "")
+    app_config.setdefault("memory_update_mode", "patch")
     app_config.setdefault("max_file_size_mb", 50)
     app_config.setdefault("host", "127.0.0.1")
     app_config.setdefault("port", 5000)
@@ -136,7 +193,11 @@ def validate_llm_config(llm_config: dict[str, Any]) -> None:
     """Raise a clear error only when an LLM call is actually required."""
     for name in ("summary_bot", "writing_bot"):
         bot = llm_config.get(name, {})
-        missing = [key for key in ("model", "model_server", "api_key") if not bot.get(key)]
-        if missing:
-            joined = "、".join(missing)
-            raise RuntimeError(f"{name} 缺少配置：{joined}。请检查环境变量和 config.json")
+        for index, endpoint in enumerate(bot.get("endpoints") or [bot]):
+            missing = [
+                key for key in ("model", "model_server", "api_key") if not endpoint.get(key)
+            ]
+            if missing:
+                joined = "、".join(missing)
+                where = f"{name} 的第 {index + 1} 个 endpoint" if bot.get("endpoints") else name
+                raise RuntimeError(f"{where} 缺少配置：{joined}。请检查环境变量和 config.json")
@@ -4,6 +4,7 @@ from __future__ import annotations
 
 import json
 import sqlite3
+import threading
 import uuid
 from contextlib import contextmanager
 from datetime import datetime, timezone
@@ -11,29 +12,113 @@ from pathlib import Path
 from typing import Any, Iterator
 
 
+# Every this many deltas a snapshot is stored in full, so checking one out
+# never replays more than a bounded chain.
+SNAPSHOT_KEYFRAME_INTERVAL = 8
+
+
 def utc_now() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
+# Applied once to every new connection. WAL with synchronous=NORMAL keeps
+# commits durable across application crashes while skipping an fsync per
+# transaction; the page cache and memory map are per connection.
+CONNECTION_PRAGMAS = (
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+    "PRAGMA temp_store = MEMORY",
+)
+
+# Generation columns listed without loading the text, plan or review.
+GENERATION_METADATA = """
+    id, project_id, position, version, is_active, created_at,
+    length(content) AS content_chars,
+    substr(content, 1, 100) AS excerpt,
+    plan != '' AS has_plan,
+    consistency_report != '' AS has_review
+"""
+
+# Prepared statements kept per connection, keyed by their SQL text.
+CACHED_STATEMENTS = 256
+
+# Idle connections kept open for reuse; more may be open while busy.
+IDLE_CONNECTIONS = 8
+
+
 class NovelDatabase:
+    """Project storage on one SQLite file with a pool of reusable connections.
+
+    ``connect`` lends the calling thread a configured connection and takes it
+    back afterwards, so pragmas run once per connection and its prepared
+    statements are reused across requests. Nested ``connect`` blocks on one
+    thread share the connection and its transaction, which the outermost
+    block commits or rolls back.
+    """
+
     def __init__(self, path: str):
         self.path = path
         Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._idle: list[sqlite3.Connection] = []
+        self._idle_guard = threading.Lock()
+        self._closed = False
         self.initialize()
 
+    def _open(self) -> sqlite3.Connection:
+        # A connection is used by one thread at a time but may move between
+        # threads as it is returned to the pool.
+        connection = sqlite3.connect(
+            self.path,
+            timeout=30,
+            check_same_thread=False,
+            cached_statements=CACHED_STATEMENTS,
+        )
+        connection.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            connection.execute(pragma)
+        return connection
+
+    def _acquire(self) -> sqlite3.Connection:
+        with self._idle_guard:
+            if self._idle:
+                return self._idle.pop()
+        return self._open()
+
+    def _release(self, connection: sqlite3.Connection) -> None:
+        with self._idle_guard:
+            if not self._closed and len(self._idle) < IDLE_CONNECTIONS:
+                self._idle.append(connection)
+                return
+        connection.close()
+
     @contextmanager
     def connect(self) -> Iterator[sqlite3.Connection]:
-        connection = sqlite3.connect(self.path, timeout=30)
-        connection.row_factory = sqlite3.Row
-        connection.execute("PRAGMA foreign_keys = ON")
-        connection.execute("PRAGMA journal_mode = WAL")
+        local = self._local
+        connection = getattr(local, "connection", None)
+        if connection is not None:
+            yield connection
+            return
+        connection = local.connection = self._acquire()
         try:
             yield connection
             connection.commit()
-        except Exception:
+        except BaseException:
             connection.rollback()
             raise
         finally:
+            local.connection = None
+            self._release(connection)
+
+    def close(self) -> None:
+        """Close the idle connections; busy ones are closed when returned."""
+        with self._idle_guard:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for connection in idle:
             connection.close()
 
     def initialize(self) -> None:
@@ -72,6 +157,48 @@ class NovelDatabase:
 
                 CREATE INDEX IF NOT EXISTS idx_generations_project_position
                     ON generations(project_id, position, version);
+
+                CREATE TABLE IF NOT EXISTS passage_indexes (
+                    project_id TEXT PRIMARY KEY,
+                    index_data BLOB NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    FOREIGN KEY(project_id) REFERENCES projects(id) ON DELETE CASCADE
+                );
+
+                CREATE TABLE IF NOT EXISTS memory_snapshots (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    project_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    generation_id TEXT,
+                    base_id INTEGER,
+                    depth INTEGER NOT NULL DEFAULT 0,
+                    delta_json TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    FOREIGN KEY(project_id) REFERENCES projects(id) ON DELETE CASCADE
+                );
+
+                CREATE INDEX IF NOT EXISTS idx_memory_snapshots_lookup
+                    ON memory_snapshots(project_id, position, generation_id);
+
+                CREATE TABLE IF NOT EXISTS memory_trees (
+                    project_id TEXT PRIMARY KEY,
+                    tree_json TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    FOREIGN KEY(project_id) REFERENCES projects(id) ON DELETE CASCADE
+                );
+
+                CREATE TABLE IF NOT EXISTS token_usage (
+                    project_id TEXT NOT NULL,
+                    generation_id TEXT NOT NULL DEFAULT '',
+                    bot TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    calls INTEGER NOT NULL DEFAULT 0,
+                    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                    completion_tokens INTEGER NOT NULL DEFAULT 0,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY(project_id, generation_id, bot, stage),
+                    FOREIGN KEY(project_id) REFERENCES projects(id) ON DELETE CASCADE
+                );
                 """
             )
 
@@ -162,6 +289,193 @@ class NovelDatabase:
                 ),
             )
 
+    @staticmethod
+    def _checkout_snapshot(
+        connection: sqlite3.Connection, snapshot_id: int
+    ) -> tuple[dict[str, Any], int]:
+        chain: list[sqlite3.Row] = []
+        next_id: int | None = snapshot_id
+        while next_id is not None:
+            row = connection.execute(
+                "SELECT base_id, depth, delta_json FROM memory_snapshots WHERE id = ?",
+                (next_id,),
+            ).fetchone()
+            chain.append(row)
+            next_id = row["base_id"]
+        memory: dict[str, Any] = {}
+        for row in reversed(chain):
+            delta = json.loads(row["delta_json"])
+            for key in delta.get("unset", []):
+                memory.pop(key, None)
+            memory.update(delta.get("set", {}))
+        return memory, int(chain[0]["depth"])
+
+    def save_memory_snapshot(
+        self,
+        project_id: str,
+        position: int,
+        generation_id: str | None,
+        memory: dict[str, Any],
+        base_id: int | None = None,
+    ) -> int:
+        """Store memory as of a generation, as a delta from ``base_id`` when given.
+
+        Position 0 with no generation holds the memory of the original text.
+        """
+        with self.connect() as connection:
+            depth = 0
+            delta: dict[str, Any] = {"set": memory}
+            if base_id is not None:
+                base, base_depth = self._checkout_snapshot(connection, base_id)
+                if base_depth + 1 < SNAPSHOT_KEYFRAME_INTERVAL:
+                    depth = base_depth + 1
+                    delta = {
+                        "set": {
+                            key: value for key, value in memory.items()
+                            if base.get(key) != value
+                        },
+                        "unset": [key for key in base if key not in memory],
+                    }
+                else:
+                    base_id = None
+            cursor = connection.execute(
+                """
+                INSERT INTO memory_snapshots (
+                    project_id, position, generation_id, base_id, depth,
+                    delta_json, created_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    project_id,
+                    position,
+                    generation_id,
+                    base_id,
+                    depth,
+                    json.dumps(delta, ensure_ascii=False),
+                    utc_now(),
+                ),
+            )
+        return int(cursor.lastrowid)
+
+    def memory_snapshot(
+        self, project_id: str, position: int, generation_id: str | None
+    ) -> tuple[int, dict[str, Any]] | None:
+        """Return the id and memory of the latest snapshot for a generation."""
+        with self.connect() as connection:
+            row = connection.execute(
+                """
+                SELECT id FROM memory_snapshots
+                WHERE project_id = ? AND position = ? AND generation_id IS ?
+                ORDER BY id DESC LIMIT 1
+                """,
+                (project_id, position, generation_id),
+            ).fetchone()
+            if not row:
+                return None
+            memory, _ = self._checkout_snapshot(connection, row["id"])
+        return int(row["id"]), memory
+
+    def get_memory_tree(self, project_id: str) -> dict[str, Any] | None:
+        with self.connect() as connection:
+            row = connection.execute(
+                "SELECT tree_json FROM memory_trees WHERE project_id = ?",
+                (project_id,),
+            ).fetchone()
+        if not row:
+            return None
+        try:
+            tree = json.loads(row["tree_json"])
+        except json.JSONDecodeError:
+            return None
+        return tree if isinstance(tree, dict) else None
+
+    def set_memory_tree(self, project_id: str, tree: dict[str, Any]) -> None:
+        """Persist chunk boundaries and partial summaries for incremental rebuilds."""
+        with self.connect() as connection:
+            connection.execute(
+                """
+                INSERT INTO memory_trees (project_id, tree_json, updated_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT(project_id) DO UPDATE SET
+                    tree_json = excluded.tree_json,
+                    updated_at = excluded.updated_at
+                """,
+                (project_id, json.dumps(tree, ensure_ascii=False), utc_now()),
+            )
+
+    def get_passage_index(self, project_id: str) -> bytes | None:
+        with self.connect() as connection:
+            row = connection.execute(
+                "SELECT index_data FROM passage_indexes WHERE project_id = ?",
+                (project_id,),
+            ).fetchone()
+        return bytes(row["index_data"]) if row else None
+
+    def set_passage_index(self, project_id: str, data: bytes) -> None:
+        with self.connect() as connection:
+            connection.execute(
+                """
+                INSERT OR REPLACE INTO passage_indexes (project_id, index_data, updated_at)
+                VALUES (?, ?, ?)
+                """,
+                (project_id, data, utc_now()),
+            )
+
+    def add_token_usage(
+        self,
+        project_id: str,
+        generation_id: str,
+        usage: list[dict[str, Any]],
+    ) -> None:
+        """Add per-call ``bot``/``stage``/token counts to the project's totals.
+
+        ``generation_id`` is empty for work not tied to one generation, such
+        as the initial memory build. Usage of a deleted project is dropped.
+        """
+        now = utc_now()
+        with self.connect() as connection:
+            connection.executemany(
+                """
+                INSERT INTO token_usage (
+                    project_id, generation_id, bot, stage, calls,
+                    prompt_tokens, completion_tokens, updated_at
+                )
+                SELECT ?, ?, ?, ?, 1, ?, ?, ?
+                WHERE EXISTS (SELECT 1 FROM projects WHERE id = ?)
+                ON CONFLICT(project_id, generation_id, bot, stage) DO UPDATE SET
+                    calls = calls + 1,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    completion_tokens = completion_tokens + excluded.completion_tokens,
+                    updated_at = excluded.updated_at
+                """,
+                [
+                    (
+                        project_id,
+                        generation_id,
+                        call["bot"],
+                        call["stage"],
+                        call["prompt_tokens"],
+                        call["completion_tokens"],
+                        now,
+                        project_id,
+                    )
+                    for call in usage
+                ],
+            )
+
+    def token_usage(self, project_id: str) -> list[dict[str, Any]]:
+        with self.connect() as connection:
+            rows = connection.execute(
+                """
+                SELECT generation_id, bot, stage, calls, prompt_tokens, completion_tokens
+                FROM token_usage
+                WHERE project_id = ?
+                ORDER BY generation_id, bot, stage
+                """,
+                (project_id,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
     def active_generations(self, project_id: str) -> list[dict[str, Any]]:
         with self.connect() as connection:
             rows = connection.execute(
@@ -239,6 +553,75 @@ class NovelDatabase:
             ).fetchone()
         return dict(saved)
 
+    def generation_page(
+        self,
+        project_id: str,
+        active_only: bool,
+        after: tuple[int, int] | None = None,
+        limit: int = 50,
+    ) -> list[dict[str, Any]]:
+        """Up to ``limit`` generations after the ``(position, version)`` cursor.
+
+        Rows carry metadata and a short excerpt but not the text itself.
+        Active generations are ordered by position; the full history by
+        position and then newest version first.
+        """
+        conditions = ["project_id = ?"]
+        parameters: list[Any] = [project_id]
+        if active_only:
+            conditions.append("is_active = 1")
+        if after:
+            conditions.append("(position > ? OR (position = ? AND version < ?))")
+            parameters += [after[0], after[0], after[1]]
+        with self.connect() as connection:
+            rows = connection.execute(
+                f"""
+                SELECT {GENERATION_METADATA} FROM generations
+                WHERE {" AND ".join(conditions)}
+                ORDER BY position ASC, version DESC
+                LIMIT ?
+                """,
+                (*parameters, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def generation_counts(self, project_id: str) -> dict[str, Any]:
+        """Active and total version counts, and the last active generation's metadata."""
+        with self.connect() as connection:
+            counts = connection.execute(
+                """
+                SELECT COALESCE(SUM(is_active), 0) AS active_count, COUNT(*) AS version_count
+                FROM generations WHERE project_id = ?
+                """,
+                (project_id,),
+            ).fetchone()
+            latest = connection.execute(
+                f"""
+                SELECT {GENERATION_METADATA} FROM generations
+                WHERE project_id = ? AND is_active = 1
+                ORDER BY position DESC LIMIT 1
+                """,
+                (project_id,),
+            ).fetchone()
+        return {**dict(counts), "latest_generation": dict(latest) if latest else None}
+
+    def get_generation(
+        self, project_id: str, generation_id: str
+    ) -> dict[str, Any] | None:
+        with self.connect() as connection:
+            row = connection.execute(
+                "SELECT * FROM generations WHERE id = ? AND project_id = ?",
+                (generation_id, project_id),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def set_consistency_report(self, generation_id: str, report: str) -> None:
+        with self.connect() as connection:
+            connection.execute(
+                "UPDATE generations SET consistency_report = ? WHERE id = ?",
+                (report, generation_id),
+            )
+
     def restore_generation(
         self, project_id: str, generation_id: str
     ) -> dict[str, Any] | None:
@@ -0,0 +1,103 @@
+"""Microbenchmark of per-request database overhead, with and without pooling.
+
+A request here is what ``GET /api/projects/<id>`` reads: the project, its
+generation counts with the latest generation's metadata, and its token
+usage. The baseline opens and configures a
+new connection for every call, as ``NovelDatabase.connect`` used to::
+
+    python -m novel_app.dbbench --requests 2000
+"""
+
+from __future__ import annotations
+
+import argparse
+import sqlite3
+import tempfile
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any
+
+from .database import NovelDatabase
+
+
+class PerCallDatabase(NovelDatabase):
+    """The baseline: a fresh connection and pragmas on every ``connect``."""
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.execute("PRAGMA journal_mode = WAL")
+        try:
+            yield connection
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+
+def _seed(database: NovelDatabase, generations: int) -> tuple[str, str]:
+    project = database.create_project(
+        "owner", "基准", "林舟站在旧宅门前。" * 200, "", 1000, "standard"
+    )
+    for position in range(1, generations + 1):
+        saved = database.save_generation(project["id"], position, "林舟推开了门。" * 100)
+        database.add_token_usage(
+            project["id"],
+            saved["id"],
+            [
+                {"bot": bot, "stage": stage, "prompt_tokens": 2000, "completion_tokens": 500}
+                for bot, stage in (("writing_bot", "stream"), ("summary_bot", "consistency"))
+            ],
+        )
+    return project["id"], "owner"
+
+
+def measure(database: NovelDatabase, requests: int, generations: int = 10) -> float:
+    """Mean seconds per project-payload request against ``database``."""
+    project_id, owner = _seed(database, generations)
+    for _ in range(min(requests, 50)):
+        database.get_project(project_id, owner)
+    started = time.perf_counter()
+    for _ in range(requests):
+        database.get_project(project_id, owner)
+        database.generation_counts(project_id)
+        database.token_usage(project_id)
+    return (time.perf_counter() - started) / requests
+
+
+def run(requests: int = 2_000, generations: int = 10) -> dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix="novel-dbbench-") as directory:
+        baseline = measure(
+            PerCallDatabase(str(Path(directory) / "per_call.db")), requests, generations
+        )
+        pooled_database = NovelDatabase(str(Path(directory) / "pooled.db"))
+        pooled = measure(pooled_database, requests, generations)
+        pooled_database.close()
+    return {
+        "requests": requests,
+        "per_call_us": round(baseline * 1_000_000, 1),
+        "pooled_us": round(pooled * 1_000_000, 1),
+        "speedup": round(baseline / pooled, 2) if pooled else None,
+    }
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="数据库连接开销基准测试")
+    parser.add_argument("--requests", type=int, default=2_000)
+    parser.add_argument("--generations", type=int, default=10, help="每个项目的续写段数")
+    args = parser.parse_args(argv)
+    result = run(args.requests, args.generations)
+    print(
+        f"每个请求（读取项目、续写计数和 Token 用量）：每次新建连接 {result['per_call_us']} 微秒，"
+        f"连接池 {result['pooled_us']} 微秒，加速 {result['speedup']} 倍"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,36 @@
-"""Small adapter around Qwen Agent with test-friendly streaming behavior."""
+"""Small adapter around the model clients with test-friendly streaming behavior."""
 
 from __future__ import annotations
 
-from collections.abc import Iterator
+import asyncio
+import threading
+import time
+from collections.abc import AsyncIterator, Iterator
 from typing import Any
 
+from .aio import iterate_in_thread
+from .balancer import Endpoint, EndpointGroup, balancing_settings
+from .cache import ResponseCache, response_key
 from .config import validate_llm_config
+from .metrics import MetricsRegistry
+from .openai_client import OpenAIChatClient
+from .scheduler import RequestScheduler, Ticket, current_request
+from .tokens import approximate_tokens
+from .transport import TransportRegistry
+
+
+# Bot settings read by this application rather than by the model client.
+GATEWAY_KEYS = frozenset(
+    {
+        "context_window",
+        "backend",
+        "transport",
+        "response_cache",
+        "balancing",
+        "weight",
+        "pricing",
+    }
+)
 
 
 def _content_from_response(response: Any) -> str:
@@ -24,61 +49,266 @@ def _content_from_response(response: Any) -> str:
     return ""
 
 
+def _stream_agent(agent: Any, messages: list[dict[str, Any]]) -> Iterator[str]:
+    """Yield only the new text of each response an agent produces."""
+    if hasattr(agent, "stream_deltas"):
+        # Delta clients already yield only the new text of each event.
+        yield from agent.stream_deltas(messages)
+        return
+    emitted = ""
+    for response in agent.run(messages=messages):
+        content = _content_from_response(response)
+        if not content:
+            continue
+        if content.startswith(emitted):
+            chunk = content[len(emitted):]
+            emitted = content
+        else:
+            chunk = content
+            emitted += content
+        if chunk:
+            yield chunk
+
+
+async def _astream_agent(agent: Any, messages: list[dict[str, Any]]) -> AsyncIterator[str]:
+    """Async deltas of an agent, bridging blocking agents through worker threads."""
+    if hasattr(agent, "astream_deltas"):
+        async for chunk in agent.astream_deltas(messages):
+            yield chunk
+        return
+    async for chunk in iterate_in_thread(_stream_agent(agent, messages)):
+        yield chunk
+
+
 class AgentGateway:
     def __init__(
         self,
         llm_config: dict[str, Any],
         prompts: dict[str, str],
         agents: dict[str, Any] | None = None,
+        response_cache: ResponseCache | None = None,
+        scheduler: RequestScheduler | None = None,
+        metrics: MetricsRegistry | None = None,
     ):
         self.llm_config = llm_config
         self.prompts = prompts
         self._agents = agents or {}
+        self.response_cache = response_cache
+        self.scheduler = scheduler
+        self.metrics = metrics or MetricsRegistry()
+        self.transports = TransportRegistry()
+        self._groups: dict[str, EndpointGroup] = {}
+        self._groups_guard = threading.Lock()
+        self._system_tokens: dict[str, int] = {}
 
-    def _agent(self, name: str) -> Any:
-        if name in self._agents:
-            return self._agents[name]
-        validate_llm_config(self.llm_config)
+    @staticmethod
+    def _prompt_key(name: str) -> str:
+        return "summary_instruction" if name == "summary_bot" else "writing_instruction"
+
+    def system_tokens(self, name: str) -> int:
+        """Estimated tokens of the system message sent with every call to ``name``."""
+        if name not in self._system_tokens:
+            self._system_tokens[name] = approximate_tokens(
+                self.prompts.get(self._prompt_key(name), "")
+            )
+        return self._system_tokens[name]
+
+    def _response_key(self, name: str, text: str) -> str | None:
+        """The cache key of a call, or ``None`` when the bot does not cache."""
+        bot_config = self.llm_config.get(name, {})
+        if not self.response_cache or not bot_config.get("response_cache"):
+            return None
+        return response_key(
+            name,
+            str(bot_config.get("model", "")),
+            bot_config.get("generate_cfg") or {},
+            self.prompts.get(self._prompt_key(name), ""),
+            text,
+        )
+
+    def _create_agent(self, name: str, bot_config: dict[str, Any]) -> Any:
+        system_message = self.prompts[self._prompt_key(name)]
+        if bot_config.get("backend", "qwen_agent") == "openai":
+            return OpenAIChatClient(bot_config, system_message, self.transports)
         try:
             from qwen_agent.agents import Assistant
         except ImportError as exc:
             raise RuntimeError("未安装 qwen-agent，请先执行 pip install -r requirements.txt") from exc
-        prompt_key = "summary_instruction" if name == "summary_bot" else "writing_instruction"
-        self._agents[name] = Assistant(
-            llm=self.llm_config[name],
-            system_message=self.prompts[prompt_key],
+        return Assistant(
+            llm={
+                key: value
+                for key, value in bot_config.items()
+                if key not in GATEWAY_KEYS
+            },
+            system_message=system_message,
+        )
+
+    def _group(self, name: str) -> EndpointGroup:
+        """The bot's endpoints, built once from ``endpoints`` or its single server.
+
+        Injected agents (a single agent or a list) stand in for endpoints.
+        """
+        with self._groups_guard:
+            if name in self._groups:
+                return self._groups[name]
+        bot_config = self.llm_config.get(name, {})
+        if name in self._agents:
+            injected = self._agents[name]
+            agents = injected if isinstance(injected, list) else [injected]
+            endpoints = [
+                Endpoint(f"{name}#{index}", agent) for index, agent in enumerate(agents)
+            ]
+        else:
+            validate_llm_config(self.llm_config)
+            shared = {key: value for key, value in bot_config.items() if key != "endpoints"}
+            endpoints = [
+                Endpoint(
+                    spec["model_server"],
+                    self._create_agent(name, {**shared, **spec}),
+                    spec.get("weight", 1),
+                )
+                for spec in bot_config.get("endpoints") or [bot_config]
+            ]
+        group = EndpointGroup(
+            endpoints, _stream_agent, _astream_agent, **balancing_settings(bot_config)
+        )
+        with self._groups_guard:
+            return self._groups.setdefault(name, group)
+
+    def enqueue(
+        self,
+        name: str,
+        text: str,
+        owner_token: str | None = None,
+        priority: int | None = None,
+    ) -> Ticket | None:
+        """Queue a call with the scheduler; defaults come from ``run_as``."""
+        if not self.scheduler:
+            return None
+        context_owner, context_priority = current_request()
+        return self.scheduler.enqueue(
+            name,
+            context_owner if owner_token is None else owner_token,
+            context_priority if priority is None else priority,
+            approximate_tokens(text),
         )
-        return self._agents[name]
-
-    def call(self, name: str, text: str) -> str:
-        emitted = ""
-        for response in self._agent(name).run(
-            messages=[{"role": "user", "content": text}]
-        ):
-            content = _content_from_response(response)
-            if not content:
-                continue
-            if content.startswith(emitted):
-                emitted = content
-            else:
-                emitted += content
+
+    def call(self, name: str, text: str, ticket: Ticket | None = None) -> str:
+        key = self._response_key(name, text)
+        if key:
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                if ticket:
+                    ticket.release()
+                return cached
+        emitted = "".join(self.stream(name, text, ticket))
         if not emitted.strip():
             raise RuntimeError(f"{name} 返回了空响应")
+        if key:
+            self.response_cache.put(key, name, emitted)
         return emitted
 
-    def stream(self, name: str, text: str) -> Iterator[str]:
-        emitted = ""
-        for response in self._agent(name).run(
-            messages=[{"role": "user", "content": text}]
-        ):
-            content = _content_from_response(response)
-            if not content:
-                continue
-            if content.startswith(emitted):
-                chunk = content[len(emitted):]
-                emitted = content
-            else:
-                chunk = content
-                emitted += content
-            if chunk:
+    def stream(
+        self, name: str, text: str, ticket: Ticket | None = None
+    ) -> Iterator[str]:
+        """Stream a call, waiting for its scheduler turn unless ``ticket`` holds one."""
+        messages = [{"role": "user", "content": text}]
+        if not self.scheduler:
+            return self._observed(name, text, self._group(name).stream(messages))
+        return self._scheduled(name, text, messages, ticket)
+
+    def _observed(self, name: str, text: str, chunks: Iterator[str]) -> Iterator[str]:
+        """Pass chunks through, reporting the call's duration and sizes at the end."""
+        started = time.perf_counter()
+        first_chunk = None
+        emitted: list[str] = []
+        try:
+            for chunk in chunks:
+                if first_chunk is None:
+                    first_chunk = time.perf_counter() - started
+                emitted.append(chunk)
                 yield chunk
+        finally:
+            self.metrics.observe_call(
+                name,
+                text,
+                "".join(emitted),
+                time.perf_counter() - started,
+                first_chunk,
+                self.system_tokens(name),
+            )
+
+    def _scheduled(
+        self,
+        name: str,
+        text: str,
+        messages: list[dict[str, Any]],
+        ticket: Ticket | None,
+    ) -> Iterator[str]:
+        ticket = ticket or self.enqueue(name, text)
+        try:
+            # Resolved here so a misconfigured bot still releases the ticket.
+            group = self._group(name)
+            ticket.wait()
+            yield from self._observed(name, text, group.stream(messages))
+        finally:
+            ticket.release()
+
+    async def acall(self, name: str, text: str, ticket: Ticket | None = None) -> str:
+        """The asyncio counterpart of ``call``, sharing its response cache."""
+        key = self._response_key(name, text)
+        if key:
+            cached = await asyncio.to_thread(self.response_cache.get, key)
+            if cached is not None:
+                if ticket:
+                    ticket.release()
+                return cached
+        emitted = "".join([chunk async for chunk in self.astream(name, text, ticket)])
+        if not emitted.strip():
+            raise RuntimeError(f"{name} 返回了空响应")
+        if key:
+            await asyncio.to_thread(self.response_cache.put, key, name, emitted)
+        return emitted
+
+    async def astream(
+        self, name: str, text: str, ticket: Ticket | None = None
+    ) -> AsyncIterator[str]:
+        """Stream a call on the event loop; scheduler waits do not hold a thread."""
+        messages = [{"role": "user", "content": text}]
+        if self.scheduler:
+            ticket = ticket or self.enqueue(name, text)
+        try:
+            group = self._group(name)
+            if ticket:
+                await ticket.wait_async()
+            started = time.perf_counter()
+            first_chunk = None
+            chunks: list[str] = []
+            try:
+                async for chunk in group.astream(messages):
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter() - started
+                    chunks.append(chunk)
+                    yield chunk
+            finally:
+                self.metrics.observe_call(
+                    name,
+                    text,
+                    "".join(chunks),
+                    time.perf_counter() - started,
+                    first_chunk,
+                    self.system_tokens(name),
+                )
+        finally:
+            if ticket:
+                ticket.release()
+
+    def endpoint_health(self) -> dict[str, list[dict[str, Any]]]:
+        """Load and health state of every endpoint of the bots used so far."""
+        with self._groups_guard:
+            groups = dict(self._groups)
+        return {name: group.health() for name, group in groups.items()}
+
+    def transport_stats(self) -> dict[str, dict[str, Any]]:
+        """Utilization counters of the shared connection pools, per endpoint."""
+        return self.transports.stats()
@@ -0,0 +1,287 @@
+"""End-to-end load harness: concurrent writing sessions against a mock model.
+
+Each session creates a project with ``POST /process``, reads the first
+continuation from ``/stream`` and then ``continues`` more from
+``/continue``, all through ``create_app`` with a ``backend: openai``
+configuration pointed at a local :class:`~novel_app.mock_llm.MockLLMServer`.
+The report gives per-stage latency and time-to-first-token percentiles,
+throughput and error counts::
+
+    python -m novel_app.loadtest --sessions 20 --continues 2 --ttft 0.3
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+from .config import BASE_DIR
+from .mock_llm import MockLLMServer
+from .web import create_app
+
+
+SAMPLE_PARAGRAPH = (
+    "夜色压在旧宅的屋檐上，林舟站在门前，手里攥着那把从信封里掉出来的铜钥匙。"
+    "院子里的槐树被风吹得沙沙作响，二楼的窗户却亮着一盏不该亮的灯。\n"
+)
+
+STAGES = ("process", "stream", "continue")
+
+# Connection keys that would let environment variables redirect the bots.
+_ENV_KEYS = ("model_env", "model_server_env", "api_key_env")
+
+
+def percentile(values: list[float], percent: float) -> float | None:
+    """Nearest-rank percentile, or None without samples."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, math.ceil(len(ordered) * percent / 100) - 1)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def write_mock_config(server_url: str, data_dir: Path, base_config: Path | None = None) -> Path:
+    """Copy ``config.json`` with every bot sent to ``server_url`` over the native client."""
+    with Path(base_config or BASE_DIR / "config.json").open("r", encoding="utf-8") as handle:
+        config = json.load(handle)
+    for bot in config["llm_config"].values():
+        for key in (*_ENV_KEYS, "endpoints"):
+            bot.pop(key, None)
+        bot.update(
+            model="mock-model",
+            model_server=server_url,
+            api_key="mock",
+            backend="openai",
+            response_cache=False,
+        )
+    config["app_config"].update(
+        database_path=str(data_dir / "novels.db"),
+        upload_folder=str(data_dir / "uploads"),
+    )
+    path = data_dir / "config.json"
+    path.write_text(json.dumps(config, ensure_ascii=False, indent=2), encoding="utf-8")
+    return path
+
+
+def _read_sse(client: Any, url: str) -> dict[str, Any]:
+    """Time one SSE generation: total seconds, first content and streamed chars."""
+    started = time.perf_counter()
+    result: dict[str, Any] = {"seconds": 0.0, "ttft": None, "chars": 0, "error": None}
+    response = client.get(url, buffered=False)
+    try:
+        if response.status_code != 200:
+            result["error"] = f"HTTP {response.status_code}"
+            return result
+        pending = ""
+        for chunk in response.response:
+            pending += chunk.decode("utf-8") if isinstance(chunk, bytes) else chunk
+            *events, pending = pending.split("\n\n")
+            for raw in events:
+                if not raw.startswith("data: "):
+                    continue
+                event = json.loads(raw[6:])
+                if event.get("type") == "content":
+                    if result["ttft"] is None:
+                        result["ttft"] = time.perf_counter() - started
+                    result["chars"] += len(event["content"])
+                elif event.get("type") == "error":
+                    result["error"] = event.get("content")
+    finally:
+        response.close()
+        result["seconds"] = time.perf_counter() - started
+    return result
+
+
+def run_session(
+    app: Any, text: str, continues: int, writing_mode: str, word_limit: int
+) -> list[tuple[str, dict[str, Any]]]:
+    """One user's process → stream → continue… sequence, timed per stage."""
+    client = app.test_client()
+    started = time.perf_counter()
+    response = client.post(
+        "/process",
+        data={
+            "title": "压测",
+            "text_input": text,
+            "requirements": "保持悬疑",
+            "word_limit": str(word_limit),
+            "writing_mode": writing_mode,
+        },
+    )
+    payload = response.get_json(silent=True) or {}
+    results = [
+        (
+            "process",
+            {
+                "seconds": time.perf_counter() - started,
+                "ttft": None,
+                "chars": 0,
+                "error": None if payload.get("success") else payload.get("error", "HTTP error"),
+            },
+        )
+    ]
+    if not payload.get("success"):
+        return results
+    project_id = payload["project_id"]
+    results.append(("stream", _read_sse(client, f"/stream/{project_id}")))
+    for _ in range(continues):
+        results.append(("continue", _read_sse(client, f"/continue/{project_id}")))
+    return results
+
+
+def summarize(
+    results: list[tuple[str, dict[str, Any]]], wall_seconds: float
+) -> dict[str, Any]:
+    """Per-stage percentiles and overall throughput for a finished run."""
+
+    def milliseconds(values: list[float]) -> dict[str, float | None]:
+        return {
+            f"p{percent}": (
+                round(value * 1000, 1)
+                if (value := percentile(values, percent)) is not None
+                else None
+            )
+            for percent in (50, 95, 99)
+        }
+
+    stages = {}
+    for stage in STAGES:
+        samples = [result for name, result in results if name == stage]
+        succeeded = [result for result in samples if not result["error"]]
+        chars = sum(result["chars"] for result in succeeded)
+        busy = sum(result["seconds"] for result in succeeded)
+        stages[stage] = {
+            "count": len(samples),
+            "errors": len(samples) - len(succeeded),
+            "latency_ms": milliseconds([result["seconds"] for result in succeeded]),
+            "ttft_ms": milliseconds(
+                [result["ttft"] for result in succeeded if result["ttft"] is not None]
+            ),
+            "chars_per_second": round(chars / busy, 1) if busy and chars else None,
+        }
+    total_chars = sum(result["chars"] for _, result in results if not result["error"])
+    return {
+        "wall_seconds": round(wall_seconds, 3),
+        "errors": sum(stage["errors"] for stage in stages.values()),
+        "chars_per_second": round(total_chars / wall_seconds, 1) if wall_seconds else None,
+        "stages": stages,
+    }
+
+
+def run_load(
+    sessions: int = 8,
+    continues: int = 1,
+    concurrency: int | None = None,
+    text_chars: int = 6_000,
+    writing_mode: str = "standard",
+    word_limit: int = 600,
+    ttft_seconds: float = 0.2,
+    tokens_per_second: float = 50,
+    error_rate: float = 0.0,
+    prose_chars: int = 600,
+    app_overrides: dict[str, Any] | None = None,
+    seed: int | None = None,
+) -> dict[str, Any]:
+    """Run ``sessions`` concurrent sessions against a fresh app and mock server."""
+    text = (SAMPLE_PARAGRAPH * (text_chars // len(SAMPLE_PARAGRAPH) + 1))[:text_chars]
+    server = MockLLMServer(
+        ttft_seconds=ttft_seconds,
+        tokens_per_second=tokens_per_second,
+        error_rate=error_rate,
+        prose_chars=prose_chars,
+        seed=seed,
+    ).start()
+    try:
+        with tempfile.TemporaryDirectory(prefix="novel-load-") as directory:
+            data_dir = Path(directory)
+            app = create_app(
+                config_overrides={
+                    # Long inputs go through chunked summarization too.
+                    "text_length_threshold": 2_000,
+                    "summary_chunk_chars": 2_000,
+                    **(app_overrides or {}),
+                },
+                config_path=write_mock_config(server.url, data_dir),
+            )
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency or sessions) as executor:
+                futures = [
+                    executor.submit(
+                        run_session, app, text, continues, writing_mode, word_limit
+                    )
+                    for _ in range(sessions)
+                ]
+                results = [item for future in futures for item in future.result()]
+            wall_seconds = time.perf_counter() - started
+            app.extensions["novel_service"].wait_idle(timeout=60)
+    finally:
+        server.stop()
+    return {
+        "sessions": sessions,
+        "continues": continues,
+        **summarize(results, wall_seconds),
+        "mock": dict(server.counters),
+    }
+
+
+def format_report(report: dict[str, Any]) -> str:
+    lines = [
+        f"会话 {report['sessions']}，每个会话继续续写 {report['continues']} 次，"
+        f"总耗时 {report['wall_seconds']} 秒，错误 {report['errors']} 个",
+        f"正文吞吐 {report['chars_per_second']} 字/秒；模拟服务收到 "
+        f"{report['mock']['requests']} 个请求，注入错误 {report['mock']['errors']} 个",
+        "",
+        f"{'阶段':<10}{'次数':>6}{'错误':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        f"{'首字 p50':>10}{'首字 p95':>10}{'首字 p99':>10}{'字/秒':>10}",
+    ]
+    for stage, stats in report["stages"].items():
+        latency, ttft = stats["latency_ms"], stats["ttft_ms"]
+        cells = [
+            latency["p50"], latency["p95"], latency["p99"],
+            ttft["p50"], ttft["p95"], ttft["p99"],
+            stats["chars_per_second"],
+        ]
+        lines.append(
+            f"{stage:<10}{stats['count']:>6}{stats['errors']:>6}"
+            + "".join(f"{'-' if cell is None else cell:>10}" for cell in cells)
+        )
+    return "\n".join(lines)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="针对模拟模型服务的端到端压测")
+    parser.add_argument("--sessions", type=int, default=8, help="并发会话数")
+    parser.add_argument("--continues", type=int, default=1, help="每个会话继续续写的次数")
+    parser.add_argument("--concurrency", type=int, default=None, help="同时运行的会话上限")
+    parser.add_argument("--text-chars", type=int, default=6_000, help="每个项目的原文字数")
+    parser.add_argument("--writing-mode", choices=("quick", "standard"), default="standard")
+    parser.add_argument("--word-limit", type=int, default=600)
+    parser.add_argument("--ttft", type=float, default=0.2, help="模拟首个片段的等待秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--prose-chars", type=int, default=600)
+    parser.add_argument("--json", action="store_true", help="输出 JSON 报告")
+    args = parser.parse_args(argv)
+    report = run_load(
+        sessions=args.sessions,
+        continues=args.continues,
+        concurrency=args.concurrency,
+        text_chars=args.text_chars,
+        writing_mode=args.writing_mode,
+        word_limit=args.word_limit,
+        ttft_seconds=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        prose_chars=args.prose_chars,
+    )
+    print(json.dumps(report, ensure_ascii=False, indent=2) if args.json else format_report(report))
+
+
+if __name__ == "__main__":
+    main()
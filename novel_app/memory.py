@@ -4,9 +4,15 @@ from __future__ import annotations
 
 import json
 import re
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 from typing import Any
 
+from .cache import SummaryCache, content_hash
 from .llm import AgentGateway
+from .retrieval import PassageIndex, join_passages
+from .splitting import iter_chunk_spans, next_chunk_start
+from .tokens import WIDE_TOKENS_PER_CHAR, BudgetSection, TokenEstimator, fit_sections
 
 
 MEMORY_KEYS = (
@@ -20,33 +26,31 @@ MEMORY_KEYS = (
 )
 
 
-def split_text(text: str, chunk_chars: int) -> list[str]:
-    """Split at paragraph boundaries where possible."""
+def split_text(text: str, chunk_chars: int, overlap: int = 0) -> list[str]:
+    """Split at paragraph, line or sentence boundaries where possible."""
     if len(text) <= chunk_chars:
         return [text]
-    paragraphs = re.split(r"(\n\s*\n)", text)
-    chunks: list[str] = []
-    current = ""
-    for paragraph in paragraphs:
-        if len(current) + len(paragraph) <= chunk_chars:
-            current += paragraph
-            continue
-        if current:
-            chunks.append(current)
-        while len(paragraph) > chunk_chars:
-            chunks.append(paragraph[:chunk_chars])
-            paragraph = paragraph[chunk_chars:]
-        current = paragraph
-    if current:
-        chunks.append(current)
-    return chunks
+    return [text[start:end] for start, end in iter_chunk_spans(text, chunk_chars, overlap)]
 
 
-def parse_memory(raw: str) -> dict[str, Any]:
+SCALAR_MEMORY_KEYS = ("overview", "current_scene", "style_profile")
+PATCH_OPERATIONS = ("set", "add", "update", "remove")
+
+
+class MemoryPatchError(ValueError):
+    """Raised when a model response is not a usable memory patch."""
+
+
+def _strip_fence(raw: str) -> str:
     cleaned = raw.strip()
     if cleaned.startswith("```"):
         cleaned = re.sub(r"^```(?:json)?\s*", "", cleaned)
         cleaned = re.sub(r"\s*```$", "", cleaned)
+    return cleaned
+
+
+def parse_memory(raw: str) -> dict[str, Any]:
+    cleaned = _strip_fence(raw)
     try:
         parsed = json.loads(cleaned)
     except json.JSONDecodeError:
@@ -54,18 +58,156 @@ def parse_memory(raw: str) -> dict[str, Any]:
     if not isinstance(parsed, dict):
         parsed = {"overview": str(parsed)}
     for key in MEMORY_KEYS:
-        parsed.setdefault(key, [] if key not in ("overview", "current_scene", "style_profile") else "")
+        parsed.setdefault(key, [] if key not in SCALAR_MEMORY_KEYS else "")
     return parsed
 
 
+def parse_memory_patch(raw: str) -> dict[str, Any]:
+    """Parse and validate a patch of the form ``{operation: {field: value}}``."""
+    try:
+        patch = json.loads(_strip_fence(raw))
+    except json.JSONDecodeError as exc:
+        raise MemoryPatchError("补丁不是合法 JSON") from exc
+    if not isinstance(patch, dict):
+        raise MemoryPatchError("补丁必须是 JSON 对象")
+    validate_memory_patch(patch)
+    return patch
+
+
+def validate_memory_patch(patch: dict[str, Any]) -> None:
+    """Check operations and fields; list fields only ever receive arrays."""
+    if any(operation not in PATCH_OPERATIONS for operation in patch):
+        raise MemoryPatchError("补丁包含未知操作")
+    for operation, fields in patch.items():
+        if not isinstance(fields, dict):
+            raise MemoryPatchError(f"{operation} 必须是对象")
+        for key, value in fields.items():
+            if key not in MEMORY_KEYS:
+                raise MemoryPatchError(f"未知记忆字段：{key}")
+            if key in SCALAR_MEMORY_KEYS:
+                if operation != "set":
+                    raise MemoryPatchError(f"{operation}.{key} 只能用 set 修改")
+            elif not isinstance(value, list):
+                raise MemoryPatchError(f"{operation}.{key} 必须是数组")
+
+
+def _identity(item: Any) -> str:
+    """The key list items are matched by: a name-like field, else the whole value."""
+    if isinstance(item, dict):
+        for field in ("name", "id", "title"):
+            if item.get(field):
+                return str(item[field])
+        return json.dumps(item, ensure_ascii=False, sort_keys=True)
+    return str(item)
+
+
+def _as_list(value: Any) -> list[Any]:
+    """A list field as a list: ``{name: details}`` maps become named items."""
+    if isinstance(value, list):
+        return value
+    if isinstance(value, dict):
+        return [
+            {"name": name, **details}
+            if isinstance(details, dict)
+            else {"name": name, "description": details}
+            for name, details in value.items()
+        ]
+    if value in (None, ""):
+        return []
+    return [value]
+
+
+def apply_memory_patch(
+    memory: dict[str, Any], patch: dict[str, Any]
+) -> dict[str, Any]:
+    """Return a copy of ``memory`` with set/add/update/remove operations applied.
+
+    ``update`` merges dict items with the existing item of the same name;
+    string items are updated with ``{"old": ..., "new": ...}`` pairs. List
+    fields the model stored in another shape are normalized to lists first.
+    """
+    validate_memory_patch(patch)
+    result = json.loads(json.dumps(memory, ensure_ascii=False))
+    for key in MEMORY_KEYS:
+        if key in SCALAR_MEMORY_KEYS:
+            result.setdefault(key, "")
+        else:
+            result[key] = _as_list(result.get(key))
+    for key, value in patch.get("set", {}).items():
+        result[key] = value
+    for key, items in patch.get("remove", {}).items():
+        removed = {_identity(item) for item in items}
+        result[key] = [item for item in result[key] if _identity(item) not in removed]
+    for key, items in patch.get("update", {}).items():
+        positions = {_identity(item): index for index, item in enumerate(result[key])}
+        for item in items:
+            if isinstance(item, dict) and "old" in item and "new" in item:
+                target, replacement = str(item["old"]), item["new"]
+            else:
+                target, replacement = _identity(item), item
+            if target not in positions:
+                result[key].append(replacement)
+                continue
+            index = positions[target]
+            current = result[key][index]
+            if isinstance(current, dict) and isinstance(replacement, dict):
+                result[key][index] = {**current, **replacement}
+            else:
+                result[key][index] = replacement
+    for key, items in patch.get("add", {}).items():
+        existing = {_identity(item) for item in result[key]}
+        for item in items:
+            if _identity(item) not in existing:
+                existing.add(_identity(item))
+                result[key].append(item)
+    return result
+
+
 class MemoryManager:
-    def __init__(self, gateway: AgentGateway, app_config: dict[str, Any]):
+    def __init__(
+        self,
+        gateway: AgentGateway,
+        app_config: dict[str, Any],
+        cache: SummaryCache | None = None,
+    ):
         self.gateway = gateway
+        self.cache = cache
         self.threshold = int(app_config["text_length_threshold"])
         self.chunk_chars = int(app_config["summary_chunk_chars"])
+        self.chunk_overlap = int(app_config.get("summary_chunk_overlap", 0))
         self.recent_chars = int(app_config["recent_context_chars"])
         self.context_budget = int(app_config["context_char_budget"])
         self.style_sample_chars = int(app_config["style_sample_chars"])
+        self.max_inflight_calls = dict(app_config.get("max_inflight_calls") or {})
+        self.merge_fan_in = max(2, int(app_config.get("summary_merge_fan_in", 8)))
+        self.retrieval_budget = int(app_config.get("retrieval_char_budget", 0))
+        self.retrieval_top_k = int(app_config.get("retrieval_top_k", 6))
+        self.passage_chars = int(app_config.get("retrieval_passage_chars", 400))
+        self.prompt_reserve_tokens = int(app_config.get("prompt_reserve_tokens", 2_000))
+        self.tokens = TokenEstimator(str(app_config.get("tokenizer", "") or ""))
+        self.update_mode = str(app_config.get("memory_update_mode", "patch"))
+
+    def _call_many(self, name: str, prompts: list[str]) -> list[str]:
+        """Run independent calls with bounded concurrency, keeping input order."""
+        limit = max(1, int(self.max_inflight_calls.get(name, 1)))
+        if limit == 1 or len(prompts) <= 1:
+            return [self.gateway.call(name, prompt) for prompt in prompts]
+        with ThreadPoolExecutor(
+            max_workers=min(limit, len(prompts)),
+            thread_name_prefix=f"{name}-map",
+        ) as executor:
+            # Each call runs in a copy of this context, so it is scheduled
+            # on behalf of the same owner.
+            futures = [
+                executor.submit(copy_context().run, self.gateway.call, name, prompt)
+                for prompt in prompts
+            ]
+            try:
+                return [future.result() for future in futures]
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
 
     @staticmethod
     def _summary_prompt(text: str, label: str) -> str:
@@ -81,23 +223,13 @@ style_profile（视角、语言、节奏、对话和描写特点）。
 {text}
 """.strip()
 
-    def build_memory(self, text: str) -> dict[str, Any]:
-        chunks = split_text(text, self.chunk_chars)
-        partials = [
-            self.gateway.call(
-                "summary_bot",
-                self._summary_prompt(chunk, f"第 {index + 1}/{len(chunks)} 个分块"),
-            )
-            for index, chunk in enumerate(chunks)
-        ]
-        if len(partials) == 1:
-            return parse_memory(partials[0])
-
+    @staticmethod
+    def _merge_prompt(partials: list[str]) -> str:
         merged_input = "\n\n".join(
             f"分块 {index + 1}：\n{partial}"
             for index, partial in enumerate(partials)
         )
-        merge_prompt = f"""
+        return f"""
 将以下分块记忆合并成一份全局小说记忆。只输出 JSON，字段为：
 {", ".join(MEMORY_KEYS)}。
 合并人物状态和时间线，保留仍未解决的伏笔；后出现的信息优先，
@@ -105,10 +237,207 @@ style_profile（视角、语言、节奏、对话和描写特点）。
 
 {merged_input}
 """.strip()
-        return parse_memory(self.gateway.call("summary_bot", merge_prompt))
+
+    def _reduce(
+        self, partials: list[str], known: dict[str, str] | None = None
+    ) -> tuple[str, dict[str, str]]:
+        """Merge partial memories level by level in groups of ``merge_fan_in``.
+
+        Merge nodes are keyed by the hash of their children, so nodes found in
+        ``known`` are reused and only groups whose inputs changed are merged
+        again. Returns the root and the nodes used by this tree.
+        """
+        known = known or {}
+        nodes: dict[str, str] = {}
+        level = list(partials)
+        while len(level) > 1:
+            groups = [
+                level[start:start + self.merge_fan_in]
+                for start in range(0, len(level), self.merge_fan_in)
+            ]
+            keys = [content_hash("\x1e".join(group)) for group in groups]
+            pending = [
+                index for index, group in enumerate(groups)
+                if len(group) > 1 and keys[index] not in known
+            ]
+            merged = dict(zip(
+                pending,
+                self._call_many(
+                    "summary_bot",
+                    [self._merge_prompt(groups[index]) for index in pending],
+                ),
+            ))
+            next_level: list[str] = []
+            for index, group in enumerate(groups):
+                if len(group) == 1:
+                    next_level.append(group[0])
+                    continue
+                result = merged[index] if index in merged else known[keys[index]]
+                nodes[keys[index]] = result
+                next_level.append(result)
+            level = next_level
+        return level[0], nodes
+
+    def _summarize_chunks(
+        self, chunks: list[str], known: dict[str, str] | None = None
+    ) -> list[str]:
+        """Summarize chunks, paying only for text the cache has never seen."""
+        hashes = [content_hash(chunk) for chunk in chunks]
+        cached = {key: known[key] for key in hashes if known and key in known}
+        if self.cache:
+            model = str(self.gateway.llm_config.get("summary_bot", {}).get("model", ""))
+            version = content_hash(
+                self._summary_prompt("", "")
+                + self.gateway.prompts.get("summary_instruction", "")
+            )[:16]
+            unknown = [key for key in hashes if key not in cached]
+            if unknown:
+                cached.update(self.cache.get_many(unknown, model, version))
+        seen: set[str] = set(cached)
+        missing: list[int] = []
+        for index, key in enumerate(hashes):
+            if key not in seen:
+                seen.add(key)
+                missing.append(index)
+        summaries = self._call_many(
+            "summary_bot",
+            [
+                self._summary_prompt(chunks[index], f"第 {index + 1}/{len(chunks)} 个分块")
+                for index in missing
+            ],
+        )
+        fresh = {hashes[index]: summary for index, summary in zip(missing, summaries)}
+        if self.cache:
+            self.cache.put_many(fresh, model, version)
+        return [cached[key] if key in cached else fresh[key] for key in hashes]
+
+    def build_memory(self, text: str) -> dict[str, Any]:
+        return self.build_memory_tree(text)[0]
+
+    def _tree_settings(self) -> dict[str, int]:
+        """The settings a memory tree was built with; any change invalidates it."""
+        return {
+            "chunk_chars": self.chunk_chars,
+            "chunk_overlap": self.chunk_overlap,
+            "merge_fan_in": self.merge_fan_in,
+        }
+
+    def _tree_matches_settings(self, tree: dict[str, Any] | None) -> bool:
+        return bool(tree) and all(
+            tree.get(key) == value for key, value in self._tree_settings().items()
+        )
+
+    def _reusable_leaves(
+        self, text: str, tree: dict[str, Any] | None
+    ) -> list[dict[str, Any]]:
+        """Return the leading leaves whose text is unchanged and whose end is settled."""
+        if not self._tree_matches_settings(tree):
+            return []
+        matched: list[dict[str, Any]] = []
+        for leaf in tree.get("leaves", []):
+            if leaf["end"] > len(text) or content_hash(
+                text[leaf["start"]:leaf["end"]]
+            ) != leaf["hash"]:
+                break
+            matched.append(leaf)
+        # The last matching leaf may grow or split differently once more text
+        # follows it, so its boundary is always recomputed.
+        return matched[:-1]
+
+    def tree_is_stale(self, text: str, tree: dict[str, Any]) -> bool:
+        """Whether ``text`` diverged from the tree, its tail outgrew one chunk
+        or the tree was built with other chunking settings."""
+        leaves = tree.get("leaves") or []
+        if not leaves or not self._tree_matches_settings(tree):
+            return True
+        last = leaves[-1]
+        if last["end"] > len(text):
+            return True
+        if content_hash(text[last["start"]:last["end"]]) != last["hash"]:
+            return True
+        return len(text) - last["start"] > self.chunk_chars
+
+    def build_memory_tree(
+        self, text: str, tree: dict[str, Any] | None = None
+    ) -> tuple[dict[str, Any], dict[str, Any]]:
+        """Build memory over ``text``, reusing unchanged chunks and merge nodes of ``tree``.
+
+        Only chunks after the first changed or unsettled leaf are summarized
+        again, and only merge nodes whose children changed are re-run.
+        """
+        leaves = self._reusable_leaves(text, tree)
+        start = (
+            next_chunk_start(text, leaves[-1]["end"], self.chunk_overlap, leaves[-1]["start"])
+            if leaves
+            else 0
+        )
+        spans = [(leaf["start"], leaf["end"]) for leaf in leaves]
+        spans.extend(iter_chunk_spans(text, self.chunk_chars, self.chunk_overlap, start))
+        if not spans:
+            spans.append((0, len(text)))
+        chunks = [text[begin:end] for begin, end in spans]
+        known = {leaf["hash"]: leaf["summary"] for leaf in (tree or {}).get("leaves", [])}
+        partials = self._summarize_chunks(chunks, known)
+        root, nodes = self._reduce(partials, (tree or {}).get("nodes"))
+        new_tree = {
+            **self._tree_settings(),
+            "leaves": [
+                {
+                    "start": begin,
+                    "end": end,
+                    "hash": content_hash(chunk),
+                    "summary": summary,
+                }
+                for (begin, end), chunk, summary in zip(spans, chunks, partials)
+            ],
+            "nodes": nodes,
+        }
+        return parse_memory(root), new_tree
 
     def update_memory(
         self, memory: dict[str, Any], new_segment: str
+    ) -> dict[str, Any]:
+        if self.update_mode == "patch":
+            raw = self.gateway.call("summary_bot", self._patch_prompt(memory, new_segment))
+            try:
+                return apply_memory_patch(memory, parse_memory_patch(raw))
+            except MemoryPatchError:
+                try:
+                    parsed = json.loads(_strip_fence(raw))
+                except json.JSONDecodeError:
+                    parsed = None
+                if isinstance(parsed, dict) and set(MEMORY_KEYS) <= set(parsed):
+                    # The model ignored the patch format and returned a full memory.
+                    return parse_memory(raw)
+            except Exception:
+                # Any other failure to apply still falls back to a full rewrite.
+                pass
+        return self._full_update(memory, new_segment)
+
+    @staticmethod
+    def _patch_prompt(memory: dict[str, Any], new_segment: str) -> str:
+        return f"""
+根据新生成的小说段落，为全局记忆输出 JSON 补丁，不要输出完整记忆。
+补丁只能包含以下操作，没有变化的操作和字段直接省略：
+set：替换 overview、current_scene、style_profile 等字段的新值；
+add：向 characters、world_rules、timeline、open_threads 追加新条目数组；
+update：修改已有条目，人物等对象按 name 匹配并只给出变化的字段，
+字符串条目写成 {{"old": "原条目", "new": "新条目"}}；
+remove：删除已失效的条目，例如已经解决的伏笔，写出原条目或其 name。
+示例：{{"set": {{"current_scene": "…"}}, "add": {{"timeline": ["…"]}},
+"update": {{"characters": [{{"name": "…", "status": "…"}}]}},
+"remove": {{"open_threads": ["…"]}}}}
+不要把写作计划或评论写入记忆。
+
+旧记忆：
+{json.dumps(memory, ensure_ascii=False)}
+
+新段落：
+{new_segment}
+""".strip()
+
+    def _full_update(
+        self, memory: dict[str, Any], new_segment: str
     ) -> dict[str, Any]:
         prompt = f"""
 根据新生成的小说段落增量更新全局记忆。只输出 JSON，字段为：
@@ -123,54 +452,141 @@ style_profile（视角、语言、节奏、对话和描写特点）。
 """.strip()
         return parse_memory(self.gateway.call("summary_bot", prompt))
 
+    def build_index(self, original_text: str) -> PassageIndex:
+        return PassageIndex.build(original_text, self.passage_chars)
+
+    @staticmethod
+    def _retrieval_query(memory: dict[str, Any] | None, latest_text: str) -> str:
+        """Describe the current scene and open threads as a retrieval query."""
+        parts = [latest_text[-500:]]
+        for key in ("current_scene", "open_threads"):
+            value = (memory or {}).get(key)
+            if value:
+                parts.append(
+                    value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+                )
+        return "\n".join(parts)
+
+    def token_budget(self, bot: str = "writing_bot") -> int:
+        """Context tokens ``bot`` can accept after its output and prompt overhead.
+
+        ``context_char_budget`` is read as Chinese prose and converted to
+        tokens; a configured ``context_window`` on the bot caps it further.
+        """
+        limits = [int(self.context_budget * WIDE_TOKENS_PER_CHAR)]
+        bot_config = getattr(self.gateway, "llm_config", {}).get(bot, {})
+        window = int(bot_config.get("context_window") or 0)
+        if window:
+            max_tokens = int((bot_config.get("generate_cfg") or {}).get("max_tokens") or 0)
+            limits.append(window - max_tokens - self.prompt_reserve_tokens)
+        return max(0, min(limits))
+
     def context_for(
         self,
         original_text: str,
         generated_segments: list[str],
         memory: dict[str, Any] | None,
+        index: PassageIndex | None = None,
+        bot: str = "writing_bot",
+        layout: str = "standard",
     ) -> str:
-        def clip_both(value: str, limit: int) -> str:
-            if len(value) <= limit:
-                return value
-            half = max(1, limit // 2)
-            return value[:half] + "\n…（中间内容已按预算省略）…\n" + value[-half:]
-
-        recent_generated = "\n\n".join(generated_segments)
-        memory_text = (
-            json.dumps(memory, ensure_ascii=False, separators=(",", ":"))
-            if memory
-            else ""
-        )
-        memory_budget = min(
-            len(memory_text),
-            max(4_000, self.context_budget // 3),
-        )
-        original_budget = min(
-            len(original_text),
-            max(self.style_sample_chars, self.context_budget // 3),
-        )
-        fixed_cost = memory_budget + original_budget + 500
-        generated_budget = max(
-            self.style_sample_chars,
-            self.context_budget - fixed_cost,
-        )
+        """Render the writing context within the bot's token budget.
+
+        The ``cache_friendly`` layout orders sections from most to least
+        stable across consecutive requests (original tail, accepted
+        segments, memory, retrieved passages) and pins the original tail to
+        a fixed share, so provider prefix caches can reuse the leading part.
+        """
+        cache_friendly = layout == "cache_friendly"
+        headers = {
+            "memory": "【全局结构化记忆】\n",
+            "original": "【原文结尾与风格样例，需直接衔接】\n",
+            "retrieval": "【与当前情节相关的原文片段】\n",
+            "generated": "【已经接受的近期续写内容】\n",
+        }
+        budget = self.token_budget(bot)
+        horizon = self.tokens.chars_for(budget)
+        third = budget // 3
+        style_tokens = int(self.style_sample_chars * WIDE_TOKENS_PER_CHAR)
+        original_tail = original_text[-horizon:]
+        if cache_friendly:
+            # Without leftover budget flowing to it, the original tail keeps
+            # the same start as the accepted segments grow.
+            original_tail = self.tokens.clip(original_tail, third)
+        sections = {
+            "memory": BudgetSection(
+                "memory",
+                json.dumps(memory, ensure_ascii=False, separators=(",", ":")) if memory else "",
+                priority=3,
+                minimum=third,
+                cap=third,
+                keep="both",
+            ),
+            "original": BudgetSection(
+                "original",
+                original_tail,
+                priority=1,
+                minimum=style_tokens,
+                cap=third,
+            ),
+            "generated": BudgetSection(
+                "generated",
+                "\n\n".join(generated_segments)[-horizon:],
+                priority=2,
+                minimum=style_tokens,
+            ),
+        }
 
-        sections: list[str] = []
-        if memory:
-            sections.append(
-                "【全局结构化记忆】\n"
-                + clip_both(memory_text, memory_budget)
+        def header_cost() -> int:
+            return sum(
+                self.tokens.count(headers[name] + "\n\n")
+                for name, section in sections.items()
+                if section.text or name == "original"
             )
-        original_tail = original_text[-original_budget:]
-        sections.append(
-            "【原文结尾与风格样例，需直接衔接】\n" + original_tail
+
+        retrieval_tokens = (
+            min(int(self.retrieval_budget * WIDE_TOKENS_PER_CHAR), budget // 4)
+            if index and self.retrieval_budget
+            else 0
         )
-        if recent_generated:
-            sections.append(
-                "【已经接受的近期续写内容】\n"
-                + recent_generated[-generated_budget:]
+        # The retrieval slice is reserved first, so passages are searched only
+        # in the part of the original text the tail does not already cover.
+        fitted = fit_sections(
+            list(sections.values()),
+            budget - retrieval_tokens - header_cost(),
+            self.tokens,
+        )
+        if retrieval_tokens:
+            spans = index.search(
+                self._retrieval_query(memory, fitted["generated"] or fitted["original"]),
+                self.retrieval_top_k,
+                before=len(original_text) - len(fitted["original"]),
+            )
+            passages = self.tokens.clip(
+                join_passages(
+                    original_text,
+                    spans,
+                    int(retrieval_tokens / WIDE_TOKENS_PER_CHAR),
+                ),
+                retrieval_tokens,
+                "head",
             )
-        return "\n\n".join(sections)
+            sections["original"].text = fitted["original"]
+            sections["retrieval"] = BudgetSection(
+                "retrieval", passages, priority=4, minimum=retrieval_tokens
+            )
+            fitted = fit_sections(list(sections.values()), budget - header_cost(), self.tokens)
+
+        order = (
+            ("original", "generated", "memory", "retrieval")
+            if cache_friendly
+            else ("memory", "original", "retrieval", "generated")
+        )
+        return "\n\n".join(
+            headers[name] + fitted[name]
+            for name in order
+            if name in fitted and (fitted[name] or name == "original")
+        )
 
     def consistency_report(
         self, memory: dict[str, Any] | None, segment: str
@@ -0,0 +1,232 @@
+"""Stage timing and model-call size metrics, exported in Prometheus text format."""
+
+from __future__ import annotations
+
+import math
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any
+
+from .tokens import approximate_tokens
+
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (100, 500, 1_000, 2_500, 5_000, 10_000, 25_000, 50_000, 100_000, 250_000)
+
+_current_stage: ContextVar[str] = ContextVar("novel_stage", default="other")
+_current_run: ContextVar["RunMetrics | None"] = ContextVar("novel_run", default=None)
+
+
+def current_stage() -> str:
+    """The pipeline stage that model calls in this context are attributed to."""
+    return _current_stage.get()
+
+
+def _label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Histogram:
+    """A labelled Prometheus histogram with fixed upper bounds."""
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_names: tuple[str, ...],
+        buckets: tuple[float, ...],
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = (*sorted(buckets), math.inf)
+        self._series: dict[tuple[str, ...], list[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        """Record ``value``; ``labels`` follow ``label_names``."""
+        with self._lock:
+            # Per-bucket counts followed by the sum and the total count.
+            series = self._series.setdefault(labels, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in sorted(self._series.items())}
+        for labels, values in series.items():
+            pairs = [
+                f'{name}="{_label_value(value)}"'
+                for name, value in zip(self.label_names, labels)
+            ]
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                bucket_labels = ",".join([*pairs, f'le="{_number(bound)}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            suffix = f"{{{','.join(pairs)}}}" if pairs else ""
+            lines.append(f"{self.name}_sum{suffix} {_number(round(values[-2], 6))}")
+            lines.append(f"{self.name}_count{suffix} {int(values[-1])}")
+        return lines
+
+
+class RunMetrics:
+    """Timings and model calls of one generation run, for its ``metrics`` event."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: dict[str, float] = {}
+        self.calls: list[dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_call(self, call: dict[str, Any]) -> None:
+        with self._lock:
+            self.calls.append(call)
+
+    def recorded_calls(self) -> list[dict[str, Any]]:
+        with self._lock:
+            return list(self.calls)
+
+    def summary(self) -> dict[str, Any]:
+        with self._lock:
+            calls = sorted(self.calls, key=lambda call: call["seconds"], reverse=True)
+            return {
+                "total_ms": round((time.perf_counter() - self.started) * 1000),
+                "stages_ms": {
+                    stage: round(seconds * 1000) for stage, seconds in self.stages.items()
+                },
+                "llm_calls": [
+                    {**call, "seconds": round(call["seconds"], 3)} for call in calls
+                ],
+                "slowest_call": calls[0]["stage"] if calls else None,
+            }
+
+
+class MetricsRegistry:
+    """Process-wide histograms for pipeline stages and model calls.
+
+    Stages are timed with ``stage``, which also attributes model calls made
+    inside it; the gateway reports each call through ``observe_call``.
+    """
+
+    def __init__(self):
+        call_labels = ("bot", "stage")
+        self.stage_seconds = Histogram(
+            "novel_stage_seconds", "Duration of generation pipeline stages.",
+            ("stage",), SECONDS_BUCKETS,
+        )
+        self.call_seconds = Histogram(
+            "novel_llm_call_seconds", "Duration of model calls.",
+            call_labels, SECONDS_BUCKETS,
+        )
+        self.first_chunk_seconds = Histogram(
+            "novel_llm_first_chunk_seconds", "Time from a model call to its first chunk.",
+            call_labels, SECONDS_BUCKETS,
+        )
+        self.prompt_chars = Histogram(
+            "novel_llm_prompt_chars", "Prompt size of model calls in characters.",
+            call_labels, SIZE_BUCKETS,
+        )
+        self.prompt_tokens = Histogram(
+            "novel_llm_prompt_tokens", "Estimated prompt tokens of model calls.",
+            call_labels, SIZE_BUCKETS,
+        )
+        self.response_chars = Histogram(
+            "novel_llm_response_chars", "Response size of model calls in characters.",
+            call_labels, SIZE_BUCKETS,
+        )
+        self.response_tokens = Histogram(
+            "novel_llm_response_tokens", "Estimated response tokens of model calls.",
+            call_labels, SIZE_BUCKETS,
+        )
+        self.histograms = [
+            self.stage_seconds,
+            self.call_seconds,
+            self.first_chunk_seconds,
+            self.prompt_chars,
+            self.prompt_tokens,
+            self.response_chars,
+            self.response_tokens,
+        ]
+
+    @staticmethod
+    def start_run() -> RunMetrics:
+        """Collect this context's stages and calls into a new ``RunMetrics``."""
+        run = RunMetrics()
+        _current_run.set(run)
+        return run
+
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        self.stage_seconds.observe(seconds, stage)
+        run = _current_run.get()
+        if run:
+            run.add_stage(stage, seconds)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a stage and attribute the model calls made inside it."""
+        previous = _current_stage.get()
+        # Restore with set() rather than a token: the block may end in
+        # another context when a suspended generator is closed.
+        _current_stage.set(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            _current_stage.set(previous)
+            self.observe_stage(name, time.perf_counter() - started)
+
+    def observe_call(
+        self,
+        bot: str,
+        prompt: str,
+        response: str,
+        seconds: float,
+        first_chunk: float | None,
+        system_tokens: int = 0,
+    ) -> None:
+        """Record one model call; ``system_tokens`` counts toward its prompt tokens."""
+        stage = current_stage()
+        labels = (bot, stage)
+        call = {
+            "bot": bot,
+            "stage": stage,
+            "seconds": seconds,
+            "prompt_chars": len(prompt),
+            "prompt_tokens": system_tokens + approximate_tokens(prompt),
+            "response_chars": len(response),
+            "response_tokens": approximate_tokens(response),
+        }
+        self.call_seconds.observe(seconds, *labels)
+        if first_chunk is not None:
+            self.first_chunk_seconds.observe(first_chunk, *labels)
+        self.prompt_chars.observe(call["prompt_chars"], *labels)
+        self.prompt_tokens.observe(call["prompt_tokens"], *labels)
+        self.response_chars.observe(call["response_chars"], *labels)
+        self.response_tokens.observe(call["response_tokens"], *labels)
+        run = _current_run.get()
+        if run:
+            run.add_call(call)
+
+    def render(self) -> str:
+        return "\n".join(
+            line for histogram in self.histograms for line in histogram.render()
+        ) + "\n"
@@ -0,0 +1,239 @@
+"""A local OpenAI-compatible chat server with canned outputs, for load tests.
+
+The server answers ``POST .../chat/completions`` with text chosen from the
+prompt (memory, memory patch, plan, consistency review or prose) and streams
+it with a configurable time to first token, token rate and error rate, so the
+whole HTTP and streaming path can be exercised without a real model::
+
+    python -m novel_app.mock_llm --port 8001 --ttft 0.3 --tokens-per-second 40
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+
+DEFAULT_OUTPUTS = {
+    "memory": json.dumps(
+        {
+            "overview": "旧宅里的失踪案逐渐牵出林家的旧事。",
+            "characters": [{"name": "林舟", "goal": "找到钥匙的来历"}],
+            "world_rules": ["夜间不能离开灯光"],
+            "timeline": ["林舟进入旧宅"],
+            "open_threads": ["钥匙的来源"],
+            "current_scene": "林舟站在门前",
+            "style_profile": "第三人称，简洁悬疑",
+        },
+        ensure_ascii=False,
+    ),
+    "patch": json.dumps(
+        {
+            "set": {"current_scene": "林舟推开了门"},
+            "add": {"timeline": ["林舟推开旧宅大门"]},
+        },
+        ensure_ascii=False,
+    ),
+    "plan": "承接门前场景，让主角在门后发现新的线索，并留下下一段的悬念。",
+    "review": "未发现明显一致性问题",
+    "prose": (
+        "林舟握紧钥匙，推开了门。门轴发出一声干涩的呻吟，灰尘在灯光里缓缓落下。"
+        "走廊尽头的座钟停在三点十七分，和信里写的时间分毫不差。他屏住呼吸，"
+        "听见楼上传来极轻的脚步声，像有人赤脚踩过木板。"
+    ),
+}
+
+# Prompt fragments that identify each kind of request, checked in order.
+PROMPT_MARKERS = (
+    ("review", "检查新续写"),
+    ("patch", "JSON 补丁"),
+    ("plan", "拟定一个简短"),
+    ("memory", "只输出 JSON"),
+)
+
+
+def classify(messages: list[dict[str, Any]]) -> str:
+    """Which canned output answers ``messages``."""
+    prompt = str(messages[-1].get("content", "")) if messages else ""
+    for kind, marker in PROMPT_MARKERS:
+        if marker in prompt:
+            return kind
+    return "prose"
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "MockLLMServer"
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def _send_json(self, status: int, payload: dict[str, Any]) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self) -> None:
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": "not found"})
+            return
+        mock = self.server
+        mock.count("requests")
+        if mock.should_fail():
+            mock.count("errors")
+            self._send_json(503, {"error": "mock overload"})
+            return
+        text = mock.output_for(request.get("messages") or [])
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        time.sleep(mock.ttft_seconds)
+        if not request.get("stream"):
+            time.sleep(len(mock.tokens(text)) / mock.tokens_per_second)
+            self._send_json(
+                200,
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "model": request.get("model", ""),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": text},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                },
+            )
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        started = time.monotonic()
+        for index, token in enumerate(mock.tokens(text)):
+            delay = started + index / mock.tokens_per_second - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            event = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {"content": token}}],
+            }
+            self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode())
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """A threaded mock model server; ``start`` serves in a daemon thread.
+
+    ``ttft_seconds`` delays the first delta, ``tokens_per_second`` paces the
+    rest (one token is ``chars_per_token`` characters), and ``error_rate`` is
+    the fraction of requests answered with HTTP 503. ``outputs`` overrides
+    entries of ``DEFAULT_OUTPUTS``; prose is repeated up to ``prose_chars``.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        ttft_seconds: float = 0.2,
+        tokens_per_second: float = 50,
+        error_rate: float = 0.0,
+        chars_per_token: int = 2,
+        prose_chars: int = 600,
+        outputs: dict[str, str] | None = None,
+        seed: int | None = None,
+    ):
+        super().__init__((host, port), _MockHandler)
+        self.ttft_seconds = max(0.0, float(ttft_seconds))
+        self.tokens_per_second = max(0.001, float(tokens_per_second))
+        self.error_rate = min(1.0, max(0.0, float(error_rate)))
+        self.chars_per_token = max(1, int(chars_per_token))
+        self.prose_chars = max(1, int(prose_chars))
+        self.outputs = {**DEFAULT_OUTPUTS, **(outputs or {})}
+        self.counters = {"requests": 0, "errors": 0}
+        self._random = random.Random(seed)
+        self._guard = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, name: str) -> None:
+        with self._guard:
+            self.counters[name] += 1
+
+    def should_fail(self) -> bool:
+        with self._guard:
+            return self._random.random() < self.error_rate
+
+    def output_for(self, messages: list[dict[str, Any]]) -> str:
+        kind = classify(messages)
+        text = self.outputs[kind]
+        if kind == "prose":
+            repeats = -(-self.prose_chars // len(text))
+            text = (text * repeats)[: self.prose_chars]
+        return text
+
+    def tokens(self, text: str) -> list[str]:
+        size = self.chars_per_token
+        return [text[start : start + size] for start in range(0, len(text), size)]
+
+    def start(self) -> "MockLLMServer":
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="mock-llm", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容模拟模型服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--ttft", type=float, default=0.2, help="首个片段前的等待秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 HTTP 503 的比例")
+    parser.add_argument("--prose-chars", type=int, default=600, help="正文输出的字数")
+    args = parser.parse_args(argv)
+    server = MockLLMServer(
+        args.host,
+        args.port,
+        ttft_seconds=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        prose_chars=args.prose_chars,
+    )
+    print(f"模拟模型服务：{server.url}（model_server 填写此地址，backend 设为 openai）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""Direct streaming client for OpenAI-compatible chat completion endpoints."""
+
+from __future__ import annotations
+
+import asyncio
+import http.client
+import json
+from collections.abc import AsyncIterator, Iterator
+from typing import Any
+from urllib.parse import urlsplit
+
+from .transport import AsyncConnection, TransportRegistry, transport_settings
+
+
+class ModelServerError(RuntimeError):
+    """A non-success HTTP status returned by the model server."""
+
+    def __init__(self, status: int, detail: str):
+        super().__init__(f"模型服务返回 HTTP {status}：{detail}")
+        self.status = status
+
+
+class SSEDecoder:
+    """Collect ``data`` lines of server-sent events, one line at a time."""
+
+    def __init__(self):
+        self._data: list[str] = []
+
+    def feed(self, raw: bytes) -> str | None:
+        """Consume a line; return the event's data when the line ends it."""
+        line = raw.decode("utf-8").rstrip("\r\n")
+        if not line:
+            return self.flush()
+        if line.startswith("data:"):
+            self._data.append(line[5:].lstrip(" "))
+        return None
+
+    def flush(self) -> str | None:
+        data, self._data = self._data, []
+        return "\n".join(data) if data else None
+
+
+def iter_sse_data(lines: Iterator[bytes]) -> Iterator[str]:
+    """Yield the ``data`` payload of each server-sent event."""
+    decoder = SSEDecoder()
+    for raw in lines:
+        data = decoder.feed(raw)
+        if data is not None:
+            yield data
+    data = decoder.flush()
+    if data is not None:
+        yield data
+
+
+def event_deltas(data: str) -> list[str]:
+    """The text deltas carried by one chat completion stream event."""
+    event = json.loads(data)
+    if event.get("error"):
+        raise RuntimeError(f"模型服务返回错误：{event['error']}")
+    return [
+        content
+        for choice in event.get("choices") or ()
+        if (content := (choice.get("delta") or {}).get("content"))
+    ]
+
+
+async def _read_body_lines(
+    reader: asyncio.StreamReader, headers: dict[str, str]
+) -> AsyncIterator[bytes]:
+    """Yield body lines of a chunked, sized or close-delimited response.
+
+    Framed bodies are read exactly to their end, so a keep-alive connection
+    is left at the start of the next response.
+    """
+    pending = b""
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+            if not size:
+                # Skip any trailers up to the blank line ending the message.
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            pending += await reader.readexactly(size)
+            await reader.readline()
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                yield line + b"\n"
+    else:
+        remaining = int(headers["content-length"]) if "content-length" in headers else None
+        while remaining is None or remaining > 0:
+            data = await reader.read(65_536 if remaining is None else min(remaining, 65_536))
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            pending += data
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                yield line + b"\n"
+    if pending:
+        yield pending
+
+
+class OpenAIChatClient:
+    """Stream ``/chat/completions`` deltas without accumulating the response.
+
+    Each delta is forwarded as the server sent it, so streaming a long
+    chapter costs time linear in its length. Connections come from the
+    endpoint's shared keep-alive pool.
+    """
+
+    def __init__(
+        self,
+        bot_config: dict[str, Any],
+        system_message: str,
+        transports: TransportRegistry,
+    ):
+        server = urlsplit(str(bot_config["model_server"]).rstrip("/"))
+        if server.scheme not in ("http", "https") or not server.hostname:
+            raise RuntimeError(f"无效的 model_server：{bot_config['model_server']}")
+        self.scheme = server.scheme
+        self.host = server.hostname
+        self.port = server.port or (443 if server.scheme == "https" else 80)
+        self.path = f"{server.path}/chat/completions"
+        self.model = bot_config["model"]
+        self.api_key = bot_config["api_key"]
+        self.generate_cfg = dict(bot_config.get("generate_cfg") or {})
+        self.system_message = system_message
+        self.pool = transports.pool(
+            server.scheme, server.hostname, server.port, transport_settings(bot_config)
+        )
+
+    def _body(self, messages: list[dict[str, Any]]) -> bytes:
+        payload = {
+            **self.generate_cfg,
+            "model": self.model,
+            "messages": [{"role": "system", "content": self.system_message}, *messages]
+            if self.system_message
+            else messages,
+            "stream": True,
+        }
+        return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+    def _headers(self) -> dict[str, str]:
+        return {
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream",
+            "Authorization": f"Bearer {self.api_key}",
+        }
+
+    def _send(
+        self, connection: http.client.HTTPConnection, body: bytes
+    ) -> http.client.HTTPResponse:
+        headers = self._headers()
+        if not self.pool.keep_alive:
+            headers["Connection"] = "close"
+        connection.request("POST", self.path, body=body, headers=headers)
+        return connection.getresponse()
+
+    def stream_deltas(self, messages: list[dict[str, Any]]) -> Iterator[str]:
+        body = self._body(messages)
+        connection, reused = self.pool.acquire()
+        reusable = False
+        try:
+            try:
+                response = self._send(connection, body)
+            except (ConnectionError, http.client.BadStatusLine):
+                if not reused:
+                    raise
+                # The server closed the idle keep-alive connection; retry
+                # once on a newly opened one.
+                self.pool.release(connection, False)
+                connection = None
+                connection, reused = self.pool.acquire(fresh=True)
+                response = self._send(connection, body)
+            if response.status != 200:
+                detail = response.read(500).decode("utf-8", "replace")
+                raise ModelServerError(response.status, detail)
+            for data in iter_sse_data(iter(response.readline, b"")):
+                if data == "[DONE]":
+                    break
+                yield from event_deltas(data)
+            # Drain the rest of the body so the connection can carry the
+            # next request.
+            response.read()
+            reusable = not response.will_close
+        finally:
+            if connection is not None:
+                self.pool.release(connection, reusable)
+
+    def _host_header(self) -> str:
+        host = f"[{self.host}]" if ":" in self.host else self.host
+        default_port = 443 if self.scheme == "https" else 80
+        return host if self.port == default_port else f"{host}:{self.port}"
+
+    async def _asend(
+        self, connection: AsyncConnection, request: bytes
+    ) -> tuple[bytes, int, dict[str, str]]:
+        """Write a request and read the response's version, status and headers."""
+        connection.writer.write(request)
+        await connection.writer.drain()
+        reader = connection.reader
+        status_line = await asyncio.wait_for(reader.readline(), self.pool.read_timeout)
+        parts = status_line.split(None, 2)
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise http.client.BadStatusLine(status_line.decode("latin-1", "replace"))
+        headers: dict[str, str] = {}
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        return parts[0], int(parts[1]), headers
+
+    async def astream_deltas(self, messages: list[dict[str, Any]]) -> AsyncIterator[str]:
+        """Stream deltas on the running event loop over the endpoint's keep-alive pool."""
+        body = self._body(messages)
+        request_headers = {
+            **self._headers(),
+            "Host": self._host_header(),
+            "Content-Length": str(len(body)),
+        }
+        if not self.pool.keep_alive:
+            request_headers["Connection"] = "close"
+        request = (
+            f"POST {self.path} HTTP/1.1\r\n".encode("latin-1")
+            + "".join(f"{key}: {value}\r\n" for key, value in request_headers.items()).encode(
+                "latin-1"
+            )
+            + b"\r\n"
+            + body
+        )
+        connection, reused = await self.pool.aacquire()
+        reusable = False
+        try:
+            try:
+                version, status, headers = await self._asend(connection, request)
+            except (ConnectionError, asyncio.IncompleteReadError, http.client.BadStatusLine):
+                if not reused:
+                    raise
+                # The server closed the idle keep-alive connection; retry
+                # once on a newly opened one.
+                self.pool.arelease(connection, False)
+                connection = None
+                connection, reused = await self.pool.aacquire(fresh=True)
+                version, status, headers = await self._asend(connection, request)
+            lines = _read_body_lines(connection.reader, headers)
+            if status != 200:
+                detail = b"".join([line async for line in lines])[:500]
+                raise ModelServerError(status, detail.decode("utf-8", "replace"))
+            decoder = SSEDecoder()
+            while True:
+                try:
+                    raw = await asyncio.wait_for(lines.__anext__(), self.pool.read_timeout)
+                except StopAsyncIteration:
+                    break
+                data = decoder.feed(raw)
+                if data is None:
+                    continue
+                if data == "[DONE]":
+                    break
+                for content in event_deltas(data):
+                    yield content
+
+            async def drain() -> None:
+                async for _ in lines:
+                    pass
+
+            # Read the rest of the body so the connection can carry the
+            # next request.
+            await asyncio.wait_for(drain(), self.pool.read_timeout)
+            reusable = (
+                version == b"HTTP/1.1"
+                and headers.get("connection", "").lower() != "close"
+                and (
+                    "content-length" in headers
+                    or "chunked" in headers.get("transfer-encoding", "").lower()
+                )
+            )
+        finally:
+            if connection is not None:
+                self.pool.arelease(connection, reusable)
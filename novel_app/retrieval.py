@@ -0,0 +1,192 @@
+"""Local BM25 retrieval over passages of the original text."""
+
+from __future__ import annotations
+
+import math
+import re
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from collections.abc import Iterable
+
+from .splitting import iter_chunk_spans
+
+
+_TERM_RUN = re.compile(r"\w+")
+
+# Stored indexes: a header, then little-endian uint32 arrays of span bounds,
+# passage lengths, posting offsets and postings, then the vocabulary.
+_MAGIC = b"NPI2"
+_HEADER = struct.Struct("<4sIIII")
+_ITEM = "I" if array("I").itemsize == 4 else "L"
+
+
+def _little_endian(values: array) -> array:
+    """Swap ``values`` in place between native and stored byte order."""
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def terms(text: str) -> list[str]:
+    """Character bigrams of word runs, which suit unsegmented Chinese text."""
+    result: list[str] = []
+    for run in _TERM_RUN.findall(text.lower()):
+        if len(run) == 1:
+            result.append(run)
+        else:
+            result.extend(run[index:index + 2] for index in range(len(run) - 1))
+    return result
+
+
+def passage_spans(text: str, passage_chars: int) -> list[tuple[int, int]]:
+    """Passages of roughly ``passage_chars`` ending at line or sentence boundaries."""
+    return [
+        (start, end)
+        for start, end in iter_chunk_spans(text, passage_chars)
+        if text[start:end].strip()
+    ]
+
+
+class PassageIndex:
+    """An inverted index of character bigrams scored with Okapi BM25.
+
+    Terms are kept sorted with their postings concatenated into one flat
+    array, so a stored index loads with a few bulk array copies rather than
+    by rebuilding a dictionary of every term.
+    """
+
+    def __init__(
+        self,
+        spans: list[tuple[int, int]],
+        lengths: array,
+        vocabulary: list[str],
+        offsets: array,
+        postings: array,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        self.spans = spans
+        self.lengths = lengths
+        # ``vocabulary[i]`` owns ``postings[offsets[i]:offsets[i + 1]]``,
+        # flattened as [passage, tf, passage, tf, ...].
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.postings = postings
+        self.k1 = k1
+        self.b = b
+        self.average_length = (sum(lengths) / len(lengths)) if lengths else 0.0
+
+    @classmethod
+    def build(cls, text: str, passage_chars: int = 400) -> "PassageIndex":
+        spans = passage_spans(text, passage_chars)
+        lengths = array(_ITEM)
+        by_term: dict[str, list[int]] = {}
+        for passage, (start, end) in enumerate(spans):
+            counts = Counter(terms(text[start:end]))
+            lengths.append(sum(counts.values()))
+            for term, frequency in counts.items():
+                by_term.setdefault(term, []).extend((passage, frequency))
+        vocabulary = sorted(by_term)
+        offsets = array(_ITEM, [0])
+        postings = array(_ITEM)
+        for term in vocabulary:
+            postings.extend(by_term[term])
+            offsets.append(len(postings))
+        return cls(spans, lengths, vocabulary, offsets, postings)
+
+    def _posting(self, term: str) -> array | None:
+        position = bisect_left(self.vocabulary, term)
+        if position == len(self.vocabulary) or self.vocabulary[position] != term:
+            return None
+        return self.postings[self.offsets[position]:self.offsets[position + 1]]
+
+    def search(
+        self,
+        query: str,
+        top_k: int,
+        before: int | None = None,
+    ) -> list[tuple[int, int]]:
+        """Return spans of the best passages, optionally only those ending before ``before``."""
+        if not self.spans or top_k <= 0:
+            return []
+        total = len(self.spans)
+        scores: dict[int, float] = {}
+        for term in set(terms(query)):
+            posting = self._posting(term)
+            if not posting:
+                continue
+            frequency_count = len(posting) // 2
+            idf = math.log(1 + (total - frequency_count + 0.5) / (frequency_count + 0.5))
+            for offset in range(0, len(posting), 2):
+                passage, frequency = posting[offset], posting[offset + 1]
+                if before is not None and self.spans[passage][1] > before:
+                    continue
+                norm = self.k1 * (
+                    1 - self.b + self.b * self.lengths[passage] / (self.average_length or 1)
+                )
+                scores[passage] = scores.get(passage, 0.0) + idf * (
+                    frequency * (self.k1 + 1) / (frequency + norm)
+                )
+        best = sorted(scores, key=lambda passage: (-scores[passage], passage))[:top_k]
+        return [self.spans[passage] for passage in best]
+
+    def to_bytes(self) -> bytes:
+        flat_spans = array(_ITEM, (bound for span in self.spans for bound in span))
+        vocabulary = "\n".join(self.vocabulary).encode("utf-8")
+        header = _HEADER.pack(
+            _MAGIC, len(self.spans), len(self.vocabulary), len(self.postings), len(vocabulary)
+        )
+        body = b"".join(
+            _little_endian(array(_ITEM, values)).tobytes()
+            for values in (flat_spans, self.lengths, self.offsets, self.postings)
+        )
+        return zlib.compress(header + body + vocabulary)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "PassageIndex":
+        """Load ``to_bytes`` output; raises ValueError for other formats."""
+        try:
+            raw = zlib.decompress(data)
+        except zlib.error as exc:
+            raise ValueError("不是检索索引数据") from exc
+        if len(raw) < _HEADER.size or raw[:len(_MAGIC)] != _MAGIC:
+            raise ValueError("检索索引格式已过期")
+        _, passages, term_count, posting_count, vocabulary_bytes = _HEADER.unpack_from(raw)
+        position = _HEADER.size
+
+        def take(count: int) -> array:
+            nonlocal position
+            values = array(_ITEM)
+            values.frombytes(raw[position:position + count * values.itemsize])
+            position += count * values.itemsize
+            return _little_endian(values)
+
+        flat_spans = take(passages * 2)
+        lengths = take(passages)
+        offsets = take(term_count + 1)
+        postings = take(posting_count)
+        vocabulary = raw[position:position + vocabulary_bytes].decode("utf-8")
+        return cls(
+            list(zip(flat_spans[::2], flat_spans[1::2])),
+            lengths,
+            vocabulary.split("\n") if term_count else [],
+            offsets,
+            postings,
+        )
+
+
+def join_passages(text: str, spans: Iterable[tuple[int, int]], budget: int) -> str:
+    """Render retrieved passages in reading order within ``budget`` characters."""
+    selected: list[tuple[int, int]] = []
+    used = 0
+    for start, end in spans:
+        end = min(end, start + budget - used)
+        if end <= start:
+            break
+        selected.append((start, end))
+        used += end - start
+    return "\n…\n".join(text[start:end].strip() for start, end in sorted(selected))
@@ -0,0 +1,289 @@
+"""Admission control for model calls: concurrency caps, rate limits and fairness."""
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+import threading
+import time
+from collections import Counter
+from collections.abc import Callable
+from contextvars import ContextVar, copy_context
+from typing import Any, TypeVar
+
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+T = TypeVar("T")
+
+_current_request: ContextVar[tuple[str, int]] = ContextVar(
+    "novel_request", default=("", BACKGROUND)
+)
+
+
+def current_request() -> tuple[str, int]:
+    """The ``(owner_token, priority)`` that model calls in this context run as."""
+    return _current_request.get()
+
+
+def run_as(owner_token: str, priority: int, function: Callable[..., T], *args: Any) -> T:
+    """Call ``function`` in a copy of the current context tagged with the request."""
+
+    def tagged() -> T:
+        _current_request.set((owner_token, priority))
+        return function(*args)
+
+    return copy_context().run(tagged)
+
+
+class TokenBucket:
+    """Allow ``per_minute`` units per minute, with up to a minute's worth in a burst."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, cost: float, now: float) -> float:
+        """Seconds until ``cost`` units are available."""
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        missing = min(cost, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, cost: float) -> None:
+        if self.capacity:
+            self.level -= min(cost, self.capacity)
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class Ticket:
+    """A queued model call; it may run once ``wait`` returns True."""
+
+    def __init__(
+        self,
+        scheduler: "RequestScheduler",
+        bot: str,
+        owner_token: str,
+        priority: int,
+        cost: int,
+        sequence: int,
+    ):
+        self.scheduler = scheduler
+        self.bot = bot
+        self.owner_token = owner_token
+        self.priority = priority
+        self.cost = cost
+        self.sequence = sequence
+        self.granted = False
+        self.released = False
+        # Event-loop waiters, woken by the scheduler on grant or release.
+        self._async_waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self.scheduler._wait(self, timeout)
+
+    async def wait_async(self, timeout: float | None = None) -> bool:
+        """Wait for the grant without holding a thread or polling the scheduler."""
+        return await self.scheduler._wait_async(self, timeout)
+
+    def _wake(self) -> None:
+        """Resolve the event-loop waiters; called with the scheduler lock held."""
+        for loop, future in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+            except RuntimeError:
+                # The waiter's loop is closed.
+                pass
+        self._async_waiters.clear()
+
+    def position(self) -> int:
+        """How many queued calls will be considered before this one."""
+        return self.scheduler._position(self)
+
+    def release(self) -> None:
+        self.scheduler._release(self)
+
+
+class RequestScheduler:
+    """One queue in front of every model call.
+
+    Waiting calls are ordered by priority (interactive before background),
+    then by how many calls their owner already has running, then round-robin
+    across owners, then by arrival, so a single user's bulk summarization
+    cannot starve other users. A call starts only while its bot is under
+    ``max_concurrent``, its request and token buckets allow it, and the
+    scheduler as a whole is under its own ``max_concurrent``. A limit of 0
+    means unlimited.
+    """
+
+    def __init__(self, settings: dict[str, Any]):
+        self.max_concurrent = int(settings.get("max_concurrent") or 0)
+        self.bot_limits: dict[str, int] = {}
+        self.buckets: dict[str, tuple[TokenBucket, TokenBucket]] = {}
+        for bot, limits in (settings.get("bots") or {}).items():
+            self.bot_limits[bot] = int(limits.get("max_concurrent") or 0)
+            self.buckets[bot] = (
+                TokenBucket(float(limits.get("requests_per_minute") or 0)),
+                TokenBucket(float(limits.get("tokens_per_minute") or 0)),
+            )
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self._waiting: list[Ticket] = []
+        self._running = 0
+        self._running_by_bot: Counter[str] = Counter()
+        self._running_by_owner: Counter[str] = Counter()
+        # Grant number of each owner's latest call, for round-robin order.
+        self._last_granted: dict[str, int] = {}
+        self._retry_at: float | None = None
+        self.counters = {"granted": 0, "queued": 0, "cancelled": 0}
+
+    def enqueue(self, bot: str, owner_token: str, priority: int, cost: int = 0) -> Ticket:
+        with self._condition:
+            ticket = Ticket(self, bot, owner_token, priority, cost, next(self._sequence))
+            self._waiting.append(ticket)
+            self._dispatch()
+            if not ticket.granted:
+                self.counters["queued"] += 1
+            return ticket
+
+    def _order(self, ticket: Ticket) -> tuple[int, int, int, int]:
+        return (
+            ticket.priority,
+            self._running_by_owner[ticket.owner_token],
+            self._last_granted.get(ticket.owner_token, -1),
+            ticket.sequence,
+        )
+
+    def _dispatch(self) -> None:
+        """Grant every waiting call that the limits currently allow."""
+        now = time.monotonic()
+        self._retry_at = None
+        granted = False
+        for ticket in sorted(self._waiting, key=self._order):
+            if self.max_concurrent and self._running >= self.max_concurrent:
+                break
+            limit = self.bot_limits.get(ticket.bot, 0)
+            if limit and self._running_by_bot[ticket.bot] >= limit:
+                continue
+            buckets = self.buckets.get(ticket.bot)
+            if buckets:
+                delay = max(buckets[0].delay(1, now), buckets[1].delay(ticket.cost, now))
+                if delay > 0:
+                    retry_at = now + delay
+                    self._retry_at = min(self._retry_at or retry_at, retry_at)
+                    continue
+                buckets[0].take(1)
+                buckets[1].take(ticket.cost)
+            self._waiting.remove(ticket)
+            ticket.granted = True
+            self._running += 1
+            self._running_by_bot[ticket.bot] += 1
+            self._running_by_owner[ticket.owner_token] += 1
+            self._last_granted[ticket.owner_token] = self.counters["granted"]
+            self.counters["granted"] += 1
+            ticket._wake()
+            granted = True
+        if granted:
+            self._condition.notify_all()
+
+    def _wait(self, ticket: Ticket, timeout: float | None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                if ticket.granted:
+                    return True
+                if ticket.released:
+                    return False
+                self._dispatch()
+                if ticket.granted:
+                    return True
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    return False
+                waits = [
+                    moment - now
+                    for moment in (deadline, self._retry_at)
+                    if moment is not None
+                ]
+                self._condition.wait(max(0.0, min(waits)) if waits else None)
+
+    async def _wait_async(self, ticket: Ticket, timeout: float | None) -> bool:
+        """``_wait`` for the event loop: sleep on a future the scheduler resolves.
+
+        The future is resolved when the ticket is granted or released; the
+        waiter also wakes by itself when a rate limit may have refilled.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._condition:
+                if ticket.granted:
+                    return True
+                if ticket.released:
+                    return False
+                self._dispatch()
+                if ticket.granted:
+                    return True
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    return False
+                waits = [
+                    moment - now
+                    for moment in (deadline, self._retry_at)
+                    if moment is not None
+                ]
+                waiter = loop.create_future()
+                ticket._async_waiters.append((loop, waiter))
+            try:
+                await asyncio.wait_for(waiter, max(0.0, min(waits)) if waits else None)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._condition:
+                    if (loop, waiter) in ticket._async_waiters:
+                        ticket._async_waiters.remove((loop, waiter))
+
+    def _position(self, ticket: Ticket) -> int:
+        with self._condition:
+            if ticket.granted or ticket not in self._waiting:
+                return 0
+            key = self._order(ticket)
+            return sum(1 for other in self._waiting if self._order(other) < key)
+
+    def _release(self, ticket: Ticket) -> None:
+        with self._condition:
+            if ticket.released:
+                return
+            ticket.released = True
+            ticket._wake()
+            if ticket.granted:
+                self._running -= 1
+                self._running_by_bot[ticket.bot] -= 1
+                self._running_by_owner[ticket.owner_token] -= 1
+            else:
+                self._waiting.remove(ticket)
+                self.counters["cancelled"] += 1
+            self._dispatch()
+            self._condition.notify_all()
+
+    def stats(self) -> dict[str, Any]:
+        with self._condition:
+            return {
+                "running": self._running,
+                "waiting": len(self._waiting),
+                "running_by_bot": dict(+self._running_by_bot),
+                "waiting_by_bot": dict(Counter(ticket.bot for ticket in self._waiting)),
+                **self.counters,
+            }
@@ -2,13 +2,77 @@
 
 from __future__ import annotations
 
+import asyncio
 import json
-from collections.abc import Iterator
+import math
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Callable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import aclosing
+from contextvars import copy_context
 from typing import Any
 
+from .aio import EventLoopThread
+from .cache import content_hash
 from .database import NovelDatabase
 from .llm import AgentGateway
 from .memory import MemoryManager
+from .metrics import MetricsRegistry, RunMetrics
+from .retrieval import PassageIndex
+from .scheduler import BACKGROUND, INTERACTIVE, Ticket, run_as
+from .tokens import WIDE_TOKENS_PER_CHAR, approximate_tokens
+
+
+# Seconds between queue-position updates sent to a waiting stream.
+QUEUE_STATUS_INTERVAL = 1.0
+
+# How long a restore waits for the project's background work to finish.
+RESTORE_WAIT_SECONDS = 5.0
+
+# Planning asks for a short plan; this is what the pre-flight estimate assumes.
+PLAN_COMPLETION_TOKENS = 300
+
+# Projects whose last writing prompt is kept for prefix statistics.
+PREFIX_TRACKED_PROJECTS = 256
+
+# Stages that run after a generation is saved, charged to that generation.
+BACKGROUND_STAGES = frozenset({"consistency", "memory_update"})
+
+# Stages charged to the project as a whole, even when a generation ran them.
+PROJECT_STAGES = frozenset({"memory_build"})
+
+# Leads every cache-friendly prompt so the plan and writing calls share the
+# whole context as a prefix.
+CACHE_FRIENDLY_PREAMBLE = "以下是小说续写所需的材料，按从稳定到易变的顺序排列，本次任务说明位于末尾。"
+
+
+class PlanSpeculation:
+    """A plan computed in the background for the segment after ``key``'s generations.
+
+    ``key`` holds the active generation ids, requirements and word limit the
+    plan is made for; ``result`` resolves to the planning prompt's hash and
+    the plan, both empty when the job gave up or was cancelled.
+    """
+
+    def __init__(self, key: tuple[tuple[str, ...], str, int]):
+        self.key = key
+        self.cancelled = False
+        self.result: Future = Future()
+
+
+def shared_prefix_length(first: str, second: str) -> int:
+    """Length of the common prefix of two strings, compared in C-level slices."""
+    low, high = 0, min(len(first), len(second))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first[:middle] == second[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
 
 
 class NovelService:
@@ -17,10 +81,391 @@ class NovelService:
         database: NovelDatabase,
         gateway: AgentGateway,
         memory: MemoryManager,
+        background_workers: int = 2,
+        speculative_planning: bool = False,
+        prompt_layout: str = "standard",
+        metrics_event: bool = False,
+        max_project_tokens: int = 0,
+        blocking_workers: int = 64,
     ):
         self.database = database
         self.gateway = gateway
         self.memory = memory
+        self.metrics: MetricsRegistry = gateway.metrics
+        self.metrics_event = metrics_event
+        self.max_project_tokens = max_project_tokens
+        self.speculative_planning = speculative_planning
+        self.prompt_layout = prompt_layout
+        self._executor = (
+            ThreadPoolExecutor(
+                max_workers=background_workers,
+                thread_name_prefix="novel-background",
+            )
+            if background_workers > 0
+            else None
+        )
+        # Reviews run beside memory refreshes; they get their own threads so
+        # a busy background pool cannot hold a refresh waiting on its review.
+        # Every streaming generation runs on this loop.
+        self._loop = EventLoopThread(workers=blocking_workers)
+        self._review_executor = ThreadPoolExecutor(
+            max_workers=max(1, background_workers),
+            thread_name_prefix="novel-review",
+        )
+        self._jobs: dict[str, tuple[Future, str]] = {}
+        self._jobs_guard = threading.Lock()
+        self._indexes: OrderedDict[str, PassageIndex] = OrderedDict()
+        self._indexes_guard = threading.Lock()
+        # Plans computed ahead of the next continue, one per project. They
+        # run outside the job chain, so only ``_detached`` tracks them.
+        self._plans: dict[str, PlanSpeculation] = {}
+        self._plans_guard = threading.Lock()
+        self._detached: set[Future] = set()
+        # The last writing prompt and prefix-sharing totals of the most
+        # recently active projects.
+        self._prefixes: OrderedDict[str, tuple[str, dict[str, int]]] = OrderedDict()
+        self._prefixes_guard = threading.Lock()
+
+    def _submit(
+        self,
+        project_id: str,
+        owner_token: str,
+        job: Callable[[], None],
+        status: str,
+        generation_id: str = "",
+    ) -> None:
+        """Queue project work after any job already pending for the project.
+
+        ``status`` is shown to a stream that has to wait for the job. Model
+        calls made by the job are scheduled as the owner's background work
+        and their token usage is charged to ``generation_id``.
+        """
+        if not self._executor:
+            run_as(owner_token, BACKGROUND, self._accounted, project_id, generation_id, job)
+            return
+        with self._jobs_guard:
+            future = self._after_pending(project_id, owner_token, job, generation_id)
+            self._jobs[project_id] = (future, status)
+        future.add_done_callback(lambda done: self._forget(project_id, done))
+
+    def _after_pending(
+        self,
+        project_id: str,
+        owner_token: str,
+        job: Callable[[], None],
+        generation_id: str,
+    ) -> Future:
+        """Start ``job`` on the background pool once the pending project job is done.
+
+        Must be called with ``_jobs_guard`` held.
+        """
+        previous = self._jobs.get(project_id)
+
+        def run() -> None:
+            if previous:
+                previous[0].exception()
+            run_as(owner_token, BACKGROUND, self._accounted, project_id, generation_id, job)
+
+        return self._executor.submit(run)
+
+    def _submit_speculation(
+        self, project_id: str, owner_token: str, speculation: PlanSpeculation
+    ) -> None:
+        """Plan the next segment after the pending memory refresh, outside the job chain.
+
+        Streams do not wait for the speculation and later jobs are not
+        ordered after it; a stream whose inputs differ cancels it instead.
+        """
+        with self._plans_guard:
+            replaced = self._plans.get(project_id)
+            if replaced:
+                replaced.cancelled = True
+            self._plans[project_id] = speculation
+
+        def job() -> None:
+            self._speculate_plan(project_id, owner_token, speculation)
+
+        if not self._executor:
+            run_as(owner_token, BACKGROUND, self._accounted, project_id, "", job)
+            return
+        with self._jobs_guard:
+            future = self._after_pending(project_id, owner_token, job, "")
+            self._detached.add(future)
+        future.add_done_callback(self._forget_detached)
+
+    def _accounted(
+        self, project_id: str, generation_id: str, job: Callable[[], None]
+    ) -> None:
+        run = self.metrics.start_run()
+        try:
+            job()
+        finally:
+            self._record_usage(project_id, generation_id, run)
+
+    def _record_usage(self, project_id: str, generation_id: str, run: RunMetrics) -> None:
+        calls = run.recorded_calls()
+        for charged_to, charged in (
+            (generation_id, [call for call in calls if call["stage"] not in PROJECT_STAGES]),
+            ("", [call for call in calls if call["stage"] in PROJECT_STAGES]),
+        ):
+            if not charged:
+                continue
+            self.database.add_token_usage(
+                project_id,
+                charged_to,
+                [
+                    {
+                        "bot": call["bot"],
+                        "stage": call["stage"],
+                        "prompt_tokens": call["prompt_tokens"],
+                        "completion_tokens": call["response_tokens"],
+                    }
+                    for call in charged
+                ],
+            )
+
+    def _cost(self, bot: str, prompt_tokens: int, completion_tokens: int) -> float:
+        pricing = self.gateway.llm_config.get(bot, {}).get("pricing") or {}
+        return (
+            prompt_tokens * float(pricing.get("prompt_per_million") or 0)
+            + completion_tokens * float(pricing.get("completion_per_million") or 0)
+        ) / 1_000_000
+
+    def token_usage(self, project_id: str) -> dict[str, Any]:
+        """Estimated tokens and cost of a project, in total, per stage and per generation.
+
+        Usage not tied to one saved generation, such as the initial memory
+        build or the calls of a run that failed or was abandoned before
+        saving, is listed under an empty ``generation_id``.
+        """
+        rows = self.database.token_usage(project_id)
+        by_stage: dict[tuple[str, str], dict[str, Any]] = {}
+        by_generation: dict[str, dict[str, Any]] = {}
+        for row in rows:
+            cost = self._cost(row["bot"], row["prompt_tokens"], row["completion_tokens"])
+            for bucket in (
+                by_stage.setdefault(
+                    (row["bot"], row["stage"]), {"bot": row["bot"], "stage": row["stage"]}
+                ),
+                by_generation.setdefault(
+                    row["generation_id"], {"generation_id": row["generation_id"]}
+                ),
+            ):
+                bucket["calls"] = bucket.get("calls", 0) + row["calls"]
+                bucket["prompt_tokens"] = bucket.get("prompt_tokens", 0) + row["prompt_tokens"]
+                bucket["completion_tokens"] = (
+                    bucket.get("completion_tokens", 0) + row["completion_tokens"]
+                )
+                bucket["cost"] = bucket.get("cost", 0.0) + cost
+        prompt_tokens = sum(row["prompt_tokens"] for row in rows)
+        completion_tokens = sum(row["completion_tokens"] for row in rows)
+        return {
+            "calls": sum(row["calls"] for row in rows),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "cost": round(sum(item["cost"] for item in by_stage.values()), 6),
+            "by_stage": [
+                {**item, "cost": round(item["cost"], 6)} for item in by_stage.values()
+            ],
+            "by_generation": [
+                {**item, "cost": round(item["cost"], 6)} for item in by_generation.values()
+            ],
+        }
+
+    def estimate_tokens(
+        self, project: dict[str, Any], context: str, plan_prompt: str
+    ) -> dict[str, int]:
+        """Pre-flight token estimate of one generation, before any model call.
+
+        Covers the plan and writing calls from their prompts and the word
+        limit, plus the project's average background review and memory
+        refresh per generation so far. ``project_tokens`` is the usage
+        recorded for the project before this generation.
+        """
+        system = self.gateway.system_tokens("writing_bot")
+        writing_prompt = self._writing_prompt(
+            context, project["requirements"], project["word_limit"], ""
+        )
+        prompt_tokens = system + approximate_tokens(writing_prompt)
+        completion_tokens = math.ceil(project["word_limit"] * WIDE_TOKENS_PER_CHAR)
+        if plan_prompt:
+            # The plan is generated once and then repeated in the writing prompt.
+            prompt_tokens += system + approximate_tokens(plan_prompt) + PLAN_COMPLETION_TOKENS
+            completion_tokens += PLAN_COMPLETION_TOKENS
+        used = 0
+        background: dict[str, int] = {}
+        for row in self.database.token_usage(project["id"]):
+            used += row["prompt_tokens"] + row["completion_tokens"]
+            if row["generation_id"] and row["stage"] in BACKGROUND_STAGES:
+                background[row["generation_id"]] = (
+                    background.get(row["generation_id"], 0)
+                    + row["prompt_tokens"]
+                    + row["completion_tokens"]
+                )
+        background_tokens = sum(background.values()) // len(background) if background else 0
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "background_tokens": background_tokens,
+            "total_tokens": prompt_tokens + completion_tokens + background_tokens,
+            "project_tokens": used,
+        }
+
+    def _forget_detached(self, future: Future) -> None:
+        with self._jobs_guard:
+            self._detached.discard(future)
+
+    def _forget(self, project_id: str, future: Future) -> None:
+        with self._jobs_guard:
+            pending = self._jobs.get(project_id)
+            if pending and pending[0] is future:
+                del self._jobs[project_id]
+
+    def has_pending_work(self, project_id: str) -> bool:
+        with self._jobs_guard:
+            return project_id in self._jobs
+
+    def pending_status(self, project_id: str) -> str | None:
+        with self._jobs_guard:
+            pending = self._jobs.get(project_id)
+        return pending[1] if pending else None
+
+    def pending_future(self, project_id: str) -> Future | None:
+        with self._jobs_guard:
+            pending = self._jobs.get(project_id)
+        return pending[0] if pending else None
+
+    def wait_for_pending(self, project_id: str, timeout: float | None = None) -> bool:
+        """Block until background work queued for the project has finished.
+
+        Returns False if it is still running after ``timeout`` seconds.
+        """
+        with self._jobs_guard:
+            pending = self._jobs.get(project_id)
+        if not pending:
+            return True
+        try:
+            pending[0].exception(timeout=timeout)
+        except FutureTimeoutError:
+            return False
+        return True
+
+    def wait_idle(self, timeout: float | None = None) -> None:
+        with self._jobs_guard:
+            futures = [future for future, _ in self._jobs.values()]
+            futures.extend(self._detached)
+        for future in futures:
+            future.exception(timeout=timeout)
+
+    def schedule_memory_build(self, project: dict[str, Any], owner_token: str) -> bool:
+        """Start building long-term memory for a freshly uploaded long novel."""
+        if len(project["original_text"]) <= self.memory.threshold:
+            return False
+        self._submit(
+            project["id"],
+            owner_token,
+            lambda: self._build_initial_memory(project["id"], owner_token),
+            "正在分块建立小说长期记忆…",
+        )
+        return True
+
+    def _passage_index(self, project: dict[str, Any]) -> PassageIndex | None:
+        """Load, or build and persist once, the retrieval index of a long original."""
+        if (
+            not self.memory.retrieval_budget
+            or len(project["original_text"]) <= self.memory.threshold
+        ):
+            return None
+        project_id = project["id"]
+        with self._indexes_guard:
+            if project_id in self._indexes:
+                self._indexes.move_to_end(project_id)
+                return self._indexes[project_id]
+        stored = self.database.get_passage_index(project_id)
+        try:
+            index = PassageIndex.from_bytes(stored) if stored else None
+        except ValueError:
+            # Stored by an older version; rebuilt below in the current format.
+            index = None
+        if index is None:
+            index = self.memory.build_index(project["original_text"])
+            self.database.set_passage_index(project_id, index.to_bytes())
+        with self._indexes_guard:
+            self._indexes[project_id] = index
+            while len(self._indexes) > 8:
+                self._indexes.popitem(last=False)
+        return index
+
+    def _build_initial_memory(self, project_id: str, owner_token: str) -> None:
+        project = self.database.get_project(project_id, owner_token)
+        if not project:
+            return
+        self._passage_index(project)
+        if self._load_memory(project):
+            return
+        try:
+            with self.metrics.stage("memory_build"):
+                memory, tree = self.memory.build_memory_tree(project["original_text"])
+        except Exception:
+            # The first stream retries the build and reports the error.
+            return
+        self._store_memory(project_id, owner_token, memory, tree)
+
+    def _store_memory(
+        self,
+        project_id: str,
+        owner_token: str,
+        memory: dict[str, Any],
+        tree: dict[str, Any],
+    ) -> int:
+        """Save a freshly built memory and its tree; returns the snapshot id."""
+        self.database.set_memory(project_id, owner_token, memory)
+        self.database.set_memory_tree(project_id, tree)
+        return self.database.save_memory_snapshot(project_id, 0, None, memory)
+
+    def _memory_before(
+        self,
+        project: dict[str, Any],
+        active: list[dict[str, Any]],
+        position: int,
+    ) -> tuple[dict[str, Any] | None, int | None]:
+        """Memory as of the active text preceding ``position`` and its snapshot id.
+
+        Falls back to the project's latest memory when no snapshot was taken.
+        """
+        previous = [item for item in active if item["position"] < position]
+        snapshot = self.database.memory_snapshot(
+            project["id"],
+            previous[-1]["position"] if previous else 0,
+            previous[-1]["id"] if previous else None,
+        )
+        if snapshot:
+            return snapshot[1], snapshot[0]
+        return self._load_memory(project), None
+
+    def restore_generation(
+        self, project_id: str, owner_token: str, generation_id: str
+    ) -> dict[str, Any] | None:
+        """Activate an older version and check out the memory recorded for it.
+
+        Raises ``TimeoutError`` when the project's memory update does not
+        finish within ``RESTORE_WAIT_SECONDS``, so a request thread is never
+        held for the length of a refresh.
+        """
+        if not self.wait_for_pending(project_id, RESTORE_WAIT_SECONDS):
+            raise TimeoutError("记忆更新仍在进行，请稍后再恢复版本")
+        restored = self.database.restore_generation(project_id, generation_id)
+        if not restored:
+            return None
+        active = self.database.active_generations(project_id)
+        if active and active[-1]["id"] == generation_id:
+            snapshot = self.database.memory_snapshot(
+                project_id, restored["position"], generation_id
+            )
+            if snapshot:
+                self.database.set_memory(project_id, owner_token, snapshot[1])
+        return restored
 
     @staticmethod
     def _load_memory(project: dict[str, Any]) -> dict[str, Any] | None:
@@ -33,13 +478,26 @@ class NovelService:
         except json.JSONDecodeError:
             return None
 
-    def _plan(
-        self, context: str, requirements: str, word_limit: int
-    ) -> str:
-        prompt = f"""
+    def _plan_prompt(self, context: str, requirements: str, word_limit: int) -> str:
+        task = """
 为下一段小说续写拟定一个简短、可执行的写作计划，包含：
 承接点、核心冲突推进、人物行动、伏笔处理和结尾钩子。
 不要写正文，不新增与现有设定冲突的内容。
+""".strip()
+        if self.prompt_layout == "cache_friendly":
+            return f"""
+{CACHE_FRIENDLY_PREAMBLE}
+
+{context}
+
+【本次任务】
+{task}
+
+额外要求：{requirements or "无"}
+目标字数：约 {word_limit} 字
+""".strip()
+        return f"""
+{task}
 
 上下文：
 {context}
@@ -47,22 +505,146 @@ class NovelService:
 额外要求：{requirements or "无"}
 目标字数：约 {word_limit} 字
 """.strip()
-        return self.gateway.call("writing_bot", prompt)
 
-    @staticmethod
+    def _plan_context(
+        self,
+        project: dict[str, Any],
+        active: list[dict[str, Any]],
+        memory: dict[str, Any] | None,
+        position: int,
+    ) -> tuple[tuple[str, ...], str]:
+        """Generation ids preceding ``position`` and their writing context."""
+        previous = [item for item in active if item["position"] < position]
+        context = self.memory.context_for(
+            project["original_text"],
+            [item["content"] for item in previous],
+            memory,
+            self._passage_index(project),
+            layout=self.prompt_layout,
+        )
+        return tuple(item["id"] for item in previous), context
+
+    def _record_prompt(self, project_id: str, prompt: str) -> None:
+        """Track how much of ``prompt`` repeats the project's previous writing prompt."""
+        with self._prefixes_guard:
+            previous, stats = self._prefixes.get(
+                project_id,
+                (
+                    "",
+                    {
+                        "requests": 0,
+                        "prompt_tokens": 0,
+                        "shared_prefix_tokens": 0,
+                        "last_shared_prefix_tokens": 0,
+                    },
+                ),
+            )
+            shared = self.memory.tokens.count(
+                prompt[: shared_prefix_length(previous, prompt)]
+            )
+            stats["requests"] += 1
+            stats["prompt_tokens"] += self.memory.tokens.count(prompt)
+            stats["shared_prefix_tokens"] += shared
+            stats["last_shared_prefix_tokens"] = shared
+            self._prefixes[project_id] = (prompt, stats)
+            self._prefixes.move_to_end(project_id)
+            while len(self._prefixes) > PREFIX_TRACKED_PROJECTS:
+                self._prefixes.popitem(last=False)
+
+    def prefix_stats(self, project_id: str) -> dict[str, Any]:
+        """Prompt prefix reuse between consecutive writing calls of a project."""
+        with self._prefixes_guard:
+            _, stats = self._prefixes.get(project_id, ("", None))
+            stats = dict(stats or {})
+        if not stats:
+            return {"requests": 0, "shared_prefix_ratio": 0.0}
+        stats["shared_prefix_ratio"] = round(
+            stats["shared_prefix_tokens"] / (stats["prompt_tokens"] or 1), 4
+        )
+        return stats
+
+    def forget_project(self, project_id: str) -> None:
+        """Drop what is kept in memory for a deleted project."""
+        with self._prefixes_guard:
+            self._prefixes.pop(project_id, None)
+        with self._indexes_guard:
+            self._indexes.pop(project_id, None)
+        with self._plans_guard:
+            speculation = self._plans.pop(project_id, None)
+        if speculation:
+            speculation.cancelled = True
+
+    def _speculate_plan(
+        self, project_id: str, owner_token: str, speculation: PlanSpeculation
+    ) -> None:
+        """Plan the segment after the active ones before it is requested."""
+        prompt_hash, plan = "", ""
+        try:
+            project = self.database.get_project(project_id, owner_token)
+            active = self.database.active_generations(project_id)
+            if (
+                speculation.cancelled
+                or not project
+                or project["writing_mode"] != "standard"
+                or not active
+            ):
+                return
+            position = active[-1]["position"] + 1
+            memory, _ = self._memory_before(project, active, position)
+            _, context = self._plan_context(project, active, memory, position)
+            prompt = self._plan_prompt(
+                context, project["requirements"], project["word_limit"]
+            )
+            if speculation.cancelled:
+                return
+            self._record_prompt(project_id, prompt)
+            try:
+                with self.metrics.stage("speculative_plan"):
+                    plan = self.gateway.call("writing_bot", prompt)
+            except Exception:
+                return
+            prompt_hash = content_hash(prompt)
+        finally:
+            speculation.result.set_result((prompt_hash, plan))
+
+    async def _take_plan(
+        self, project: dict[str, Any], generation_ids: tuple[str, ...], prompt: str
+    ) -> str:
+        """The speculative plan made for exactly this prompt, or an empty string.
+
+        The speculation is awaited only when it was started for the same
+        generations, requirements and word limit; otherwise it is cancelled
+        and the stream plans at once.
+        """
+        with self._plans_guard:
+            speculation = self._plans.pop(project["id"], None)
+        if not speculation:
+            return ""
+        if speculation.key != (generation_ids, project["requirements"], project["word_limit"]):
+            speculation.cancelled = True
+            return ""
+        prompt_hash, plan = await asyncio.wrap_future(speculation.result)
+        return plan if prompt_hash == content_hash(prompt) else ""
+
     def _writing_prompt(
+        self,
         context: str,
         requirements: str,
         word_limit: int,
         plan: str,
     ) -> str:
         plan_section = f"\n\n【本段写作计划】\n{plan}" if plan else ""
-        return f"""
-请根据以下材料续写小说正文。直接输出正文，不解释，不重复已有段落。
+        task = """
+直接输出正文，不解释，不重复已有段落。
 首句必须自然承接最近场景；严格遵守人物、世界规则、叙述视角和语言风格。
 推进当前冲突，并为下一段保留自然衔接点。
-
-{context}
+""".strip()
+        if self.prompt_layout == "cache_friendly":
+            lead = f"{CACHE_FRIENDLY_PREAMBLE}\n\n{context}\n\n【本次任务】\n请根据以上材料续写小说正文。{task}"
+        else:
+            lead = f"请根据以下材料续写小说正文。{task}\n\n{context}"
+        return f"""
+{lead}
 {plan_section}
 
 【额外写作要求】
@@ -72,18 +654,161 @@ class NovelService:
 约 {word_limit} 个中文字符，优先保证完整场景，不要输出标题或字数说明。
 """.strip()
 
+    def _refresh_memory(
+        self,
+        project: dict[str, Any],
+        owner_token: str,
+        memory: dict[str, Any] | None,
+        snapshot_id: int | None,
+        context_segments: list[str],
+        content: str,
+        generation: dict[str, Any],
+    ) -> None:
+        project_id = project["id"]
+        full_text = (
+            project["original_text"]
+            + "\n\n"
+            + "\n\n".join(context_segments + [content])
+        )
+        tree = self.database.get_memory_tree(project_id)
+        updated_memory = None
+        if tree and self.memory.tree_is_stale(full_text, tree):
+            # A full chunk of new text has accumulated: fold it into the
+            # tree, re-merging only the affected nodes.
+            updated_memory, tree = self.memory.build_memory_tree(full_text, tree)
+            self.database.set_memory_tree(project_id, tree)
+        elif memory:
+            updated_memory = self.memory.update_memory(memory, content)
+        elif len(full_text) > self.memory.threshold:
+            updated_memory, tree = self.memory.build_memory_tree(full_text)
+            self.database.set_memory_tree(project_id, tree)
+        if updated_memory:
+            self.database.set_memory(project_id, owner_token, updated_memory)
+            self.database.save_memory_snapshot(
+                project_id,
+                generation["position"],
+                generation["id"],
+                updated_memory,
+                snapshot_id,
+            )
+
+    def _post_process(
+        self,
+        project: dict[str, Any],
+        owner_token: str,
+        memory: dict[str, Any] | None,
+        snapshot_id: int | None,
+        context_segments: list[str],
+        content: str,
+        generation: dict[str, Any],
+        review: bool,
+    ) -> None:
+        """Review a saved segment and refresh memory outside the SSE stream.
+
+        The review and the refresh both read the memory preceding the
+        segment, so they run side by side; the job finishes once both have.
+        """
+        reviewing = (
+            self._review_executor.submit(
+                copy_context().run, self._review, memory, content, generation
+            )
+            if review
+            else None
+        )
+        try:
+            with self.metrics.stage("memory_update"):
+                self._refresh_memory(
+                    project,
+                    owner_token,
+                    memory,
+                    snapshot_id,
+                    context_segments,
+                    content,
+                    generation,
+                )
+        except Exception:
+            # A memory refresh failure must not discard a successful chapter.
+            pass
+        if reviewing:
+            reviewing.result()
+
+    def _review(
+        self,
+        memory: dict[str, Any] | None,
+        content: str,
+        generation: dict[str, Any],
+    ) -> None:
+        try:
+            with self.metrics.stage("consistency"):
+                report = self.memory.consistency_report(memory, content)
+        except Exception as exc:
+            report = f"一致性检查未完成：{exc}"
+        self.database.set_consistency_report(generation["id"], report)
+
+    @staticmethod
+    async def _queue_status(ticket: Ticket | None) -> AsyncIterator[dict[str, Any]]:
+        """Report the queue position of an interactive call until it may start."""
+        if ticket is None or ticket.wait(0):
+            return
+        while True:
+            yield {
+                "type": "status",
+                "content": f"模型服务繁忙，正在排队，前面还有 {ticket.position()} 个请求…",
+            }
+            if await ticket.wait_async(QUEUE_STATUS_INTERVAL) or ticket.released:
+                return
+
     def generate(
         self,
         project_id: str,
         owner_token: str,
         action: str,
     ) -> Iterator[dict[str, Any]]:
+        """Synchronous bridge over ``agenerate`` for WSGI routes.
+
+        The pipeline runs on the service's shared event loop, so waiting on
+        the model does not hold the loop; the calling thread only relays
+        events.
+        """
+        yield from self._loop.iterate(self.agenerate(project_id, owner_token, action))
+
+    def _load_run(
+        self, project_id: str, owner_token: str
+    ) -> tuple[dict[str, Any] | None, list[dict[str, Any]]]:
+        """The project and its active generations, as a run starts from them."""
         project = self.database.get_project(project_id, owner_token)
+        if not project:
+            return None, []
+        return project, self.database.active_generations(project_id)
+
+    async def agenerate(
+        self,
+        project_id: str,
+        owner_token: str,
+        action: str,
+    ) -> AsyncIterator[dict[str, Any]]:
+        run = self.metrics.start_run()
+        with self.metrics.stage("load_project"):
+            project, active = await asyncio.to_thread(
+                self._load_run, project_id, owner_token
+            )
         if not project:
             yield {"type": "error", "content": "项目不存在或无权访问"}
             return
 
-        active = self.database.active_generations(project_id)
+        pending_status = self.pending_status(project_id)
+        if pending_status:
+            yield {"type": "status", "content": pending_status}
+            with self.metrics.stage("wait_pending"):
+                pending = self.pending_future(project_id)
+                if pending:
+                    await asyncio.wait([asyncio.wrap_future(pending)])
+                # The job may have changed the memory or the active versions.
+                reloaded, active = await asyncio.to_thread(
+                    self._load_run, project_id, owner_token
+                )
+                project = reloaded or project
+
         if action == "initial" and active:
             yield {"type": "error", "content": "初次续写已经完成，请使用继续续写"}
             return
@@ -94,27 +819,69 @@ class NovelService:
             position = (active[-1]["position"] + 1) if active else 1
             context_segments = [item["content"] for item in active]
 
+        generation_id = ""
         try:
-            memory = self._load_memory(project)
+            memory, snapshot_id = await asyncio.to_thread(
+                self._memory_before, project, active, position
+            )
             if not memory and len(project["original_text"]) > self.memory.threshold:
                 yield {"type": "status", "content": "正在分块建立小说长期记忆…"}
-                memory = self.memory.build_memory(project["original_text"])
-                self.database.set_memory(project_id, owner_token, memory)
+                with self.metrics.stage("memory_build"):
+                    memory, tree = await asyncio.to_thread(
+                        run_as,
+                        owner_token,
+                        BACKGROUND,
+                        self.memory.build_memory_tree,
+                        project["original_text"],
+                    )
+                    snapshot_id = await asyncio.to_thread(
+                        self._store_memory, project_id, owner_token, memory, tree
+                    )
                 yield {"type": "status", "content": "长期记忆已建立"}
 
-            context = self.memory.context_for(
-                project["original_text"],
-                context_segments,
-                memory,
-            )
+            with self.metrics.stage("context"):
+                generation_ids, context = await asyncio.to_thread(
+                    self._plan_context, project, active, memory, position
+                )
             plan = ""
-            if project["writing_mode"] == "standard":
-                yield {"type": "status", "content": "正在规划本段情节…"}
-                plan = self._plan(
-                    context,
-                    project["requirements"],
-                    project["word_limit"],
+            plan_prompt = (
+                self._plan_prompt(context, project["requirements"], project["word_limit"])
+                if project["writing_mode"] == "standard"
+                else ""
+            )
+            estimate = await asyncio.to_thread(
+                self.estimate_tokens, project, context, plan_prompt
+            )
+            yield {"type": "estimate", **estimate}
+            if (
+                self.max_project_tokens
+                and estimate["project_tokens"] + estimate["total_tokens"]
+                > self.max_project_tokens
+            ):
+                raise RuntimeError(
+                    f"项目累计 Token 预计将超过上限 {self.max_project_tokens}"
+                    f"（已用 {estimate['project_tokens']}，本次约 {estimate['total_tokens']}）"
                 )
+            if plan_prompt:
+                plan = await self._take_plan(project, generation_ids, plan_prompt)
+                if plan:
+                    yield {"type": "status", "content": "已采用预先拟定的本段计划"}
+                else:
+                    yield {"type": "status", "content": "正在规划本段情节…"}
+                    self._record_prompt(project_id, plan_prompt)
+                    with self.metrics.stage("plan"):
+                        ticket = self.gateway.enqueue(
+                            "writing_bot", plan_prompt, owner_token, INTERACTIVE
+                        )
+                        try:
+                            async for event in self._queue_status(ticket):
+                                yield event
+                            plan = await self.gateway.acall(
+                                "writing_bot", plan_prompt, ticket
+                            )
+                        finally:
+                            if ticket:
+                                ticket.release()
 
             yield {"type": "status", "content": "正在生成正文…"}
             prompt = self._writing_prompt(
@@ -123,58 +890,86 @@ class NovelService:
                 project["word_limit"],
                 plan,
             )
+            self._record_prompt(project_id, prompt)
             chunks: list[str] = []
-            for chunk in self.gateway.stream("writing_bot", prompt):
-                chunks.append(chunk)
-                yield {"type": "content", "content": chunk}
+            with self.metrics.stage("stream"):
+                started = time.perf_counter()
+                ticket = self.gateway.enqueue("writing_bot", prompt, owner_token, INTERACTIVE)
+                try:
+                    async for event in self._queue_status(ticket):
+                        yield event
+                    # Closed here, not by the garbage collector, so a client
+                    # disconnect still records the partial call.
+                    async with aclosing(
+                        self.gateway.astream("writing_bot", prompt, ticket)
+                    ) as stream:
+                        async for chunk in stream:
+                            if not chunks:
+                                self.metrics.observe_stage(
+                                    "first_token", time.perf_counter() - started
+                                )
+                            chunks.append(chunk)
+                            yield {"type": "content", "content": chunk}
+                finally:
+                    if ticket:
+                        ticket.release()
             content = "".join(chunks).strip()
             if not content:
                 raise RuntimeError("写作模型返回了空内容")
 
-            consistency_report = ""
-            if project["writing_mode"] == "standard":
-                yield {"type": "status", "content": "正在进行基础一致性检查…"}
-                try:
-                    consistency_report = self.memory.consistency_report(memory, content)
-                except Exception as exc:
-                    consistency_report = f"一致性检查未完成：{exc}"
-
-            saved = self.database.save_generation(
-                project_id=project_id,
-                position=position,
-                content=content,
-                plan=plan,
-                consistency_report=consistency_report,
+            with self.metrics.stage("save"):
+                saved = await asyncio.to_thread(
+                    self.database.save_generation,
+                    project_id=project_id,
+                    position=position,
+                    content=content,
+                    plan=plan,
+                )
+            generation_id = saved["id"]
+            review_pending = project["writing_mode"] == "standard"
+            # Without a background pool the jobs run inline, off the loop.
+            await asyncio.to_thread(
+                self._submit,
+                project_id,
+                owner_token,
+                lambda: self._post_process(
+                    project,
+                    owner_token,
+                    memory,
+                    snapshot_id,
+                    context_segments,
+                    content,
+                    saved,
+                    review_pending,
+                ),
+                "正在等待上一段的记忆更新完成…",
+                generation_id=saved["id"],
             )
-
-            try:
-                if memory:
-                    updated_memory = self.memory.update_memory(memory, content)
-                elif len(project["original_text"]) + sum(
-                    len(item) for item in context_segments
-                ) + len(content) > self.memory.threshold:
-                    updated_memory = self.memory.build_memory(
-                        project["original_text"]
-                        + "\n\n"
-                        + "\n\n".join(context_segments + [content])
-                    )
-                else:
-                    updated_memory = None
-                if updated_memory:
-                    self.database.set_memory(project_id, owner_token, updated_memory)
-            except Exception:
-                # A memory refresh failure must not discard a successful chapter.
-                pass
-
-            if consistency_report:
-                yield {
-                    "type": "review",
-                    "content": consistency_report,
-                }
+            if self.speculative_planning and review_pending:
+                await asyncio.to_thread(
+                    self._submit_speculation,
+                    project_id,
+                    owner_token,
+                    PlanSpeculation(
+                        (
+                            (*generation_ids, saved["id"]),
+                            project["requirements"],
+                            project["word_limit"],
+                        )
+                    ),
+                )
             yield {
                 "type": "complete",
                 "content": "续写完成",
                 "generation_id": saved["id"],
+                "review_pending": review_pending,
             }
         except Exception as exc:
             yield {"type": "error", "content": f"生成失败：{exc}"}
+        finally:
+            # Also on errors, cancellation and client disconnects: every call
+            # made so far was paid for.
+            await asyncio.to_thread(self._record_usage, project_id, generation_id, run)
+        if self.metrics_event:
+            # Background review and memory refresh are reported only at /metrics.
+            yield {"type": "metrics", **run.summary()}
@@ -0,0 +1,67 @@
+"""Offset-based text splitting that prefers natural Chinese boundaries."""
+
+from __future__ import annotations
+
+import re
+from collections.abc import Iterator
+
+
+_PARAGRAPH_BREAK = re.compile(r"\n[^\S\n]*\n")
+_LINE_BREAK = re.compile(r"\n")
+_SENTENCE_END = re.compile(r"[。！？…」]+")
+_SOFT_BOUNDARY = re.compile(r"[。！？…」]+|\n")
+
+
+def _last_boundary(pattern: re.Pattern[str], text: str, low: int, high: int) -> int:
+    end = 0
+    for match in pattern.finditer(text, low, high):
+        end = match.end()
+    return end
+
+
+def next_chunk_start(text: str, end: int, overlap: int, start: int) -> int:
+    """Where the chunk after ``[start, end)`` begins.
+
+    With an overlap the start moves back by up to ``overlap`` characters and
+    then forward to the next sentence or line boundary, so overlapping text
+    begins with a whole sentence.
+    """
+    if overlap <= 0:
+        return end
+    candidate = max(start + 1, end - overlap)
+    match = _SOFT_BOUNDARY.search(text, candidate, end)
+    return match.end() if match and match.end() < end else candidate
+
+
+def iter_chunk_spans(
+    text: str,
+    chunk_chars: int,
+    overlap: int = 0,
+    start: int = 0,
+) -> Iterator[tuple[int, int]]:
+    """Yield ``(start, end)`` offsets of chunks of at most ``chunk_chars``.
+
+    Each chunk ends at the last blank line in the second half of its window,
+    else the last line break, else the last Chinese sentence end, and only
+    then at a hard cut. No chunk text is copied, so splitting stays linear
+    on very large single-paragraph uploads. A chunk's end depends only on
+    the text from its start, so splitting can resume from any yielded
+    boundary.
+    """
+    chunk_chars = max(1, int(chunk_chars))
+    overlap = max(0, min(int(overlap), chunk_chars // 4))
+    length = len(text)
+    while start < length:
+        limit = start + chunk_chars
+        if limit >= length:
+            yield start, length
+            return
+        floor = start + chunk_chars // 2
+        end = (
+            _last_boundary(_PARAGRAPH_BREAK, text, floor, limit)
+            or _last_boundary(_LINE_BREAK, text, floor, limit)
+            or _last_boundary(_SENTENCE_END, text, floor, limit)
+            or limit
+        )
+        yield start, end
+        start = next_chunk_start(text, end, overlap, start)
@@ -0,0 +1,140 @@
+"""Token estimation and priority-based context budget allocation."""
+
+from __future__ import annotations
+
+import math
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any
+
+
+_WIDE = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+# Rough averages for OpenAI-compatible BPE vocabularies: one Chinese
+# character is a little under one token, while ASCII text, JSON syntax and
+# whitespace pack three to four characters per token.
+WIDE_TOKENS_PER_CHAR = 0.75
+NARROW_TOKENS_PER_CHAR = 0.3
+
+
+def approximate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    narrow = len(_WIDE.sub("", text))
+    wide = len(text) - narrow
+    return math.ceil(wide * WIDE_TOKENS_PER_CHAR + narrow * NARROW_TOKENS_PER_CHAR)
+
+
+@lru_cache(maxsize=4)
+def _load_encoding(name: str) -> Any:
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception:
+        return None
+
+
+class TokenEstimator:
+    """Count tokens with an optional tokenizer and a fast local fallback.
+
+    ``tokenizer`` is either empty (approximation only) or
+    ``"tiktoken:<encoding>"``; the encoding is loaded once per process and
+    the approximation is used whenever it is unavailable.
+    """
+
+    def __init__(self, tokenizer: str = ""):
+        self.tokenizer = tokenizer
+
+    @property
+    def encoding(self) -> Any:
+        kind, _, name = self.tokenizer.partition(":")
+        if kind != "tiktoken" or not name:
+            return None
+        return _load_encoding(name)
+
+    def count(self, text: str) -> int:
+        encoding = self.encoding
+        if encoding is None:
+            return approximate_tokens(text)
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def chars_for(self, tokens: int) -> int:
+        """An upper bound on the characters that can fit in ``tokens``."""
+        if self.encoding is None:
+            return math.ceil(tokens / NARROW_TOKENS_PER_CHAR) + 1
+        return tokens * 16 + 16
+
+    def clip(self, text: str, tokens: int, keep: str = "tail") -> str:
+        """Clip ``text`` to at most ``tokens``, keeping its head, tail or both ends."""
+        if tokens <= 0:
+            return ""
+        if self.count(text) <= tokens:
+            return text
+        if keep == "both":
+            marker = "\n…（中间内容已按预算省略）…\n"
+            half = max(1, (tokens - self.count(marker)) // 2)
+            return self.clip(text, half, "head") + marker + self.clip(text, half, "tail")
+        low, high = 0, min(len(text), self.chars_for(tokens))
+        while low < high:
+            middle = (low + high + 1) // 2
+            piece = text[-middle:] if keep == "tail" else text[:middle]
+            if self.count(piece) <= tokens:
+                low = middle
+            else:
+                high = middle - 1
+        if not low:
+            return ""
+        return text[-low:] if keep == "tail" else text[:low]
+
+
+@dataclass
+class BudgetSection:
+    """One block of context competing for the token budget.
+
+    Sections are served in ``priority`` order (lower first), first up to
+    ``minimum``, then up to ``cap``, and finally up to their full size, so
+    budget that one section does not need flows to the next.
+    """
+
+    name: str
+    text: str
+    priority: int
+    minimum: int = 0
+    cap: int | None = None
+    keep: str = "tail"
+
+
+def allocate(
+    sections: list[BudgetSection], budget: int, estimator: TokenEstimator
+) -> dict[str, int]:
+    needs = {section.name: estimator.count(section.text) for section in sections}
+    grants = {section.name: 0 for section in sections}
+    remaining = max(0, budget)
+    ordered = sorted(sections, key=lambda section: section.priority)
+    limits = (
+        lambda section: section.minimum,
+        lambda section: section.cap if section.cap is not None else needs[section.name],
+        lambda section: needs[section.name],
+    )
+    for limit in limits:
+        for section in ordered:
+            target = min(needs[section.name], limit(section))
+            extra = min(remaining, max(0, target - grants[section.name]))
+            grants[section.name] += extra
+            remaining -= extra
+    return grants
+
+
+def fit_sections(
+    sections: list[BudgetSection], budget: int, estimator: TokenEstimator
+) -> dict[str, str]:
+    """Allocate ``budget`` tokens across sections and clip each to its share."""
+    grants = allocate(sections, budget, estimator)
+    return {
+        section.name: estimator.clip(section.text, grants[section.name], section.keep)
+        for section in sections
+    }
@@ -0,0 +1,317 @@
+"""Keep-alive HTTP connection pools shared by every bot on the same endpoint."""
+
+from __future__ import annotations
+
+import asyncio
+import http.client
+import ssl
+import threading
+import time
+from collections import deque
+from typing import Any
+
+
+DEFAULT_TRANSPORT = {
+    "pool_size": 8,
+    "keep_alive": True,
+    "connect_timeout": 10,
+    "read_timeout": 300,
+}
+
+
+def transport_settings(bot_config: dict[str, Any]) -> dict[str, Any]:
+    """The bot's ``transport`` settings merged over the defaults."""
+    configured = bot_config.get("transport") or {}
+    return {key: configured.get(key, value) for key, value in DEFAULT_TRANSPORT.items()}
+
+
+class AsyncConnection:
+    """An asyncio stream pair opened on, and only usable from, one event loop."""
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        loop: asyncio.AbstractEventLoop,
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+
+    def usable(self, loop: asyncio.AbstractEventLoop) -> bool:
+        return (
+            self.loop is loop
+            and not self.writer.is_closing()
+            and not self.reader.at_eof()
+        )
+
+    def close(self) -> None:
+        try:
+            self.writer.close()
+        except RuntimeError:
+            # Its event loop has already been closed.
+            pass
+
+
+class ConnectionPool:
+    """A bounded set of connections to one scheme/host/port.
+
+    ``acquire`` hands out an idle ``http.client`` connection or opens a new
+    one while fewer than ``pool_size`` are in use, and otherwise waits for a
+    release for at most ``connect_timeout`` seconds. ``aacquire`` does the
+    same for asyncio streams without blocking the event loop; both kinds
+    count against the same ``pool_size``.
+    """
+
+    def __init__(
+        self,
+        scheme: str,
+        host: str,
+        port: int | None,
+        pool_size: int = 8,
+        keep_alive: bool = True,
+        connect_timeout: float = 10,
+        read_timeout: float = 300,
+    ):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.pool_size = max(1, int(pool_size))
+        self.keep_alive = bool(keep_alive)
+        self.connect_timeout = float(connect_timeout)
+        self.read_timeout = float(read_timeout)
+        self._idle: deque[http.client.HTTPConnection] = deque()
+        self._idle_async: deque[AsyncConnection] = deque()
+        # Event-loop waiters, handed a slot directly by ``_return_slot``.
+        self._async_waiters: deque[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+        self._in_use = 0
+        self._available = threading.Condition()
+        self.counters = {
+            "created": 0,
+            "reused": 0,
+            "discarded": 0,
+            "waits": 0,
+            "wait_timeouts": 0,
+            "peak_in_use": 0,
+        }
+
+    def _open(self) -> http.client.HTTPConnection:
+        connection_class = (
+            http.client.HTTPSConnection
+            if self.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        connection = connection_class(self.host, self.port, timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection
+
+    def _take_slot(self) -> None:
+        self._in_use += 1
+        self.counters["peak_in_use"] = max(self.counters["peak_in_use"], self._in_use)
+
+    def _wait_timeout(self) -> TimeoutError:
+        self.counters["wait_timeouts"] += 1
+        return TimeoutError(f"{self.connect_timeout:g} 秒内没有空闲连接：{self.host}")
+
+    def acquire(self, fresh: bool = False) -> tuple[http.client.HTTPConnection, bool]:
+        """Return a connection and whether it was reused from the idle set.
+
+        ``fresh`` skips idle connections, for retrying after a stale one.
+        Raises ``TimeoutError`` when no connection frees up within the
+        connect timeout, so a stuck endpoint cannot hold callers forever.
+        """
+        deadline = time.monotonic() + self.connect_timeout
+        with self._available:
+            if self._in_use >= self.pool_size:
+                self.counters["waits"] += 1
+            while self._in_use >= self.pool_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._wait_timeout()
+                self._available.wait(remaining)
+            self._take_slot()
+            connection = None
+            if self._idle and not fresh:
+                connection = self._idle.pop()
+                self.counters["reused"] += 1
+        if connection:
+            return connection, True
+        try:
+            connection = self._open()
+        except BaseException:
+            self._return_slot()
+            raise
+        with self._available:
+            self.counters["created"] += 1
+        return connection, False
+
+    def release(self, connection: http.client.HTTPConnection, reusable: bool) -> None:
+        """Hand a connection back, keeping it only if it can carry another request."""
+        if reusable and self.keep_alive:
+            with self._available:
+                self._idle.append(connection)
+        else:
+            connection.close()
+            with self._available:
+                self.counters["discarded"] += 1
+        self._return_slot()
+
+    async def _aopen(self) -> AsyncConnection:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                self.host,
+                self.port or (443 if self.scheme == "https" else 80),
+                ssl=ssl.create_default_context() if self.scheme == "https" else None,
+            ),
+            self.connect_timeout,
+        )
+        return AsyncConnection(reader, writer, asyncio.get_running_loop())
+
+    async def aacquire(self, fresh: bool = False) -> tuple[AsyncConnection, bool]:
+        """Async ``acquire``: an asyncio connection and whether it was reused."""
+        loop = asyncio.get_running_loop()
+        waiter = None
+        with self._available:
+            if self._in_use < self.pool_size:
+                self._take_slot()
+            else:
+                self.counters["waits"] += 1
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+        if waiter:
+            try:
+                await asyncio.wait_for(waiter, self.connect_timeout)
+            except BaseException as exc:
+                with self._available:
+                    try:
+                        self._async_waiters.remove((loop, waiter))
+                    except ValueError:
+                        # Already handed a slot; ``_hand_over`` returns it.
+                        pass
+                    if isinstance(exc, asyncio.TimeoutError):
+                        raise self._wait_timeout() from None
+                raise
+        stale: list[AsyncConnection] = []
+        connection = None
+        with self._available:
+            while self._idle_async and not fresh:
+                candidate = self._idle_async.pop()
+                if candidate.usable(loop):
+                    connection = candidate
+                    self.counters["reused"] += 1
+                    break
+                stale.append(candidate)
+            self.counters["discarded"] += len(stale)
+        for candidate in stale:
+            candidate.close()
+        if connection:
+            return connection, True
+        try:
+            connection = await self._aopen()
+        except BaseException:
+            self._return_slot()
+            raise
+        with self._available:
+            self.counters["created"] += 1
+        return connection, False
+
+    def arelease(self, connection: AsyncConnection, reusable: bool) -> None:
+        """Hand an asyncio connection back, keeping it only if it can carry another request."""
+        if reusable and self.keep_alive:
+            with self._available:
+                self._idle_async.append(connection)
+        else:
+            connection.close()
+            with self._available:
+                self.counters["discarded"] += 1
+        self._return_slot()
+
+    def _return_slot(self) -> None:
+        with self._available:
+            while self._async_waiters:
+                loop, waiter = self._async_waiters.popleft()
+                try:
+                    # The slot passes to the waiter without being freed.
+                    loop.call_soon_threadsafe(self._hand_over, waiter)
+                    return
+                except RuntimeError:
+                    # The waiter's loop is closed.
+                    continue
+            self._in_use -= 1
+            self._available.notify()
+
+    def _hand_over(self, waiter: asyncio.Future) -> None:
+        if waiter.done():
+            # It timed out or was cancelled after the slot was passed on.
+            self._return_slot()
+        else:
+            waiter.set_result(None)
+
+    def stats(self) -> dict[str, Any]:
+        with self._available:
+            return {
+                "pool_size": self.pool_size,
+                "in_use": self._in_use,
+                "idle": len(self._idle) + len(self._idle_async),
+                **self.counters,
+            }
+
+    def close(self) -> None:
+        with self._available:
+            idle, self._idle = list(self._idle), deque()
+            idle_async, self._idle_async = list(self._idle_async), deque()
+        for connection in [*idle, *idle_async]:
+            connection.close()
+
+
+PoolKey = tuple[str, str, "int | None", tuple[tuple[str, Any], ...]]
+
+
+class TransportRegistry:
+    """One connection pool per endpoint and transport settings, created on first use."""
+
+    def __init__(self):
+        self._pools: dict[PoolKey, ConnectionPool] = {}
+        self._guard = threading.Lock()
+
+    def pool(
+        self,
+        scheme: str,
+        host: str,
+        port: int | None,
+        settings: dict[str, Any],
+    ) -> ConnectionPool:
+        """The pool of an endpoint, shared by every bot with the same ``settings``.
+
+        Bots with different transport settings get separate pools, so one
+        bot's ``pool_size`` and timeouts never apply to another.
+        """
+        key = (scheme, host, port, tuple(sorted(settings.items())))
+        with self._guard:
+            if key not in self._pools:
+                self._pools[key] = ConnectionPool(scheme, host, port, **settings)
+            return self._pools[key]
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """Pool statistics by endpoint; endpoints with several pools add their settings."""
+        with self._guard:
+            pools = dict(self._pools)
+        endpoints = [
+            f"{scheme}://{host}{f':{port}' if port else ''}"
+            for scheme, host, port, _ in pools
+        ]
+        return {
+            (
+                endpoint
+                if endpoints.count(endpoint) == 1
+                else f"{endpoint} ({', '.join(f'{name}={value}' for name, value in settings)})"
+            ): pool.stats()
+            for endpoint, ((_, _, _, settings), pool) in zip(endpoints, pools.items())
+        }
+
+    def close(self) -> None:
+        with self._guard:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.close()
@@ -3,10 +3,12 @@
 from __future__ import annotations
 
 import json
+import re
 import threading
 import uuid
 from pathlib import Path
 from typing import Any
+from urllib.parse import quote
 
 from flask import (
     Flask,
@@ -19,13 +21,21 @@ from flask import (
 )
 from werkzeug.exceptions import RequestEntityTooLarge
 
+from .cache import ResponseCache, SummaryCache
 from .config import BASE_DIR, load_config
 from .database import NovelDatabase
 from .llm import AgentGateway
 from .memory import MemoryManager
+from .metrics import MetricsRegistry
+from .scheduler import RequestScheduler
 from .service import NovelService
 
 
+# Generations listed per page by default and at most.
+GENERATION_PAGE_SIZE = 50
+MAX_GENERATION_PAGE_SIZE = 200
+
+
 def _load_prompts() -> dict[str, str]:
     prompt_dir = BASE_DIR / "prompts"
     return {
@@ -82,8 +92,9 @@ def _decode_upload(file_storage: Any, allowed_extensions: set[str]) -> str:
 def create_app(
     config_overrides: dict[str, Any] | None = None,
     agents: dict[str, Any] | None = None,
+    config_path: str | Path | None = None,
 ) -> Flask:
-    config = load_config(overrides=config_overrides)
+    config = load_config(config_path, overrides=config_overrides)
     app_config = config["app_config"]
     prompts = _load_prompts()
 
@@ -99,9 +110,43 @@ def create_app(
         app.config.update(config_overrides)
 
     database = NovelDatabase(app_config["database_path"])
-    gateway = AgentGateway(config["llm_config"], prompts, agents=agents)
-    memory = MemoryManager(gateway, app_config)
-    service = NovelService(database, gateway, memory)
+    response_cache = (
+        ResponseCache(
+            database,
+            int(float(app_config["response_cache_max_mb"]) * 1024 * 1024),
+            float(app_config["response_cache_ttl_hours"]) * 3600,
+        )
+        if any(bot.get("response_cache") for bot in config["llm_config"].values())
+        else None
+    )
+    metrics = MetricsRegistry()
+    gateway = AgentGateway(
+        config["llm_config"],
+        prompts,
+        agents=agents,
+        response_cache=response_cache,
+        scheduler=(
+            RequestScheduler(app_config["scheduler"]) if app_config["scheduler"] else None
+        ),
+        metrics=metrics,
+    )
+    summary_cache = (
+        SummaryCache(database, int(float(app_config["summary_cache_max_mb"]) * 1024 * 1024))
+        if app_config["summary_cache_max_mb"]
+        else None
+    )
+    memory = MemoryManager(gateway, app_config, cache=summary_cache)
+    service = NovelService(
+        database,
+        gateway,
+        memory,
+        background_workers=int(app_config["background_workers"]),
+        speculative_planning=bool(app_config["speculative_planning"]),
+        prompt_layout=app_config["prompt_layout"],
+        metrics_event=bool(app_config["metrics_event"]),
+        max_project_tokens=int(app_config["max_project_tokens"]),
+        blocking_workers=int(app_config["blocking_workers"]),
+    )
     allowed_extensions = {
         extension.lower() for extension in app_config["allowed_extensions"]
     }
@@ -111,18 +156,26 @@ def create_app(
     app.extensions["novel_database"] = database
     app.extensions["novel_service"] = service
     app.extensions["novel_config"] = config
+    app.extensions["summary_cache"] = summary_cache
+    app.extensions["response_cache"] = response_cache
+    app.extensions["metrics"] = metrics
 
     def project_or_404(project_id: str) -> dict[str, Any] | None:
         return database.get_project(project_id, _owner_token())
 
     def project_payload(project: dict[str, Any]) -> dict[str, Any]:
-        active = database.active_generations(project["id"])
-        history = database.generation_history(project["id"])
+        """Project settings and counts; text and memory stay on the server."""
         return {
-            **{key: value for key, value in project.items() if key != "owner_token"},
+            **{
+                key: value
+                for key, value in project.items()
+                if key not in ("owner_token", "original_text", "memory_json")
+            },
+            "original_chars": len(project["original_text"]),
             "has_memory": bool(project.get("memory_json")),
-            "active_generations": active,
-            "generation_history": history,
+            **database.generation_counts(project["id"]),
+            "prompt_prefix": service.prefix_stats(project["id"]),
+            "token_usage": service.token_usage(project["id"]),
         }
 
     def lock_for(project_id: str) -> threading.Lock:
@@ -167,7 +220,19 @@ def create_app(
 
     @app.get("/health")
     def health() -> Response:
-        return jsonify({"status": "ok"})
+        return jsonify(
+            {
+                "status": "ok",
+                "endpoints": gateway.endpoint_health(),
+                "transport": gateway.transport_stats(),
+                "scheduler": gateway.scheduler.stats() if gateway.scheduler else None,
+                "response_cache": response_cache.stats() if response_cache else None,
+            }
+        )
+
+    @app.get("/metrics")
+    def prometheus_metrics() -> Response:
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
     @app.post("/process")
     def process_text() -> Response:
@@ -187,14 +252,16 @@ def create_app(
                 first_line = text_content.splitlines()[0].strip()
                 title = (first_line[:30] or "未命名小说")
 
+            owner = _owner_token()
             project = database.create_project(
-                owner_token=_owner_token(),
+                owner_token=owner,
                 title=title,
                 original_text=text_content,
                 requirements=requirements,
                 word_limit=word_limit,
                 writing_mode=mode,
             )
+            memory_pending = service.schedule_memory_build(project, owner)
             return jsonify(
                 {
                     "success": True,
@@ -202,6 +269,7 @@ def create_app(
                     "project_id": project["id"],
                     "text_length": len(text_content),
                     "used_summary": len(text_content) > memory.threshold,
+                    "memory_pending": memory_pending,
                     "word_limit": word_limit,
                 }
             )
@@ -251,12 +319,93 @@ def create_app(
             return jsonify({"success": False, "error": "项目不存在"}), 404
         return jsonify({"success": True, "project": project_payload(project)})
 
+    @app.get("/api/projects/<project_id>/generations")
+    def list_generations(project_id: str) -> Response:
+        project = project_or_404(project_id)
+        if not project:
+            return jsonify({"success": False, "error": "项目不存在"}), 404
+        try:
+            scope = request.args.get("scope", "active")
+            if scope not in {"active", "history"}:
+                raise ValueError("scope 只能是 active 或 history")
+            limit = int(request.args.get("limit", GENERATION_PAGE_SIZE))
+            if not 1 <= limit <= MAX_GENERATION_PAGE_SIZE:
+                raise ValueError(f"limit 必须在 1–{MAX_GENERATION_PAGE_SIZE} 之间")
+            cursor = request.args.get("cursor", "")
+            after = tuple(int(part) for part in cursor.split(":")) if cursor else None
+            if after is not None and len(after) != 2:
+                raise ValueError("无效的 cursor")
+        except ValueError as exc:
+            return jsonify({"success": False, "error": str(exc)}), 400
+        rows = database.generation_page(project_id, scope == "active", after, limit + 1)
+        page = rows[:limit]
+        return jsonify(
+            {
+                "success": True,
+                "generations": page,
+                "next_cursor": (
+                    f"{page[-1]['position']}:{page[-1]['version']}"
+                    if len(rows) > limit
+                    else None
+                ),
+            }
+        )
+
+    @app.get("/api/projects/<project_id>/generations/<generation_id>")
+    def get_generation(project_id: str, generation_id: str) -> Response:
+        project = project_or_404(project_id)
+        if not project:
+            return jsonify({"success": False, "error": "项目不存在"}), 404
+        generation = database.get_generation(project_id, generation_id)
+        if not generation:
+            return jsonify({"success": False, "error": "版本不存在"}), 404
+        return jsonify({"success": True, "generation": generation})
+
+    @app.get("/api/projects/<project_id>/export")
+    def export_project(project_id: str) -> Response:
+        project = project_or_404(project_id)
+        if not project:
+            return jsonify({"success": False, "error": "项目不存在"}), 404
+        generated = "\n\n".join(
+            f"## 续写 {index}\n\n{item['content']}"
+            for index, item in enumerate(database.active_generations(project_id), start=1)
+        )
+        document = f"# {project['title']}\n\n## 原文\n\n{project['original_text']}\n\n{generated}\n"
+        filename = re.sub(r'[\\/:*?"<>|]', "_", project["title"]) + ".md"
+        return Response(
+            document,
+            mimetype="text/markdown",
+            headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"},
+        )
+
+    @app.get("/api/projects/<project_id>/generations/<generation_id>/review")
+    def generation_review(project_id: str, generation_id: str) -> Response:
+        project = project_or_404(project_id)
+        if not project:
+            return jsonify({"success": False, "error": "项目不存在"}), 404
+        generation = database.get_generation(project_id, generation_id)
+        if not generation:
+            return jsonify({"success": False, "error": "版本不存在"}), 404
+        return jsonify(
+            {
+                "success": True,
+                "pending": (
+                    not generation["consistency_report"]
+                    and service.has_pending_work(project_id)
+                ),
+                "consistency_report": generation["consistency_report"],
+            }
+        )
+
     @app.post("/api/projects/<project_id>/restore/<generation_id>")
     def restore_version(project_id: str, generation_id: str) -> Response:
         project = project_or_404(project_id)
         if not project:
             return jsonify({"success": False, "error": "项目不存在"}), 404
-        restored = database.restore_generation(project_id, generation_id)
+        try:
+            restored = service.restore_generation(project_id, _owner_token(), generation_id)
+        except TimeoutError as exc:
+            return jsonify({"success": False, "error": str(exc)}), 409
         if not restored:
             return jsonify({"success": False, "error": "版本不存在"}), 404
         return jsonify({"success": True, "generation": restored})
@@ -265,6 +414,8 @@ def create_app(
     @app.delete("/api/projects/<project_id>")
     def clear_project(project_id: str) -> Response:
         deleted = database.delete_project(project_id, _owner_token())
+        if deleted:
+            service.forget_project(project_id)
         status = 200 if deleted else 404
         return jsonify({"success": deleted}), status
 
@@ -22,6 +22,15 @@ MEMORY_RESPONSE = json.dumps(
 )
 
 
+MEMORY_PATCH_RESPONSE = json.dumps(
+    {
+        "set": {"current_scene": "林舟推开了门"},
+        "add": {"timeline": ["林舟推开旧宅大门"]},
+    },
+    ensure_ascii=False,
+)
+
+
 class SmartFakeAgent:
     def __init__(self, kind: str):
         self.kind = kind
@@ -35,6 +44,8 @@ class SmartFakeAgent:
         if self.kind == "summary":
             if "检查新续写" in prompt:
                 output = "未发现明显一致性问题"
+            elif "JSON 补丁" in prompt:
+                output = MEMORY_PATCH_RESPONSE
             else:
                 output = MEMORY_RESPONSE
         elif "拟定一个简短" in prompt:
@@ -97,4 +108,26 @@ def create_project(client, text="林舟站在旧宅门前。", **fields):
 def consume_stream(client, url: str) -> str:
     response = client.get(url, buffered=True)
     assert response.status_code == 200
-    return response.get_data(as_text=True)
+    data = response.get_data(as_text=True)
+    client.application.extensions["novel_service"].wait_idle(timeout=10)
+    return data
+
+
+def generations(client, project_id: str, scope: str = "active", limit: int = 50) -> list[dict]:
+    """Every generation of a project with its text, following the page cursors."""
+    items: list[dict] = []
+    cursor = ""
+    while True:
+        body = client.get(
+            f"/api/projects/{project_id}/generations",
+            query_string={"scope": scope, "cursor": cursor, "limit": limit},
+        ).get_json()
+        for item in body["generations"]:
+            items.append(
+                client.get(f"/api/projects/{project_id}/generations/{item['id']}").get_json()[
+                    "generation"
+                ]
+            )
+        cursor = body["next_cursor"]
+        if not cursor:
+            return items
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+import pytest
+
+from novel_app.balancer import Endpoint, EndpointGroup
+from novel_app.llm import _astream_agent, _stream_agent
+from novel_app.openai_client import ModelServerError
+
+
+class DeltaAgent:
+    def __init__(self, chunks=("林舟", "推开了门。"), error=None, delay=0.0, fail_after=None):
+        self.chunks = chunks
+        self.error = error
+        self.delay = delay
+        self.fail_after = fail_after
+        self.calls = 0
+
+    def stream_deltas(self, messages):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        for index, chunk in enumerate(self.chunks):
+            if index == self.fail_after:
+                raise ConnectionResetError("连接中断")
+            yield chunk
+
+
+def group(*agents, weights=None, **settings) -> EndpointGroup:
+    weights = weights or [1] * len(agents)
+    endpoints = [
+        Endpoint(f"server-{index}", agent, weight)
+        for index, (agent, weight) in enumerate(zip(agents, weights))
+    ]
+    return EndpointGroup(
+        endpoints, _stream_agent, _astream_agent, sleep=lambda seconds: None, **settings
+    )
+
+
+def test_requests_go_to_least_outstanding_endpoint_per_weight():
+    balancer = group(DeltaAgent(), DeltaAgent(), weights=[1, 3])
+
+    picked = [balancer._acquire([]).label for _ in range(4)]
+
+    assert picked.count("server-1") == 3
+    assert picked.count("server-0") == 1
+
+
+def test_retryable_failure_fails_over_and_cools_endpoint_down():
+    broken = DeltaAgent(error=ModelServerError(503, "busy"))
+    balancer = group(broken, DeltaAgent())
+
+    assert "".join(balancer.stream([])) == "林舟推开了门。"
+    assert "".join(balancer.stream([])) == "林舟推开了门。"
+
+    assert broken.calls == 1
+    health = {item["endpoint"]: item for item in balancer.health()}
+    assert health["server-0"]["healthy"] is False
+    assert health["server-0"]["failures"] == 1
+    assert health["server-1"]["requests"] == 2
+
+
+def test_client_errors_and_interrupted_streams_are_not_retried():
+    rejected = DeltaAgent(error=ModelServerError(400, "bad request"))
+    with pytest.raises(ModelServerError):
+        "".join(group(rejected, DeltaAgent()).stream([]))
+    assert rejected.calls == 1
+
+    interrupted = DeltaAgent(fail_after=1)
+    with pytest.raises(ConnectionResetError):
+        "".join(group(interrupted).stream([]))
+    assert interrupted.calls == 1
+
+
+def test_slow_first_chunk_is_hedged_on_another_endpoint():
+    slow = DeltaAgent(chunks=("慢",), delay=0.5)
+    fast = DeltaAgent(chunks=("快", "速"))
+    balancer = group(slow, fast, hedge=True, hedge_min_delay_seconds=0.05)
+    balancer.endpoints[0].first_chunk_seconds.extend([0.01] * 10)
+    balancer.endpoints[1].outstanding = 1
+
+    started = time.monotonic()
+    assert "".join(balancer.stream([])) == "快速"
+
+    assert time.monotonic() - started < 0.4
+    health = {item["endpoint"]: item for item in balancer.health()}
+    assert health["server-1"]["hedges"] == 1
+    assert health["server-1"]["hedge_wins"] == 1
+
+
+class FailingAsyncAgent:
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    async def astream_deltas(self, messages):
+        await asyncio.sleep(self.delay)
+        raise ModelServerError(503, "busy")
+        yield ""
+
+
+def test_async_hedge_survives_a_failing_primary():
+    balancer = group(
+        FailingAsyncAgent(0.1),
+        DeltaAgent(chunks=("快", "速"), delay=0.3),
+        hedge=True,
+        hedge_min_delay_seconds=0.05,
+    )
+    balancer.endpoints[0].first_chunk_seconds.extend([0.01] * 10)
+
+    async def collect():
+        return "".join([chunk async for chunk in balancer.astream([])])
+
+    assert asyncio.run(collect()) == "快速"
+    health = {item["endpoint"]: item for item in balancer.health()}
+    assert health["server-0"]["failures"] == 1
+    assert health["server-1"]["hedge_wins"] == 1
+    assert all(item["outstanding"] == 0 for item in health.values())
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import asyncio
+
+from novel_app.cache import ResponseCache, SummaryCache, response_key
+from novel_app.database import NovelDatabase
+from novel_app.llm import AgentGateway
+
+from .conftest import consume_stream, create_project
+
+
+def test_summary_cache_evicts_least_recently_used(tmp_path):
+    cache = SummaryCache(NovelDatabase(str(tmp_path / "cache.db")), max_bytes=20)
+    cache.put_many({"a": "1234567890"}, "model", "v1")
+    cache.put_many({"b": "1234567890"}, "model", "v1")
+    assert cache.get_many(["a"], "model", "v1") == {"a": "1234567890"}
+
+    cache.put_many({"c": "1234567890"}, "model", "v1")
+
+    assert cache.get_many(["a", "b", "c"], "model", "v1").keys() == {"a", "c"}
+    assert cache.get_many(["a"], "other-model", "v1") == {}
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 3
+    assert stats["misses"] == 2
+    assert stats["entries"] == 2
+
+
+def test_reuploaded_novel_reuses_chunk_summaries(client, app):
+    text = "林舟沿着走廊前进。" * 30
+    consume_stream(client, f"/stream/{create_project(client, text=text)}")
+    summary = app.extensions["fake_summary"]
+    first_build = [call for call in summary.calls if "个分块" in call]
+
+    consume_stream(client, f"/stream/{create_project(client, text=text)}")
+
+    assert len([call for call in summary.calls if "个分块" in call]) == len(first_build)
+    assert app.extensions["summary_cache"].stats()["hits"] >= len(first_build)
+
+
+def test_response_cache_has_memory_and_disk_tiers_with_ttl(tmp_path):
+    database = NovelDatabase(str(tmp_path / "cache.db"))
+    cache = ResponseCache(database, max_bytes=20, ttl_seconds=60, memory_entries=1)
+    cache.put("a", "summary_bot", "1234567890")
+    cache.put("b", "summary_bot", "1234567890")
+
+    assert cache.get("b") == "1234567890"
+    assert cache.get("a") == "1234567890"
+    cache.put("c", "summary_bot", "1234567890")
+    assert cache.get("b") is None
+    assert cache.stats()["memory_hits"] == 1
+
+    restarted = ResponseCache(database, max_bytes=20, ttl_seconds=60)
+    assert restarted.get("a") == "1234567890"
+    expired = ResponseCache(database, max_bytes=20, ttl_seconds=1e-9)
+    assert expired.get("a") is None
+
+
+def test_gateway_caches_only_enabled_bots(tmp_path, app):
+    summary = app.extensions["fake_summary"]
+    writing = app.extensions["fake_writing"]
+    llm_config = {
+        "summary_bot": {"model": "m", "response_cache": True, "generate_cfg": {"top_p": 0.9}},
+        "writing_bot": {"model": "m", "generate_cfg": {"top_p": 0.9}},
+    }
+    gateway = AgentGateway(
+        llm_config,
+        {"summary_instruction": "总结", "writing_instruction": "写作"},
+        agents={"summary_bot": summary, "writing_bot": writing},
+        response_cache=ResponseCache(
+            NovelDatabase(str(tmp_path / "cache.db")), max_bytes=1_000, ttl_seconds=60
+        ),
+    )
+
+    first = gateway.call("summary_bot", "检查新续写")
+    assert gateway.call("summary_bot", "检查新续写") == first
+    assert asyncio.run(gateway.acall("summary_bot", "检查新续写")) == first
+    gateway.call("writing_bot", "拟定一个简短计划")
+    gateway.call("writing_bot", "拟定一个简短计划")
+    assert len(summary.calls) == 1
+    assert len(writing.calls) == 2
+
+    llm_config["summary_bot"]["generate_cfg"] = {"top_p": 0.5}
+    gateway.call("summary_bot", "检查新续写")
+    assert len(summary.calls) == 2
+    assert response_key("a", "m", {}, "s", "p") != response_key("b", "m", {}, "s", "p")
@@ -121,3 +121,28 @@ def test_empty_environment_values_fall_back_to_dotenv(tmp_path, monkeypatch):
     assert summary["model_server"] == "https://dotenv.example/v1"
     assert summary["api_key"] == "dotenv-key"
     assert config["app_config"]["secret_key"] == "dotenv-secret"
+
+
+def test_endpoints_resolve_environment_and_inherit_bot_values(tmp_path, monkeypatch):
+    config_path = tmp_path / "config.json"
+    write_config(config_path)
+    data = json.loads(config_path.read_text(encoding="utf-8"))
+    data["llm_config"]["writing_bot"]["endpoints"] = [
+        {"model_server": "https://primary.example/v1", "weight": 3},
+        {"model_server_env": "TEST_BACKUP_SERVER", "api_key": "backup-key"},
+    ]
+    config_path.write_text(json.dumps(data), encoding="utf-8")
+    monkeypatch.setenv("TEST_BACKUP_SERVER", "https://backup.example/v1")
+
+    config = load_config(config_path)
+
+    primary, backup = config["llm_config"]["writing_bot"]["endpoints"]
+    assert primary == {
+        "model_server": "https://primary.example/v1",
+        "model": "writing-model",
+        "api_key": "writing-key",
+        "weight": 3.0,
+    }
+    assert backup["model_server"] == "https://backup.example/v1"
+    assert backup["api_key"] == "backup-key"
+    assert backup["weight"] == 1.0
@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import json
+
+from novel_app.database import SNAPSHOT_KEYFRAME_INTERVAL, NovelDatabase
+
+
+def test_memory_snapshots_are_stored_as_bounded_delta_chains(tmp_path):
+    database = NovelDatabase(str(tmp_path / "novels.db"))
+    project = database.create_project("owner", "旧宅", "原文", "", 1000, "quick")
+    memories = [
+        {"overview": "旧宅", "timeline": [f"事件{step}"], "characters": []}
+        for step in range(SNAPSHOT_KEYFRAME_INTERVAL * 2)
+    ]
+    snapshot_id = database.save_memory_snapshot(project["id"], 0, None, memories[0])
+    for position, memory in enumerate(memories[1:], start=1):
+        snapshot_id = database.save_memory_snapshot(
+            project["id"], position, f"g{position}", memory, snapshot_id
+        )
+
+    for position, memory in enumerate(memories[1:], start=1):
+        assert database.memory_snapshot(project["id"], position, f"g{position}")[1] == memory
+    assert database.memory_snapshot(project["id"], 0, None)[1] == memories[0]
+
+    with database.connect() as connection:
+        rows = connection.execute(
+            "SELECT depth, delta_json FROM memory_snapshots ORDER BY id"
+        ).fetchall()
+    assert max(row["depth"] for row in rows) < SNAPSHOT_KEYFRAME_INTERVAL
+    assert "overview" not in json.loads(rows[1]["delta_json"])["set"]
+
+
+def test_connections_are_pooled_and_nested_blocks_share_a_transaction(tmp_path):
+    database = NovelDatabase(str(tmp_path / "novels.db"))
+    with database.connect() as first:
+        assert first.execute("PRAGMA synchronous").fetchone()[0] == 1
+    with database.connect() as second:
+        assert second is first
+
+    try:
+        with database.connect() as connection:
+            database.create_project("owner", "旧宅", "原文", "", 1000, "quick")
+            assert connection.execute("SELECT COUNT(*) FROM projects").fetchone()[0] == 1
+            raise RuntimeError("中断")
+    except RuntimeError:
+        pass
+    assert database.list_projects("owner") == []
+
+    database.close()
+    with database.connect() as reopened:
+        assert reopened is not first
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from novel_app.llm import AgentGateway
+
+
+class ChatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests: list[tuple[dict, dict]] = []
+    deltas = ["林舟", "握紧钥匙，", "推开了门。"]
+    status = 200
+    chunked = False
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        type(self).requests.append((dict(self.headers), body))
+        if self.status != 200:
+            payload = b'{"error": "overloaded"}'
+            self.send_response(self.status)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        events = [
+            {"choices": [{"index": 0, "delta": {"content": delta}}]}
+            for delta in self.deltas
+        ]
+        payload = "".join(
+            f"data: {json.dumps(event, ensure_ascii=False)}\n\n" for event in events
+        ).encode() + b"data: [DONE]\n\n"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        if not self.chunked:
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for start in range(0, len(payload), 7):
+            piece = payload[start:start + 7]
+            self.wfile.write(f"{len(piece):x}\r\n".encode() + piece + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def chat_server():
+    ChatHandler.requests = []
+    ChatHandler.status = 200
+    ChatHandler.chunked = False
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ChatHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/v1"
+    server.shutdown()
+    server.server_close()
+
+
+def openai_gateway(server: str) -> AgentGateway:
+    bot = {
+        "model": "test-model",
+        "model_server": server,
+        "api_key": "secret",
+        "backend": "openai",
+        "context_window": 128000,
+        "balancing": {"backoff_seconds": 0},
+        "generate_cfg": {"temperature": 0.7, "max_tokens": 100},
+    }
+    return AgentGateway(
+        {"summary_bot": dict(bot), "writing_bot": dict(bot)},
+        {"summary_instruction": "总结", "writing_instruction": "写作"},
+    )
+
+
+def test_openai_backend_forwards_server_deltas(chat_server):
+    gateway = openai_gateway(chat_server)
+
+    assert list(gateway.stream("writing_bot", "续写")) == ChatHandler.deltas
+    assert gateway.call("summary_bot", "总结一下") == "林舟握紧钥匙，推开了门。"
+
+    headers, body = ChatHandler.requests[0]
+    assert headers["Authorization"] == "Bearer secret"
+    assert body["stream"] is True
+    assert body["model"] == "test-model"
+    assert body["temperature"] == 0.7
+    assert "context_window" not in body and "backend" not in body
+    assert body["messages"] == [
+        {"role": "system", "content": "写作"},
+        {"role": "user", "content": "续写"},
+    ]
+
+
+def test_openai_backend_retries_and_reports_http_errors(chat_server):
+    ChatHandler.status = 503
+    gateway = openai_gateway(chat_server)
+
+    with pytest.raises(RuntimeError, match="HTTP 503"):
+        gateway.call("writing_bot", "续写")
+    assert len(ChatHandler.requests) == 3
+    assert gateway.endpoint_health()["writing_bot"][0]["failures"] == 3
+
+
+def test_bots_share_one_keep_alive_pool_per_endpoint(chat_server):
+    gateway = openai_gateway(chat_server)
+    gateway.llm_config["writing_bot"]["transport"] = {"pool_size": 2}
+    gateway.llm_config["summary_bot"]["transport"] = {"pool_size": 2}
+
+    for _ in range(3):
+        gateway.call("writing_bot", "续写")
+        gateway.call("summary_bot", "总结")
+
+    stats = gateway.transport_stats()
+    assert len(stats) == 1
+    pool = next(iter(stats.values()))
+    assert pool["pool_size"] == 2
+    assert pool["created"] == 1
+    assert pool["reused"] == 5
+    assert pool["in_use"] == 0 and pool["idle"] == 1
+
+
+def test_pool_waits_when_all_connections_are_busy(chat_server):
+    gateway = openai_gateway(chat_server)
+    gateway.llm_config["writing_bot"]["transport"] = {"pool_size": 1}
+    gateway.llm_config["summary_bot"]["transport"] = {"pool_size": 1}
+    first = gateway.stream("writing_bot", "续写")
+    assert next(first) == "林舟"
+
+    second = threading.Thread(target=gateway.call, args=("summary_bot", "总结"))
+    second.start()
+    second.join(timeout=0.2)
+    assert second.is_alive()
+    assert "".join(first) == "握紧钥匙，推开了门。"
+    second.join(timeout=5)
+
+    pool = next(iter(gateway.transport_stats().values()))
+    assert pool["waits"] == 1 and pool["peak_in_use"] == 1
+
+
+def test_pool_wait_is_bounded_and_pools_follow_bot_settings(chat_server):
+    gateway = openai_gateway(chat_server)
+    gateway.llm_config["writing_bot"]["transport"] = {"pool_size": 1, "connect_timeout": 0.1}
+    gateway.llm_config["summary_bot"]["transport"] = {"pool_size": 3}
+    first = gateway.stream("writing_bot", "续写")
+    assert next(first) == "林舟"
+
+    pool = gateway._group("writing_bot").endpoints[0].agent.pool
+    with pytest.raises(TimeoutError):
+        pool.acquire()
+    assert gateway.call("summary_bot", "总结") == "林舟握紧钥匙，推开了门。"
+    first.close()
+
+    stats = gateway.transport_stats()
+    assert sorted(pool["pool_size"] for pool in stats.values()) == [1, 3]
+    assert all("pool_size=" in name for name in stats)
+    assert pool.stats()["wait_timeouts"] == 1
+
+
+def test_async_stream_reads_sized_and_chunked_responses(chat_server):
+    gateway = openai_gateway(chat_server)
+
+    async def collect():
+        return [chunk async for chunk in gateway.astream("writing_bot", "续写")]
+
+    assert asyncio.run(collect()) == ChatHandler.deltas
+    ChatHandler.chunked = True
+    assert asyncio.run(collect()) == ChatHandler.deltas
+    assert asyncio.run(gateway.acall("summary_bot", "总结")) == "林舟握紧钥匙，推开了门。"
+    assert ChatHandler.requests[-1][1]["messages"][0] == {"role": "system", "content": "总结"}
+
+
+def test_async_calls_share_the_keep_alive_pool(chat_server):
+    gateway = openai_gateway(chat_server)
+    ChatHandler.chunked = True
+
+    async def run():
+        for _ in range(3):
+            assert [chunk async for chunk in gateway.astream("writing_bot", "续写")] == (
+                ChatHandler.deltas
+            )
+        return await gateway.acall("summary_bot", "总结")
+
+    assert asyncio.run(run()) == "林舟握紧钥匙，推开了门。"
+    pool = next(iter(gateway.transport_stats().values()))
+    assert pool["created"] == 1 and pool["reused"] == 3
+    assert pool["in_use"] == 0 and pool["idle"] == 1
+    port = chat_server.split(":")[2].split("/")[0]
+    assert ChatHandler.requests[0][0]["Host"] == f"127.0.0.1:{port}"
+    assert "Connection" not in ChatHandler.requests[0][0]
+
+
+def test_async_pool_waits_for_a_slot_without_blocking_the_loop(chat_server):
+    gateway = openai_gateway(chat_server)
+    gateway.llm_config["writing_bot"]["transport"] = {"pool_size": 1}
+    gateway.llm_config["summary_bot"]["transport"] = {"pool_size": 1}
+
+    async def run():
+        return await asyncio.gather(
+            *(gateway.acall("writing_bot", "续写") for _ in range(3)),
+            asyncio.sleep(0),
+        )
+
+    assert asyncio.run(run())[:3] == ["林舟握紧钥匙，推开了门。"] * 3
+    pool = next(iter(gateway.transport_stats().values()))
+    assert pool["waits"] == 2 and pool["peak_in_use"] == 1 and pool["in_use"] == 0
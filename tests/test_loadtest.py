@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from novel_app.loadtest import format_report, percentile, run_load
+from novel_app.mock_llm import MockLLMServer, classify
+
+
+@pytest.fixture()
+def mock_server():
+    server = MockLLMServer(ttft_seconds=0, tokens_per_second=10_000, prose_chars=50).start()
+    yield server
+    server.stop()
+
+
+def post(server: MockLLMServer, prompt: str, stream: bool) -> urllib.request.Request:
+    body = {"model": "m", "stream": stream, "messages": [{"role": "user", "content": prompt}]}
+    return urllib.request.Request(
+        f"{server.url}/chat/completions",
+        data=json.dumps(body, ensure_ascii=False).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+
+
+def test_mock_server_streams_canned_outputs_and_injects_errors(mock_server):
+    assert classify([{"role": "user", "content": "请只输出 JSON"}]) == "memory"
+    assert classify([{"role": "user", "content": "输出 JSON 补丁"}]) == "patch"
+    assert classify([{"role": "user", "content": "续写下一段"}]) == "prose"
+
+    with urllib.request.urlopen(post(mock_server, "续写", stream=True)) as response:
+        lines = [line for line in response.read().decode().split("\n\n") if line]
+    assert lines[-1] == "data: [DONE]"
+    text = "".join(
+        json.loads(line[6:])["choices"][0]["delta"]["content"] for line in lines[:-1]
+    )
+    assert len(text) == 50
+
+    with urllib.request.urlopen(post(mock_server, "拟定一个简短的计划", stream=False)) as response:
+        message = json.loads(response.read())["choices"][0]["message"]["content"]
+    assert message == mock_server.outputs["plan"]
+
+    mock_server.error_rate = 1.0
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(post(mock_server, "续写", stream=True))
+    assert error.value.code == 503
+    assert mock_server.counters == {"requests": 3, "errors": 1}
+
+
+def test_load_run_reports_every_stage():
+    report = run_load(
+        sessions=3,
+        continues=1,
+        text_chars=3_000,
+        ttft_seconds=0.01,
+        tokens_per_second=5_000,
+        prose_chars=120,
+    )
+
+    assert report["errors"] == 0
+    stages = report["stages"]
+    assert [stages[name]["count"] for name in ("process", "stream", "continue")] == [3, 3, 3]
+    assert stages["stream"]["ttft_ms"]["p50"] > 0
+    assert stages["continue"]["latency_ms"]["p99"] >= stages["continue"]["latency_ms"]["p50"]
+    assert report["mock"]["requests"] > 6
+    assert "stream" in format_report(report)
+    assert percentile([3, 1, 2, 4], 50) == 2
+    assert percentile([], 95) is None
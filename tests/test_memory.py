@@ -1,4 +1,18 @@
-from novel_app.memory import parse_memory, split_text
+import json
+import re
+import threading
+import time
+
+import pytest
+
+from novel_app.memory import (
+    MemoryManager,
+    MemoryPatchError,
+    apply_memory_patch,
+    parse_memory,
+    parse_memory_patch,
+    split_text,
+)
 
 
 def test_split_text_respects_chunk_limit():
@@ -24,3 +38,195 @@ def test_context_budget_keeps_global_memory_and_recent_end(app):
     assert "必须保留的全局记忆" in context
     assert "必须保留的结尾" in context
     assert "续写" in context
+
+
+class RecordingGateway:
+    def __init__(self, delay: float = 0.02):
+        self.delay = delay
+        self.active = 0
+        self.peak = 0
+        self.prompts: list[str] = []
+        self.merges = 0
+        self.guard = threading.Lock()
+
+    def call(self, name: str, text: str) -> str:
+        with self.guard:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            self.prompts.append(text)
+        time.sleep(self.delay)
+        with self.guard:
+            self.active -= 1
+        match = re.search(r"第 (\d+)/\d+ 个分块", text)
+        if match:
+            label = match.group(1)
+        else:
+            with self.guard:
+                self.merges += 1
+                label = f"合并{self.merges}"
+        return json.dumps({"overview": label}, ensure_ascii=False)
+
+
+def memory_manager(gateway, **overrides) -> MemoryManager:
+    config = {
+        "text_length_threshold": 100,
+        "summary_chunk_chars": 40,
+        "recent_context_chars": 50,
+        "context_char_budget": 300,
+        "style_sample_chars": 30,
+        "max_inflight_calls": {"summary_bot": 3},
+    }
+    config.update(overrides)
+    return MemoryManager(gateway, config)
+
+
+def test_cache_friendly_context_puts_stable_sections_first(app):
+    manager = app.extensions["novel_service"].memory
+    original = "开头" + "原文" * 300 + "必须保留的结尾"
+    memory = {"overview": "每段都会变化的记忆", "characters": []}
+    first = manager.context_for(original, ["续写一"], memory, layout="cache_friendly")
+    second = manager.context_for(
+        original, ["续写一", "续写二" * 20], memory, layout="cache_friendly"
+    )
+
+    assert first.index("【原文结尾") < first.index("【已经接受") < first.index("【全局结构化记忆】")
+    original_section = first.split("【已经接受")[0]
+    assert second.startswith(original_section + "【已经接受的近期续写内容】\n续写一")
+
+
+def test_chunk_summaries_run_concurrently_and_keep_order():
+    gateway = RecordingGateway()
+    manager = memory_manager(gateway)
+    manager.build_memory("\n\n".join(f"第{index}段" + "文" * 30 for index in range(8)))
+
+    assert gateway.peak == 3
+    merge_prompt = gateway.prompts[-1]
+    positions = [merge_prompt.index(f'"overview": "{index}"') for index in range(1, 9)]
+    assert positions == sorted(positions)
+
+
+def test_large_novels_merge_in_bounded_groups():
+    gateway = RecordingGateway(delay=0)
+    manager = memory_manager(gateway, summary_merge_fan_in=4)
+    memory = manager.build_memory("\n\n".join("文" * 35 for _ in range(20)))
+
+    merge_prompts = [prompt for prompt in gateway.prompts if "合并成一份全局" in prompt]
+    assert len(merge_prompts) == 5 + 1 + 1
+    assert all(prompt.count("分块 ") <= 4 for prompt in merge_prompts)
+    assert memory["overview"] == "合并7"
+
+
+def test_memory_tree_only_resummarizes_new_tail():
+    gateway = RecordingGateway(delay=0)
+    manager = memory_manager(gateway, summary_merge_fan_in=4)
+    text = "\n\n".join(f"{index:02d}" + "文" * 33 for index in range(20))
+    _, tree = manager.build_memory_tree(text)
+
+    assert not manager.tree_is_stale(text + "\n\n短", tree)
+    assert memory_manager(gateway, summary_merge_fan_in=8).tree_is_stale(text, tree)
+    assert memory_manager(
+        gateway, summary_merge_fan_in=4, summary_chunk_overlap=5
+    ).tree_is_stale(text, tree)
+    extended = text + "\n\n" + "\n\n".join(f"{index:02d}" + "新" * 33 for index in range(2))
+    assert manager.tree_is_stale(extended, tree)
+
+    gateway.prompts.clear()
+    memory, updated = manager.build_memory_tree(extended, tree)
+
+    leaf_prompts = [prompt for prompt in gateway.prompts if "个分块" in prompt]
+    merge_prompts = [prompt for prompt in gateway.prompts if "合并成一份全局" in prompt]
+    assert len(leaf_prompts) == 3
+    assert len(merge_prompts) == 3
+    assert len(updated["leaves"]) == 22
+    assert updated["leaves"][-1]["end"] == len(extended)
+    assert memory["overview"].startswith("合并")
+
+
+def test_memory_patch_adds_updates_and_removes_entries():
+    memory = parse_memory(json.dumps({
+        "overview": "旧概述",
+        "characters": [{"name": "林舟", "status": "迷路"}],
+        "timeline": ["进入旧宅"],
+        "open_threads": ["钥匙的来源", "井底的铃声"],
+    }, ensure_ascii=False))
+    patch = parse_memory_patch(json.dumps({
+        "set": {"current_scene": "书房"},
+        "add": {"timeline": ["进入旧宅", "找到账本"]},
+        "update": {
+            "characters": [{"name": "林舟", "status": "受伤"}],
+            "open_threads": [{"old": "井底的铃声", "new": "井底的铃声来自画师"}],
+        },
+        "remove": {"open_threads": ["钥匙的来源"]},
+    }, ensure_ascii=False))
+
+    updated = apply_memory_patch(memory, patch)
+
+    assert updated["current_scene"] == "书房"
+    assert updated["overview"] == "旧概述"
+    assert updated["timeline"] == ["进入旧宅", "找到账本"]
+    assert updated["characters"] == [{"name": "林舟", "status": "受伤"}]
+    assert updated["open_threads"] == ["井底的铃声来自画师"]
+    assert memory["open_threads"] == ["钥匙的来源", "井底的铃声"]
+
+
+def test_invalid_patch_falls_back_to_full_update():
+    with pytest.raises(MemoryPatchError):
+        parse_memory_patch('{"add": {"overview": "不是列表"}}')
+
+    class PatchGateway(RecordingGateway):
+        def call(self, name, text):
+            self.prompts.append(text)
+            if "JSON 补丁" in text:
+                return "无法输出补丁"
+            return json.dumps({"overview": "完整更新"}, ensure_ascii=False)
+
+    gateway = PatchGateway()
+    updated = memory_manager(gateway).update_memory({"overview": "旧"}, "新段落")
+
+    assert updated["overview"] == "完整更新"
+    assert len(gateway.prompts) == 2
+
+
+def test_memory_patch_normalizes_list_fields_of_other_shapes():
+    memory = {
+        "characters": {"林舟": {"status": "迷路"}, "管家": "闪躲"},
+        "timeline": "进入旧宅",
+        "open_threads": None,
+    }
+    patch = parse_memory_patch(json.dumps({
+        "add": {"timeline": ["找到账本"], "open_threads": ["井底的铃声"]},
+        "update": {"characters": [{"name": "林舟", "status": "受伤"}]},
+    }, ensure_ascii=False))
+
+    updated = apply_memory_patch(memory, patch)
+
+    assert updated["characters"] == [
+        {"name": "林舟", "status": "受伤"},
+        {"name": "管家", "description": "闪躲"},
+    ]
+    assert updated["timeline"] == ["进入旧宅", "找到账本"]
+    assert updated["open_threads"] == ["井底的铃声"]
+
+    with pytest.raises(MemoryPatchError):
+        parse_memory_patch('{"set": {"timeline": "不是列表"}}')
+    with pytest.raises(MemoryPatchError):
+        apply_memory_patch(memory, {"set": {"characters": "林舟"}})
+
+
+def test_patch_apply_failure_falls_back_to_full_update(monkeypatch):
+    class PatchGateway(RecordingGateway):
+        def call(self, name, text):
+            self.prompts.append(text)
+            if "JSON 补丁" in text:
+                return '{"add": {"timeline": ["新事件"]}}'
+            return json.dumps({"overview": "完整更新"}, ensure_ascii=False)
+
+    def broken(memory, patch):
+        raise KeyError("timeline")
+
+    monkeypatch.setattr("novel_app.memory.apply_memory_patch", broken)
+    gateway = PatchGateway()
+    updated = memory_manager(gateway).update_memory({"timeline": "旧"}, "新段落")
+
+    assert updated["overview"] == "完整更新"
+    assert len(gateway.prompts) == 2
@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+from novel_app.metrics import Histogram, MetricsRegistry, current_stage
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("demo_seconds", "Demo.", ("stage",), (0.5, 1))
+    for value in (0.2, 0.7, 3):
+        histogram.observe(value, 'pl"an')
+
+    assert histogram.render() == [
+        "# HELP demo_seconds Demo.",
+        "# TYPE demo_seconds histogram",
+        'demo_seconds_bucket{stage="pl\\"an",le="0.5"} 1',
+        'demo_seconds_bucket{stage="pl\\"an",le="1"} 2',
+        'demo_seconds_bucket{stage="pl\\"an",le="+Inf"} 3',
+        'demo_seconds_sum{stage="pl\\"an"} 3.9',
+        'demo_seconds_count{stage="pl\\"an"} 3',
+    ]
+
+
+def test_stage_attributes_calls_to_the_current_run():
+    metrics = MetricsRegistry()
+    run = metrics.start_run()
+    with metrics.stage("plan"):
+        assert current_stage() == "plan"
+        metrics.observe_call("writing_bot", "提示词", "计划", 0.4, 0.1)
+    assert current_stage() == "other"
+
+    summary = run.summary()
+    assert summary["slowest_call"] == "plan"
+    assert summary["llm_calls"][0]["prompt_chars"] == 3
+    assert set(summary["stages_ms"]) == {"plan"}
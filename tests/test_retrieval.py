@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import zlib
+
+import pytest
+
+from novel_app.retrieval import PassageIndex, passage_spans, terms
+
+
+NOVEL = "\n".join(
+    [
+        "林舟第一次来到旧宅，门口挂着一盏青铜风灯。",
+        "雨夜里，他听见井底传来铃声。",
+        "管家说起十年前失踪的画师，语气闪躲。",
+    ]
+    + [f"第{index}天，林舟整理书房里的旧账本。" for index in range(40)]
+)
+
+
+def test_terms_are_character_bigrams():
+    assert terms("青铜风灯 ok") == ["青铜", "铜风", "风灯", "ok"]
+
+
+def test_passage_spans_cover_lines_within_limit():
+    spans = passage_spans(NOVEL, 60)
+    assert all(end - start <= 60 for start, end in spans)
+    assert NOVEL[spans[0][0]:spans[0][1]].startswith("林舟第一次")
+
+
+def test_bm25_finds_relevant_passage_and_survives_persistence():
+    index = PassageIndex.from_bytes(PassageIndex.build(NOVEL, 40).to_bytes())
+    start, end = index.search("青铜风灯忽然亮了", top_k=1)[0]
+    assert "青铜风灯" in NOVEL[start:end]
+    assert index.search("青铜风灯", top_k=3, before=10) == []
+
+
+def test_context_includes_retrieved_passages(app):
+    manager = app.extensions["novel_service"].memory
+    context = manager.context_for(
+        NOVEL,
+        [],
+        {"current_scene": "林舟提着青铜风灯走向井边", "open_threads": ["失踪的画师"]},
+        manager.build_index(NOVEL),
+    )
+    assert "【与当前情节相关的原文片段】" in context
+    assert "青铜风灯" in context
+
+
+def test_stored_index_rejects_other_formats():
+    with pytest.raises(ValueError):
+        PassageIndex.from_bytes(zlib.compress(b'{"spans": []}'))
+    with pytest.raises(ValueError):
+        PassageIndex.from_bytes(b"not an index")
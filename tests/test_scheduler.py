@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from novel_app.scheduler import (
+    BACKGROUND,
+    INTERACTIVE,
+    RequestScheduler,
+    TokenBucket,
+    current_request,
+    run_as,
+)
+
+from .conftest import consume_stream, create_project
+
+
+def scheduler(**bot_limits) -> RequestScheduler:
+    return RequestScheduler({"bots": {"summary_bot": bot_limits, "writing_bot": bot_limits}})
+
+
+def test_waiting_calls_are_fair_across_owners():
+    limiter = scheduler(max_concurrent=1)
+    running = limiter.enqueue("summary_bot", "alice", BACKGROUND)
+    alice = [limiter.enqueue("summary_bot", "alice", BACKGROUND) for _ in range(2)]
+    bob = limiter.enqueue("summary_bot", "bob", BACKGROUND)
+
+    assert running.granted
+    assert bob.position() == 0 and alice[0].position() == 1
+    running.release()
+
+    assert bob.wait(0) and not alice[0].granted
+
+
+def test_interactive_writing_goes_before_background_work():
+    limiter = scheduler(max_concurrent=1)
+    running = limiter.enqueue("writing_bot", "alice", BACKGROUND)
+    speculative = limiter.enqueue("writing_bot", "alice", BACKGROUND)
+    interactive = limiter.enqueue("writing_bot", "alice", INTERACTIVE)
+    other_bot = limiter.enqueue("summary_bot", "alice", BACKGROUND)
+
+    assert other_bot.granted
+    running.release()
+    assert interactive.granted and not speculative.granted
+    interactive.release()
+    assert speculative.wait(0)
+
+
+def test_token_bucket_delays_calls_over_the_rate():
+    bucket = TokenBucket(600)
+    now = time.monotonic()
+    assert bucket.delay(600, now) == 0
+    bucket.take(600)
+    assert 0.9 < bucket.delay(10, now) <= 1.0
+
+
+def test_async_waiters_sleep_until_the_scheduler_wakes_them():
+    limiter = scheduler(max_concurrent=1)
+    running = limiter.enqueue("summary_bot", "alice", BACKGROUND)
+    granted = limiter.enqueue("summary_bot", "bob", BACKGROUND)
+    dropped = limiter.enqueue("summary_bot", "carol", BACKGROUND)
+    dispatches = 0
+    dispatch = limiter._dispatch
+
+    def counting_dispatch():
+        nonlocal dispatches
+        dispatches += 1
+        dispatch()
+
+    limiter._dispatch = counting_dispatch
+
+    async def wait_for_both():
+        return await asyncio.gather(granted.wait_async(5), dropped.wait_async(5))
+
+    threading.Timer(0.2, running.release).start()
+    threading.Timer(0.3, dropped.release).start()
+    started = time.monotonic()
+    results = asyncio.run(wait_for_both())
+
+    assert results == [True, False]
+    assert time.monotonic() - started < 1
+    # One check per waiter before sleeping, one per wake-up, two releases.
+    assert dispatches <= 6
+    assert not granted._async_waiters and not dropped._async_waiters
+
+
+def test_async_waiter_retries_when_the_rate_limit_refills():
+    limiter = scheduler(requests_per_minute=600)
+    for _ in range(600):
+        limiter.enqueue("summary_bot", "alice", BACKGROUND).release()
+    ticket = limiter.enqueue("summary_bot", "alice", BACKGROUND)
+
+    assert not ticket.granted
+    assert asyncio.run(ticket.wait_async(1))
+
+
+def test_background_jobs_run_as_their_owner():
+    assert current_request() == ("", BACKGROUND)
+    assert run_as("alice", INTERACTIVE, current_request) == ("alice", INTERACTIVE)
+    assert current_request() == ("", BACKGROUND)
+
+
+def test_stream_reports_queue_position_while_waiting(client, app, monkeypatch):
+    monkeypatch.setattr("novel_app.service.QUEUE_STATUS_INTERVAL", 0.05)
+    gateway = app.extensions["novel_service"].gateway
+    gateway.scheduler = scheduler(max_concurrent=1)
+    busy = gateway.scheduler.enqueue("writing_bot", "someone-else", INTERACTIVE)
+    threading.Timer(0.3, busy.release).start()
+
+    stream = consume_stream(client, f"/stream/{create_project(client)}")
+
+    assert "正在排队，前面还有 0 个请求" in stream
+    assert '"type": "complete"' in stream
+    assert gateway.scheduler.stats()["running"] == 0
+
+
+def test_failed_plan_call_gives_its_slot_back(client, app, monkeypatch):
+    gateway = app.extensions["novel_service"].gateway
+    gateway.scheduler = scheduler(max_concurrent=1)
+
+    def unconfigured(name):
+        raise ValueError(f"{name} 未配置 model_server")
+
+    monkeypatch.setattr(gateway, "_group", unconfigured)
+    project_id = create_project(client, writing_mode="standard")
+
+    for _ in range(3):
+        stream = consume_stream(client, f"/stream/{project_id}")
+        assert "生成失败：writing_bot 未配置 model_server" in stream
+        assert "正在排队" not in stream
+    assert gateway.scheduler.stats()["running"] == 0
+
+    ticket = gateway.enqueue("writing_bot", "提示词", "alice", INTERACTIVE)
+    with pytest.raises(ValueError):
+        list(gateway.stream("writing_bot", "提示词", ticket))
+    assert ticket.released
@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+
+from .conftest import create_project
+
+
+class SlowAsyncWriter:
+    def __init__(self):
+        self.active = 0
+        self.peak = 0
+
+    async def astream_deltas(self, messages):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(0.2)
+            yield "林舟"
+            await asyncio.sleep(0.05)
+            yield "推开了门。"
+        finally:
+            self.active -= 1
+
+
+class BlockingWriter:
+    """A synchronous agent whose every chunk blocks its thread."""
+
+    def run(self, messages):
+        time.sleep(0.3)
+        yield [{"role": "assistant", "content": "林舟"}]
+        time.sleep(0.1)
+        yield [{"role": "assistant", "content": "林舟推开了门。"}]
+
+
+class TimedAsyncWriter:
+    def __init__(self, text: str, first_delay: float):
+        self.text = text
+        self.first_delay = first_delay
+        self.cancelled = False
+
+    async def astream_deltas(self, messages):
+        try:
+            await asyncio.sleep(self.first_delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        yield self.text
+
+
+def owner_of(app, project_id: str) -> str:
+    with app.extensions["novel_database"].connect() as connection:
+        return connection.execute(
+            "SELECT owner_token FROM projects WHERE id = ?", (project_id,)
+        ).fetchone()["owner_token"]
+
+
+def test_async_pipeline_multiplexes_streams_on_one_loop(client, app):
+    service = app.extensions["novel_service"]
+    service.gateway.scheduler = None
+    writer = SlowAsyncWriter()
+    service.gateway._agents["writing_bot"] = writer
+    service.gateway._groups.clear()
+    projects = [create_project(client) for _ in range(40)]
+    owner = owner_of(app, projects[0])
+
+    async def run(project_id):
+        return [event async for event in service.agenerate(project_id, owner, "initial")]
+
+    async def run_all():
+        return await asyncio.gather(*(run(project_id) for project_id in projects))
+
+    started = time.monotonic()
+    results = asyncio.run(run_all())
+    elapsed = time.monotonic() - started
+    service.wait_idle(timeout=10)
+
+    assert writer.peak == 40
+    assert elapsed < 2
+    for events in results:
+        assert [event["content"] for event in events if event["type"] == "content"] == [
+            "林舟",
+            "推开了门。",
+        ]
+        assert events[-1]["type"] == "complete"
+
+
+def test_sync_bridge_relays_async_pipeline_events(client, app):
+    service = app.extensions["novel_service"]
+    project_id = create_project(client)
+
+    events = list(service.generate(project_id, owner_of(app, project_id), "initial"))
+    service.wait_idle(timeout=10)
+
+    assert [event["type"] for event in events][-1] == "complete"
+    assert "".join(event["content"] for event in events if event["type"] == "content") == (
+        "林舟握紧钥匙，推开了门。"
+    )
+
+
+def test_blocking_agents_do_not_queue_on_the_default_executor(client, app):
+    service = app.extensions["novel_service"]
+    service.gateway.scheduler = None
+    service.gateway._agents["writing_bot"] = BlockingWriter()
+    service.gateway._groups.clear()
+    projects = [create_project(client) for _ in range(20)]
+    owner = owner_of(app, projects[0])
+    results: dict[str, list] = {}
+
+    def run(project_id):
+        results[project_id] = list(service.generate(project_id, owner, "initial"))
+
+    threads = [threading.Thread(target=run, args=(project_id,)) for project_id in projects]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    elapsed = time.monotonic() - started
+    service.wait_idle(timeout=10)
+
+    assert elapsed < 1.5
+    assert all(events[-1]["type"] == "complete" for events in results.values())
+
+
+def test_slow_primary_is_hedged_during_generate(client, app):
+    service = app.extensions["novel_service"]
+    gateway = service.gateway
+    gateway.scheduler = None
+    slow = TimedAsyncWriter("慢速服务的正文。", first_delay=3)
+    fast = TimedAsyncWriter("对冲服务的正文。", first_delay=0)
+    gateway.llm_config["writing_bot"]["balancing"] = {
+        "hedge": True,
+        "hedge_min_delay_seconds": 0.05,
+    }
+    gateway._agents["writing_bot"] = [slow, fast]
+    gateway._groups.clear()
+    gateway._group("writing_bot").endpoints[0].first_chunk_seconds.extend([0.01] * 10)
+    project_id = create_project(client)
+
+    started = time.monotonic()
+    events = list(service.generate(project_id, owner_of(app, project_id), "initial"))
+    elapsed = time.monotonic() - started
+    service.wait_idle(timeout=10)
+
+    assert elapsed < 1
+    assert [event["content"] for event in events if event["type"] == "content"] == [
+        "对冲服务的正文。"
+    ]
+    assert slow.cancelled
+    health = {item["endpoint"]: item for item in gateway.endpoint_health()["writing_bot"]}
+    assert health["writing_bot#1"]["hedges"] == 1
+    assert health["writing_bot#1"]["hedge_wins"] == 1
+    assert health["writing_bot#0"]["outstanding"] == 0
+
+
+def usage_by_generation(service, project_id: str) -> dict[str, dict[str, dict]]:
+    usage: dict[str, dict[str, dict]] = {}
+    for row in service.database.token_usage(project_id):
+        usage.setdefault(row["generation_id"], {})[row["stage"]] = row
+    return usage
+
+
+def test_usage_is_recorded_when_a_run_fails_or_is_abandoned(client, app):
+    service = app.extensions["novel_service"]
+    app.extensions["fake_writing"].fail_next_draft = True
+    failed = create_project(client, writing_mode="standard")
+    owner = owner_of(app, failed)
+
+    events = list(service.generate(failed, owner, "initial"))
+
+    assert events[-1]["type"] == "error"
+    assert set(usage_by_generation(service, failed)) == {""}
+    assert usage_by_generation(service, failed)[""]["plan"]["completion_tokens"] > 0
+
+    service.gateway._agents["writing_bot"] = SlowAsyncWriter()
+    service.gateway._groups.clear()
+    abandoned = create_project(client)
+
+    async def leave_after_first_chunk():
+        stream = service.agenerate(abandoned, owner, "initial")
+        async for event in stream:
+            if event["type"] == "content":
+                break
+        await stream.aclose()
+
+    asyncio.run(leave_after_first_chunk())
+
+    partial = usage_by_generation(service, abandoned)[""]["stream"]
+    assert partial["calls"] == 1 and partial["completion_tokens"] > 0
+
+
+def test_memory_built_during_a_stream_is_charged_to_the_project(client, app, monkeypatch):
+    service = app.extensions["novel_service"]
+    monkeypatch.setattr(service, "schedule_memory_build", lambda project, owner: False)
+    project_id = create_project(client, text="林舟沿着走廊前进。" * 30)
+
+    events = list(service.generate(project_id, owner_of(app, project_id), "initial"))
+    service.wait_idle(timeout=10)
+
+    assert "正在分块建立小说长期记忆…" in [event.get("content") for event in events]
+    generation_id = events[-1]["generation_id"]
+    usage = usage_by_generation(service, project_id)
+    assert set(usage[""]) == {"memory_build"}
+    assert "memory_build" not in usage[generation_id]
+    assert "stream" in usage[generation_id]
+
+
+def test_inline_background_jobs_do_not_block_the_shared_loop(client, app):
+    service = app.extensions["novel_service"]
+    service._executor = None
+    summary = app.extensions["fake_summary"]
+    original_run = summary.run
+
+    def slow_run(messages):
+        time.sleep(0.3)
+        yield from original_run(messages)
+
+    summary.run = slow_run
+    project_id = create_project(client, writing_mode="standard")
+
+    async def heartbeat():
+        gaps = []
+        for _ in range(12):
+            started = time.monotonic()
+            await asyncio.sleep(0.05)
+            gaps.append(time.monotonic() - started)
+        return gaps
+
+    beats = asyncio.run_coroutine_threadsafe(heartbeat(), service._loop.loop)
+    events = list(service.generate(project_id, owner_of(app, project_id), "initial"))
+
+    assert events[-1]["type"] == "complete"
+    assert summary.calls
+    assert max(beats.result(timeout=5)) < 0.2
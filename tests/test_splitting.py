@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+import time
+
+from novel_app.splitting import iter_chunk_spans
+
+
+def test_spans_cover_text_and_prefer_sentence_ends():
+    text = "林舟推开门。" * 30 + "他听见铃声！" * 30
+    spans = list(iter_chunk_spans(text, 50))
+
+    assert spans[0][0] == 0 and spans[-1][1] == len(text)
+    assert all(end == next_start for (_, end), (next_start, _) in zip(spans, spans[1:]))
+    assert all(end - start <= 50 for start, end in spans)
+    assert all(text[end - 1] in "。！" for _, end in spans)
+
+
+def test_paragraph_breaks_win_over_sentence_ends():
+    text = "第一段。" * 6 + "\n\n" + "第二段。" * 20
+    start, end = next(iter_chunk_spans(text, 40))
+    assert text[start:end].endswith("\n\n")
+
+
+def test_overlap_starts_on_a_sentence_boundary():
+    text = "甲乙丙丁。" * 40
+    spans = list(iter_chunk_spans(text, 40, overlap=10))
+
+    for (_, end), (next_start, _) in zip(spans, spans[1:]):
+        assert end - 10 <= next_start < end
+        assert text[next_start - 1] == "。"
+
+
+def test_single_paragraph_upload_splits_in_linear_time():
+    text = "字" * 2_000_000
+    started = time.perf_counter()
+    spans = list(iter_chunk_spans(text, 24_000))
+
+    assert len(spans) == 84
+    assert time.perf_counter() - started < 2
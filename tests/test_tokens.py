@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+from novel_app.tokens import BudgetSection, TokenEstimator, allocate, approximate_tokens
+
+
+def test_chinese_prose_costs_more_tokens_per_char_than_ascii():
+    assert approximate_tokens("林舟推开了门" * 10) > approximate_tokens("abcdef" * 10)
+    assert approximate_tokens("") == 0
+
+
+def test_unused_budget_flows_to_lower_priority_sections():
+    estimator = TokenEstimator()
+    sections = [
+        BudgetSection("tail", "尾" * 400, priority=1, minimum=30, cap=100),
+        BudgetSection("memory", "忆" * 20, priority=2, minimum=100, cap=100),
+        BudgetSection("recent", "续" * 400, priority=3, minimum=30),
+    ]
+    grants = allocate(sections, 300, estimator)
+
+    assert grants["memory"] == estimator.count("忆" * 20)
+    assert grants["tail"] == 100
+    assert sum(grants.values()) == 300
+
+
+def test_clip_respects_token_limit_and_kept_end():
+    estimator = TokenEstimator()
+    text = "开头" + "中间" * 200 + "结尾"
+    tail = estimator.clip(text, 20)
+    both = estimator.clip(text, 40, "both")
+
+    assert estimator.count(tail) <= 20 and tail.endswith("结尾")
+    assert both.startswith("开头") and both.endswith("结尾")
+
+
+def test_token_budget_leaves_room_for_output(app):
+    manager = app.extensions["novel_service"].memory
+    writing = manager.gateway.llm_config["writing_bot"]
+    writing["context_window"] = 1000
+    writing["generate_cfg"]["max_tokens"] = 600
+    manager.prompt_reserve_tokens = 200
+    manager.context_budget = 10_000
+
+    assert manager.token_budget("writing_bot") == 200
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
 import io
+import json
+import threading
+import time
 
-from .conftest import consume_stream, create_project
+from .conftest import consume_stream, create_project, generations
 
 
 def test_index_has_responsive_chat_workspace(client):
@@ -25,7 +28,9 @@ def test_initial_word_limit_is_persisted_and_used(client, app):
     assert '"type": "complete"' in stream
     project = client.get(f"/api/projects/{project_id}").get_json()["project"]
     assert project["word_limit"] == 2345
-    assert project["active_generations"][0]["content"] == "林舟握紧钥匙，推开了门。"
+    assert project["active_count"] == 1
+    assert "original_text" not in project
+    assert generations(client, project_id)[0]["content"] == "林舟握紧钥匙，推开了门。"
     draft_prompt = app.extensions["fake_writing"].calls[-1]
     assert "2345" in draft_prompt
 
@@ -42,29 +47,63 @@ def test_project_is_isolated_by_browser_session(app):
 
 def test_long_text_is_chunked_and_memory_is_cached(client, app):
     project_id = create_project(client, text="林舟沿着走廊前进。" * 30)
-    stream = consume_stream(client, f"/stream/{project_id}")
+    app.extensions["novel_service"].wait_for_pending(project_id, timeout=5)
 
-    assert "正在分块建立小说长期记忆" in stream
     summary = app.extensions["fake_summary"]
     chunk_calls = [call for call in summary.calls if "个分块" in call]
     assert len(chunk_calls) > 1
     project = client.get(f"/api/projects/{project_id}").get_json()["project"]
     assert project["has_memory"] is True
 
+    stream = consume_stream(client, f"/stream/{project_id}")
+    assert "正在分块建立小说长期记忆" not in stream
+    assert sum("小说第 1/" in call for call in summary.calls) == 1
+
+
+def test_stream_attaches_to_memory_build_queued_at_upload(client, app):
+    summary = app.extensions["fake_summary"]
+    release = threading.Event()
+    original_run = summary.run
+
+    def gated_run(messages):
+        release.wait(timeout=5)
+        yield from original_run(messages)
+
+    summary.run = gated_run
+    response = client.post(
+        "/process",
+        data={
+            "text_input": "林舟沿着走廊前进。" * 30,
+            "word_limit": "1000",
+            "writing_mode": "quick",
+        },
+    )
+    assert response.get_json()["memory_pending"] is True
+    project_id = response.get_json()["project_id"]
+
+    threading.Timer(0.1, release.set).start()
+    stream = consume_stream(client, f"/stream/{project_id}")
+
+    assert "正在分块建立小说长期记忆" in stream
+    assert '"type": "complete"' in stream
+    assert sum("小说第 1/" in call for call in summary.calls) == 1
+    text = client.get("/metrics").get_data(as_text=True)
+    assert 'novel_stage_seconds_count{stage="load_project"} 1' in text
+    assert 'novel_stage_seconds_count{stage="wait_pending"} 1' in text
+
 
 def test_failed_restart_keeps_active_version(client, app):
     project_id = create_project(client)
     consume_stream(client, f"/stream/{project_id}")
-    before = client.get(f"/api/projects/{project_id}").get_json()["project"]
-    active_id = before["active_generations"][0]["id"]
+    active_id = generations(client, project_id)[0]["id"]
 
     app.extensions["fake_writing"].fail_next_draft = True
     stream = consume_stream(client, f"/restart/{project_id}")
 
     assert '"type": "error"' in stream
     after = client.get(f"/api/projects/{project_id}").get_json()["project"]
-    assert after["active_generations"][0]["id"] == active_id
-    assert len(after["generation_history"]) == 1
+    assert after["latest_generation"]["id"] == active_id
+    assert after["version_count"] == 1
 
 
 def test_restart_creates_restorable_version(client, app):
@@ -74,18 +113,45 @@ def test_restart_creates_restorable_version(client, app):
     consume_stream(client, f"/stream/{project_id}")
     consume_stream(client, f"/restart/{project_id}")
 
-    project = client.get(f"/api/projects/{project_id}").get_json()["project"]
-    history = project["generation_history"]
+    history = generations(client, project_id, scope="history")
     assert len(history) == 2
-    assert project["active_generations"][0]["content"] == "第二版正文"
+    assert generations(client, project_id)[0]["content"] == "第二版正文"
 
     first = next(item for item in history if item["version"] == 1)
     response = client.post(
         f"/api/projects/{project_id}/restore/{first['id']}"
     )
     assert response.status_code == 200
-    restored = client.get(f"/api/projects/{project_id}").get_json()["project"]
-    assert restored["active_generations"][0]["content"] == "第一版正文"
+    assert generations(client, project_id)[0]["content"] == "第一版正文"
+
+
+def test_restore_does_not_hold_the_request_during_a_memory_update(client, app, monkeypatch):
+    monkeypatch.setattr("novel_app.service.RESTORE_WAIT_SECONDS", 0.1)
+    service = app.extensions["novel_service"]
+    app.extensions["fake_writing"].writing_outputs = ["第一版正文", "第二版正文"]
+    project_id = create_project(client)
+    consume_stream(client, f"/stream/{project_id}")
+    consume_stream(client, f"/restart/{project_id}")
+    first = next(
+        item
+        for item in generations(client, project_id, scope="history")
+        if item["version"] == 1
+    )
+    release = threading.Event()
+    service._submit(project_id, "", lambda: release.wait(5), "正在更新记忆…")
+
+    started = time.monotonic()
+    busy = client.post(f"/api/projects/{project_id}/restore/{first['id']}")
+    assert time.monotonic() - started < 1
+    assert busy.status_code == 409
+    assert busy.get_json()["error"] == "记忆更新仍在进行，请稍后再恢复版本"
+    assert generations(client, project_id)[0]["content"] == "第二版正文"
+
+    release.set()
+    service.wait_idle(timeout=5)
+    restored = client.post(f"/api/projects/{project_id}/restore/{first['id']}")
+    assert restored.status_code == 200
+    assert generations(client, project_id)[0]["content"] == "第一版正文"
 
 
 def test_upload_extension_and_word_limit_are_validated(client):
@@ -118,8 +184,257 @@ def test_standard_mode_plans_and_checks_consistency(client, app):
     stream = consume_stream(client, f"/stream/{project_id}")
 
     assert "正在规划本段情节" in stream
-    assert '"type": "review"' in stream
-    project = client.get(f"/api/projects/{project_id}").get_json()["project"]
-    generation = project["active_generations"][0]
+    assert '"review_pending": true' in stream
+    generation = generations(client, project_id)[0]
     assert generation["plan"]
     assert generation["consistency_report"] == "未发现明显一致性问题"
+    review = client.get(
+        f"/api/projects/{project_id}/generations/{generation['id']}/review"
+    ).get_json()
+    assert review["pending"] is False
+    assert review["consistency_report"] == "未发现明显一致性问题"
+
+
+def test_complete_is_sent_before_post_processing_finishes(client, app):
+    project_id = create_project(client, writing_mode="standard")
+    service = app.extensions["novel_service"]
+    release = threading.Event()
+    summary = app.extensions["fake_summary"]
+    original_run = summary.run
+
+    def slow_run(messages):
+        release.wait(timeout=5)
+        yield from original_run(messages)
+
+    summary.run = slow_run
+    response = client.get(f"/stream/{project_id}", buffered=True)
+    stream = response.get_data(as_text=True)
+
+    assert '"type": "complete"' in stream
+    assert service.has_pending_work(project_id)
+    release.set()
+    service.wait_for_pending(project_id, timeout=5)
+    assert not service.has_pending_work(project_id)
+
+
+def test_review_and_memory_update_run_concurrently(client, app):
+    service = app.extensions["novel_service"]
+    service.memory.chunk_chars = 1_000
+    project_id = create_project(
+        client, text="林舟沿着走廊前进。" * 30, writing_mode="standard"
+    )
+    consume_stream(client, f"/stream/{project_id}")
+    summary = app.extensions["fake_summary"]
+    original_run = summary.run
+    both_started = threading.Barrier(2, timeout=5)
+
+    def rendezvous_run(messages):
+        both_started.wait()
+        yield from original_run(messages)
+
+    summary.run = rendezvous_run
+    stream = consume_stream(client, f"/continue/{project_id}")
+
+    assert '"review_pending": true' in stream
+    assert not both_started.broken
+    project = client.get(f"/api/projects/{project_id}").get_json()["project"]
+    latest = generations(client, project_id)[-1]
+    assert latest["consistency_report"] == "未发现明显一致性问题"
+    assert "memory_json" not in project and project["has_memory"] is True
+    with app.extensions["novel_database"].connect() as connection:
+        memory_json = connection.execute(
+            "SELECT memory_json FROM projects WHERE id = ?", (project_id,)
+        ).fetchone()["memory_json"]
+    assert "林舟推开旧宅大门" in json.loads(memory_json)["timeline"]
+
+
+def test_speculative_plan_is_reused_only_when_nothing_changed(client, app):
+    service = app.extensions["novel_service"]
+    service.speculative_planning = True
+    writing = app.extensions["fake_writing"]
+    project_id = create_project(client, writing_mode="standard")
+    consume_stream(client, f"/stream/{project_id}")
+    plan_calls = sum("拟定一个简短" in call for call in writing.calls)
+    assert plan_calls == 2
+
+    stream = consume_stream(client, f"/continue/{project_id}")
+    assert "已采用预先拟定的本段计划" in stream
+    assert "正在规划本段情节" not in stream
+    assert sum("拟定一个简短" in call for call in writing.calls) == 3
+
+    stream = consume_stream(client, f"/restart/{project_id}")
+    assert "正在规划本段情节" in stream
+
+
+def test_restart_does_not_wait_for_a_speculative_plan_it_cannot_use(client, app):
+    service = app.extensions["novel_service"]
+    service.speculative_planning = True
+    writing = app.extensions["fake_writing"]
+    project_id = create_project(client, writing_mode="standard")
+    release = threading.Event()
+    original_run = writing.run
+
+    def slow_speculation(messages):
+        if threading.current_thread().name.startswith("novel-background"):
+            release.wait(timeout=5)
+        yield from original_run(messages)
+
+    writing.run = slow_speculation
+    client.get(f"/stream/{project_id}", buffered=True)
+    started = time.perf_counter()
+    stream = client.get(f"/restart/{project_id}", buffered=True).get_data(as_text=True)
+    elapsed = time.perf_counter() - started
+    release.set()
+    service.wait_idle(timeout=5)
+
+    assert "正在规划本段情节" in stream
+    assert '"type": "complete"' in stream
+    assert elapsed < 2
+
+
+def test_cache_friendly_layout_shares_prompt_prefixes(client, app):
+    service = app.extensions["novel_service"]
+    ratios = {}
+    for layout in ("standard", "cache_friendly"):
+        service.prompt_layout = layout
+        project_id = create_project(client, writing_mode="standard")
+        consume_stream(client, f"/stream/{project_id}")
+        consume_stream(client, f"/continue/{project_id}")
+        project = client.get(f"/api/projects/{project_id}").get_json()["project"]
+        assert project["prompt_prefix"]["requests"] == 4
+        ratios[layout] = project["prompt_prefix"]["shared_prefix_ratio"]
+
+    assert ratios["cache_friendly"] > 2 * ratios["standard"]
+    writing = app.extensions["fake_writing"]
+    assert writing.calls[-1].startswith(writing.calls[-2].split("【本次任务】")[0])
+
+
+def test_prefix_statistics_are_bounded_and_dropped_with_the_project(client, app, monkeypatch):
+    monkeypatch.setattr("novel_app.service.PREFIX_TRACKED_PROJECTS", 2)
+    service = app.extensions["novel_service"]
+    project_ids = [create_project(client) for _ in range(3)]
+    for project_id in project_ids:
+        consume_stream(client, f"/stream/{project_id}")
+
+    assert list(service._prefixes) == project_ids[1:]
+    assert service.prefix_stats(project_ids[0])["requests"] == 0
+
+    assert client.delete(f"/api/projects/{project_ids[2]}").status_code == 200
+    assert list(service._prefixes) == project_ids[1:2]
+
+
+def test_restart_updates_memory_snapshot_before_replaced_segment(client, app):
+    app.extensions["novel_service"].memory.chunk_chars = 1_000
+    project_id = create_project(client, text="林舟沿着走廊前进。" * 30)
+    consume_stream(client, f"/stream/{project_id}")
+    first_id = client.get(f"/api/projects/{project_id}").get_json()["project"][
+        "latest_generation"
+    ]["id"]
+    summary = app.extensions["fake_summary"]
+    patch_prompts = [call for call in summary.calls if "JSON 补丁" in call]
+    assert "林舟推开旧宅大门" not in patch_prompts[-1]
+
+    consume_stream(client, f"/restart/{project_id}")
+
+    patch_prompts = [call for call in summary.calls if "JSON 补丁" in call]
+    assert "林舟推开旧宅大门" not in patch_prompts[-1].split("新段落：")[0]
+    response = client.post(f"/api/projects/{project_id}/restore/{first_id}")
+    assert response.status_code == 200
+    database = app.extensions["novel_database"]
+    snapshot = database.memory_snapshot(project_id, 1, first_id)
+    assert snapshot and "林舟推开旧宅大门" in snapshot[1]["timeline"]
+
+
+def test_stages_are_timed_and_exported_as_prometheus_histograms(client, app):
+    app.extensions["novel_service"].metrics_event = True
+    project_id = create_project(client, writing_mode="standard")
+    stream = consume_stream(client, f"/stream/{project_id}")
+    events = [
+        json.loads(line[6:]) for line in stream.splitlines() if line.startswith("data: ")
+    ]
+
+    assert [event["type"] for event in events[-2:]] == ["complete", "metrics"]
+    summary = events[-1]
+    assert {"load_project", "context", "plan", "first_token", "stream", "save"} <= set(
+        summary["stages_ms"]
+    )
+    assert [call["stage"] for call in summary["llm_calls"]] in (
+        ["plan", "stream"],
+        ["stream", "plan"],
+    )
+    writing_call = next(call for call in summary["llm_calls"] if call["stage"] == "stream")
+    assert writing_call["response_chars"] == len("林舟握紧钥匙，推开了门。")
+    assert writing_call["prompt_tokens"] > 0
+
+    text = client.get("/metrics").get_data(as_text=True)
+    assert "# TYPE novel_stage_seconds histogram" in text
+    assert 'novel_stage_seconds_count{stage="consistency"} 1' in text
+    assert 'novel_stage_seconds_count{stage="memory_update"} 1' in text
+    assert 'novel_stage_seconds_count{stage="load_project"} 1' in text
+    assert 'stage="wait_pending"' not in text
+    assert 'novel_llm_response_chars_bucket{bot="writing_bot",stage="stream",le="+Inf"} 1' in text
+    assert 'novel_llm_prompt_tokens_count{bot="summary_bot",stage="consistency"} 1' in text
+
+
+def test_token_usage_is_recorded_per_generation_and_caps_runaway_projects(client, app):
+    service = app.extensions["novel_service"]
+    service.gateway.llm_config["writing_bot"]["pricing"] = {
+        "prompt_per_million": 2,
+        "completion_per_million": 8,
+    }
+    project_id = create_project(client, writing_mode="standard")
+    stream = consume_stream(client, f"/stream/{project_id}")
+    estimate = next(
+        json.loads(line[6:])
+        for line in stream.splitlines()
+        if line.startswith("data: ") and '"estimate"' in line
+    )
+    assert estimate["project_tokens"] == 0
+    assert estimate["completion_tokens"] > 1200 * 0.7
+
+    project = client.get(f"/api/projects/{project_id}").get_json()["project"]
+    usage = project["token_usage"]
+    generation_id = project["latest_generation"]["id"]
+    stages = {(item["bot"], item["stage"]): item for item in usage["by_stage"]}
+    assert set(stages) == {
+        ("writing_bot", "plan"),
+        ("writing_bot", "stream"),
+        ("summary_bot", "consistency"),
+    }
+    assert stages[("writing_bot", "stream")]["completion_tokens"] > 0
+    assert stages[("summary_bot", "consistency")]["cost"] == 0
+    assert usage["cost"] > 0
+    assert [item["generation_id"] for item in usage["by_generation"]] == [generation_id]
+    assert usage["total_tokens"] == usage["prompt_tokens"] + usage["completion_tokens"]
+
+    service.max_project_tokens = usage["total_tokens"] + 10
+    stream = consume_stream(client, f"/continue/{project_id}")
+    assert "项目累计 Token 预计将超过上限" in stream
+    assert len(app.extensions["fake_writing"].calls) == 2
+
+
+def test_generations_are_listed_in_pages_without_their_text(client, app):
+    app.extensions["fake_writing"].writing_outputs = ["第一段", "第二段", "第三段", "第三段新版"]
+    project_id = create_project(client)
+    consume_stream(client, f"/stream/{project_id}")
+    consume_stream(client, f"/continue/{project_id}")
+    consume_stream(client, f"/continue/{project_id}")
+    consume_stream(client, f"/restart/{project_id}")
+
+    url = f"/api/projects/{project_id}/generations"
+    first = client.get(url, query_string={"limit": 2}).get_json()
+    assert [item["position"] for item in first["generations"]] == [1, 2]
+    assert "content" not in first["generations"][0]
+    assert first["generations"][0]["excerpt"] == "第一段"
+    assert first["generations"][0]["content_chars"] == 3
+    rest = client.get(url, query_string={"limit": 2, "cursor": first["next_cursor"]}).get_json()
+    assert [item["excerpt"] for item in rest["generations"]] == ["第三段新版"]
+    assert rest["next_cursor"] is None
+
+    history = generations(client, project_id, scope="history", limit=1)
+    assert [(item["position"], item["version"]) for item in history] == [(1, 1), (2, 1), (3, 2), (3, 1)]
+    assert client.get(url, query_string={"cursor": "x"}).status_code == 400
+
+    export = client.get(f"/api/projects/{project_id}/export")
+    assert export.mimetype == "text/markdown"
+    assert "## 续写 3\n\n第三段新版" in export.get_data(as_text=True)